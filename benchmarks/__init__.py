@@ -0,0 +1,8 @@
+"""
+offline microbenchmarks of models, fields, views and the in-memory backend.
+run from the repository root:
+
+    python -m benchmarks                    # run and compare to the baseline
+    python -m benchmarks --save             # store the run as the baseline
+    python -m benchmarks -k view --sizes 1000,10000
+"""
@@ -0,0 +1,74 @@
+import argparse
+import os
+import sys
+
+from . import harness, suite
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='runs the benchmarks and compares them to a baseline')
+    parser.add_argument('-k', dest='pattern',
+        help='only run benchmarks with this in their name')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+        help='document counts for the view benchmarks, comma separated')
+    parser.add_argument('--min-time', type=float, default=0.2,
+        help='least seconds to time each benchmark for')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='timings taken of each benchmark, the best one counts')
+    parser.add_argument('--baseline', default=BASELINE,
+        help='baseline results file, default: %(default)s')
+    parser.add_argument('--save', action='store_true',
+        help='store this run as the baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help='slowdown over the baseline that fails the run, 0.25 => 25%%')
+    parser.add_argument('--min-diff', type=float, default=1e-7,
+        help='least slowdown in seconds that fails the run, '
+            'default: %(default)s')
+    parser.add_argument('--retries', type=int, default=2,
+        help='times benchmarks found slower are run again, keeping their '
+            'best time, before the run fails')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    results = harness.run(sizes, args.pattern, args.min_time, args.repeat)
+    if args.save:
+        if args.pattern and os.path.exists(args.baseline):
+            # keep the baseline of the benchmarks not run
+            merged = harness.load(args.baseline)['results']
+            merged.update(results)
+            results = merged
+        harness.save(args.baseline, results)
+        print 'saved {} results to {}'.format(len(results), args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print 'no baseline at {}, store one with --save'.format(args.baseline)
+        return 0
+    baseline = harness.load(args.baseline)
+    for _ in range(args.retries):
+        # a slowdown has to hold over the best of several runs
+        slower = harness.regressions(
+            baseline, results, args.tolerance, args.min_diff)
+        if not slower:
+            break
+        print '\nrunning {} slower benchmark(s) again'.format(len(slower))
+        again = harness.run(sizes, None, args.min_time, args.repeat,
+            names=slower)
+        for name, seconds in again.iteritems():
+            results[name] = min(results[name], seconds)
+    print
+    slower = harness.compare(
+        baseline, results, args.tolerance, args.min_diff)
+    if slower:
+        print '\n{} benchmark(s) slower than the baseline: {}'.format(
+            len(slower), ', '.join(slower))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
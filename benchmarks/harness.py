@@ -0,0 +1,131 @@
+import json
+import platform
+import sys
+from timeit import Timer
+
+
+# (name, setup) pairs in registration order
+REGISTRY = []
+
+
+def benchmark(name, sizes=False):
+    """
+    registers setup(size) returning the callable to time.  with sizes, it
+    is registered once per document count, as name[size].
+    """
+    def register(setup):
+        REGISTRY.append((name, setup, sizes))
+        return setup
+    return register
+
+
+def expand(sizes):
+    """ the (name, setup, size) of every registered benchmark """
+    for name, setup, sized in REGISTRY:
+        if sized:
+            for size in sizes:
+                yield '{}[{}]'.format(name, size), setup, size
+        else:
+            yield name, setup, None
+
+
+def measure(fn, min_time=0.2, repeat=5):
+    """ best seconds per call, calling fn often enough for min_time """
+    timer = Timer(fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1000000:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        best = min(best, timer.timeit(number))
+    return best / number
+
+
+def run(sizes, pattern=None, min_time=0.2, repeat=5, out=sys.stdout,
+        names=None):
+    """ names - only run the benchmarks of these exact names """
+    results = {}
+    for name, setup, size in expand(sizes):
+        if pattern and pattern not in name:
+            continue
+        if names is not None and name not in names:
+            continue
+        fn = setup(size) if size is not None else setup()
+        results[name] = measure(fn, min_time, repeat)
+        out.write('{:<40} {:>12}\n'.format(name, human(results[name])))
+        out.flush()
+    return results
+
+
+def human(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return '{:.3f}{}'.format(seconds * scale, unit)
+    return '{:.3f}ns'.format(seconds * 1e9)
+
+
+def save(path, results):
+    with open(path, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results }, f, indent=2, sort_keys=True,
+            separators=(',', ': '))
+        f.write('\n')
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _changed(base, result, tolerance, min_diff):
+    """
+    1 when result is slower than base by more than tolerance and by at
+    least min_diff seconds, -1 when likewise faster, else 0.  the absolute
+    floor keeps the timer noise of the shortest benchmarks from counting.
+    """
+    if abs(result - base) < min_diff:
+        return 0
+    if result > base * (1 + tolerance):
+        return 1
+    if result < base * (1 - tolerance):
+        return -1
+    return 0
+
+
+def regressions(baseline, results, tolerance=0.25, min_diff=1e-7):
+    """ the names in results slower than the baseline, see compare """
+    base = baseline['results']
+    return [name for name in sorted(results) if name in base
+        and _changed(base[name], results[name], tolerance, min_diff) > 0]
+
+
+def compare(baseline, results, tolerance=0.25, min_diff=1e-7,
+        out=sys.stdout):
+    """
+    prints each result next to the baseline, returns the names that got
+    slower than the baseline by more than tolerance (0.25 => 25%) and by
+    at least min_diff seconds
+    """
+    base = baseline['results']
+    slower = []
+    for name in sorted(results):
+        if name not in base:
+            out.write('{:<40} {:>12} {:>12}\n'.format(
+                name, human(results[name]), 'new'))
+            continue
+        ratio = results[name] / base[name]
+        flag = ''
+        changed = _changed(base[name], results[name], tolerance, min_diff)
+        if changed > 0:
+            slower.append(name)
+            flag = '  SLOWER'
+        elif changed < 0:
+            flag = '  faster'
+        out.write('{:<40} {:>12} {:>12} {:>+7.1%}{}\n'.format(
+            name, human(base[name]), human(results[name]), ratio - 1, flag))
+    return slower
@@ -0,0 +1,275 @@
+import atexit
+import os
+import shutil
+import tempfile
+from base64 import b64encode
+from datetime import datetime
+
+from cushion import columns
+from cushion.model import Model
+from cushion.field import (
+    BooleanField, ByteField, DateTimeField, DictField, FloatField,
+    IntegerField, ListField, OptionField, RefField, TextField, prefetch )
+from cushion.persist import set_connection
+from cushion.persist.mem import MemConnection
+from cushion.view import View, sync_all
+
+from .harness import benchmark
+
+
+# python maps, so that nothing needs a js runtime
+def map_by_count(doc, meta):
+    if doc.get('type') == 'item':
+        yield doc['count'], None
+
+
+def map_by_size(doc, meta):
+    if doc.get('type') == 'item':
+        yield doc['size'], None
+
+
+class Brand(Model):
+    name = TextField()
+
+
+class Item(Model):
+    name = TextField()
+    count = IntegerField()
+    price = FloatField()
+    active = BooleanField()
+    added = DateTimeField()
+    tags = ListField()
+    attrs = DictField()
+    blob = ByteField()
+    size = OptionField(choices=['s', 'm', 'l'])
+    brand = RefField(Brand)
+
+    by_count = View(
+        'bench', 'by_count',
+        '''
+        function(doc) {
+            if (doc.type == "item") {
+                emit(doc.count, null)
+            }
+        }
+        ''',
+        pymapf=map_by_count )
+
+    count_by_size = View(
+        'bench', 'count_by_size',
+        '''
+        function(doc) {
+            if (doc.type == "item") {
+                emit(doc.size, null)
+            }
+        }
+        ''',
+        redf='_count',
+        pymapf=map_by_size )
+
+
+FIELD_VALUES = {
+    'name': u'item',
+    'count': 7,
+    'price': 9.95,
+    'active': True,
+    'added': '2016-03-01T12:30:00+00:00',
+    'tags': ['red', 'sale'],
+    'attrs': {'color': 'red', 'sizes': [1, 2, 3]},
+    'blob': b64encode('\x00\x01' * 32),
+    'size': 'm' }
+
+SET_VALUES = dict(FIELD_VALUES, added=datetime(2016, 3, 1, 12, 30))
+
+
+def item_doc(i, brand_id=None):
+    doc = dict(FIELD_VALUES, type='item', count=i, size='sml'[i % 3],
+        name=u'item {}'.format(i))
+    if brand_id:
+        doc['brand'] = brand_id
+    return doc
+
+
+def connect(n=0, brands=1):
+    """ a fresh MemConnection holding n items, and the brand ids """
+    conn = MemConnection()
+    set_connection(conn)
+    brand_ids = [conn.set('brand{}'.format(b),
+        {'type': 'brand', 'name': u'brand'})[0] for b in range(brands)]
+    conn.set_multi([('item{}'.format(i), item_doc(i, brand_ids[i % brands]))
+        for i in range(n)])
+    return conn, brand_ids
+
+
+# models and fields
+
+@benchmark('model.construct')
+def construct():
+    kw = dict(SET_VALUES)
+    return lambda: Item(**kw)
+
+
+@benchmark('model.from_doc')
+def from_doc():
+    doc = item_doc(1, 'brand0')
+    return lambda: Item._from_doc('item1', dict(doc))
+
+
+@benchmark('model.update_fields')
+def update_fields():
+    return Item._update_fields
+
+
+def _field_get(name):
+    # a fresh model every call, so that the raw value is decoded rather
+    # than read back from _data.  less model.from_doc, that's the decode.
+    def setup():
+        doc = item_doc(1)
+        field = Item.__dict__[name]
+        return lambda: field.__get__(Item._from_doc('item1', doc), Item)
+    return setup
+
+
+def _field_set(name):
+    def setup():
+        item = Item()
+        field = Item.__dict__[name]
+        value = SET_VALUES[name]
+        return lambda: field.__set__(item, value)
+    return setup
+
+
+for _name in sorted(FIELD_VALUES):
+    _type = type(Item.__dict__[_name]).__name__
+    benchmark('field.get.{}'.format(_type))(_field_get(_name))
+    benchmark('field.set.{}'.format(_type))(_field_set(_name))
+
+
+@benchmark('model.to_doc')
+def to_doc():
+    item = Item(**SET_VALUES)
+    return item._to_doc
+
+
+@benchmark('model.save.new')
+def save_new():
+    connect()
+    kw = dict(SET_VALUES)
+    return lambda: Item(**kw).save()
+
+
+@benchmark('model.save.changed')
+def save_changed():
+    connect(1)
+    item = Item.load('item0')
+    counter = iter(xrange(10 ** 9))
+    def save():
+        item.count = next(counter)
+        item.save()
+    return save
+
+
+@benchmark('model.load')
+def load():
+    connect(1)
+    return lambda: Item.load('item0')
+
+
+@benchmark('model.load_many.100')
+def load_many():
+    connect(100)
+    ids = ['item{}'.format(i) for i in range(100)]
+    return lambda: Item.load_many(ids)
+
+
+@benchmark('ref.resolve')
+def ref_resolve():
+    connect(1)
+    doc = item_doc(0, 'brand0')
+    return lambda: Item._from_doc('item0', dict(doc)).brand
+
+
+@benchmark('ref.prefetch.100')
+def ref_prefetch():
+    connect(100, brands=10)
+    docs = [('item{}'.format(i), item_doc(i, 'brand{}'.format(i % 10)))
+        for i in range(100)]
+    return lambda: prefetch(
+        [Item._from_doc(k, dict(doc)) for k, doc in docs], 'brand')
+
+
+# views over n docs
+
+def _view_conn(n):
+    conn, _ = connect(n)
+    sync_all(Item.viewlist())
+    return conn
+
+
+@benchmark('view.build', sizes=True)
+def view_build(n):
+    conn = _view_conn(n)
+    view = conn.designs['bench/by_count']
+    def build():
+        view['index'] = None
+        conn.query('bench', 'by_count', limit=1)
+    return build
+
+
+@benchmark('view.query.100', sizes=True)
+def view_query(n):
+    _view_conn(n)
+    start = n // 2
+    return lambda: Item.by_count(
+        startkey=start, endkey=start + 99, include_docs=True)
+
+
+def view_columns(n):
+    _view_conn(n)
+    start = n // 2
+    return lambda: Item.by_count.to_columns(['count', 'price', 'added'],
+        startkey=start, endkey=start + 99)
+
+
+if columns.numpy is not None:
+    benchmark('view.to_columns.100', sizes=True)(view_columns)
+
+
+@benchmark('view.reduce.group', sizes=True)
+def view_reduce(n):
+    conn = _view_conn(n)
+    index = conn._index(conn.designs['bench/count_by_size'])
+    def reduce_():
+        # uncached, as after a write
+        index.reductions = {}
+        Item.count_by_size(group=True)
+    return reduce_
+
+
+@benchmark('view.query.after_write', sizes=True)
+def view_query_after_write(n):
+    _view_conn(n)
+    item = Item.load('item0')
+    counter = iter(xrange(10 ** 9))
+    def write_and_query():
+        item.count = next(counter)
+        item.save()
+        Item.by_count(startkey=0, limit=10)
+    return write_and_query
+
+
+@benchmark('mem.open_snapshot', sizes=True)
+def open_snapshot(n):
+    conn = _view_conn(n)
+    Item.by_count(limit=1)
+    tmp = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, tmp, True)
+    path = os.path.join(tmp, 'bench.snap')
+    conn.dump(path)
+    def open_():
+        conn = MemConnection(path=path)
+        set_connection(conn)
+        sync_all(Item.viewlist())
+        Item.by_count(limit=1)
+        conn.close()
+    return open_
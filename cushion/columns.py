@@ -0,0 +1,147 @@
+from collections import OrderedDict
+
+import iso8601
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from .field import BooleanField, DateTimeField, Field, FloatField, \
+    IntegerField
+
+
+# columns of the rows themselves, anything else is a field of their docs
+ROW_COLUMNS = ('id', 'key', 'value')
+
+
+def _int(v):
+    return 0 if v is None else int(v)
+
+
+def _float(v):
+    return float('nan') if v is None else float(v)
+
+
+# field type => (numpy dtype, value as that dtype, missing ones included).
+# ints and bools miss as 0 and False, like the fields default to.
+DTYPES = (
+    (BooleanField, 'bool', bool),
+    (IntegerField, 'int64', _int),
+    (FloatField, 'float64', _float) )
+
+DATETIME = 'datetime64[us]'
+
+
+def _utc(dt):
+    """ a datetime as naive utc """
+    if dt is not None and dt.tzinfo is not None:
+        dt = dt.astimezone(iso8601.UTC).replace(tzinfo=None)
+    return dt
+
+
+def _utc_iso(v):
+    """ an isoformat string in utc less its offset, None for other values """
+    if not isinstance(v, basestring) or len(v) <= 10:
+        return None
+    if v.endswith('+00:00'):
+        v = v[:-6]
+    elif v.endswith('Z'):
+        v = v[:-1]
+    # any other offset follows the date
+    if '+' in v[10:] or '-' in v[10:]:
+        return None
+    return v
+
+
+def _datetime_column(values, field):
+    """
+    isoformat strings in utc, as DateTimeFields store utc datetimes, are
+    left for numpy to parse in bulk, which is many times faster.  other
+    values go through the field's own parsing.
+    """
+    load = field._loader
+    values = list(values)
+    bulk = []
+    for v in values:
+        iso = _utc_iso(v)
+        bulk.append(iso if iso is not None else _utc(load(v)))
+    try:
+        # None is NaT
+        return numpy.array(bulk, dtype=DATETIME)
+    except ValueError:
+        # iso8601 forms numpy can't read, eg. without dashes
+        return numpy.array([_utc(load(v)) for v in values], dtype=DATETIME)
+
+
+def _column_type(model, name):
+    """
+    (dtype, convert) of a column, convert being the DateTimeField of
+    datetime columns.  untyped columns hold objects.
+    """
+    if name in ROW_COLUMNS or model is None:
+        return object, None
+    field = getattr(model, name, None)
+    if not isinstance(field, Field):
+        raise ValueError('{} is not a field of {}'.format(
+            name, model.__name__) )
+    if isinstance(field, DateTimeField):
+        return DATETIME, field
+    for cls, dtype, convert in DTYPES:
+        if isinstance(field, cls):
+            return dtype, convert
+    return object, None
+
+
+def _values(rows, name):
+    if name == 'id':
+        return (r.docid for r in rows)
+    if name == 'key':
+        return (r.key for r in rows)
+    if name == 'value':
+        return (r.value for r in rows)
+    return (r.doc.value.get(name) if r.doc is not None else None
+        for r in rows)
+
+
+def _column(rows, name, dtype, convert):
+    values = _values(rows, name)
+    if dtype is object:
+        column = numpy.empty(len(rows), dtype=object)
+        for i, v in enumerate(values):
+            column[i] = v
+        return column
+    if dtype == DATETIME:
+        return _datetime_column(values, convert)
+    return numpy.fromiter((convert(v) for v in values), dtype=dtype,
+        count=len(rows))
+
+
+def columns(rows, model, fields, arrow=False):
+    """
+    view rows as typed columns, read from the docs without making models.
+    returns {name: numpy array} in the order of fields, or a pyarrow
+    RecordBatch with arrow.
+    model - the model of the docs, whose field types pick the dtypes:
+            Integer, Float, Boolean and DateTimeFields get int64, float64,
+            bool and datetime64[us] (utc) columns, others hold objects
+    fields - field names, or 'id', 'key' and 'value' of the rows
+    """
+    if numpy is None:
+        raise ImportError('columns need numpy')
+    if arrow and pyarrow is None:
+        raise ImportError('arrow columns need pyarrow')
+    rows = list(rows)
+    cols = OrderedDict()
+    for name in fields:
+        dtype, convert = _column_type(model, name)
+        cols[name] = _column(rows, name, dtype, convert)
+    if not arrow:
+        return cols
+    # nan and NaT become nulls
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(c, from_pandas=True) for c in cols.itervalues()],
+        list(cols) )
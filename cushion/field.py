@@ -5,6 +5,10 @@ from datetime import datetime
 from json import loads
 import iso8601
 
+from .persist import get_connection
+from .persist.codec import compress, decompress, is_packed, pack_bytes, \
+    unpack_bytes
+
 
 class Field(object):
 
@@ -23,16 +27,23 @@ class Field(object):
         self._field_name = None
 
     def _get_fieldname(self, model_instance):
+        # models bind _field_name when their class is created
         if self._field_name:
             return self._field_name
         fields = getattr(model_instance, "_fields")
         return fields[self.id]
 
     def _get_value(self, instance):
-        field_name = self._get_fieldname(instance)
-        value = None
-        if field_name in instance._data:
-            return instance._data.get(field_name)
+        field_name = self._field_name or self._get_fieldname(instance)
+        data = instance._data
+        if field_name in data:
+            return data[field_name]
+        raw = instance._raw_data
+        if field_name in raw:
+            # loaded from a doc, decoded on first access
+            value = raw[field_name]
+            data[field_name] = self._loader(value) if self._loader else value
+            return data[field_name]
         default = self._default
         if default is not None:
             default_val = default() if callable(default) else default
@@ -45,8 +56,18 @@ class Field(object):
     def to_d(self, instance):
         return self._get_value(instance)
 
+    def same(self, stored, other):
+        """ whether two stored values load the same, eg. two date spellings """
+        if self._loader is None:
+            return stored == other
+        try:
+            return self._loader(stored) == self._loader(other)
+        except (TypeError, ValueError):
+            # eg. naive and aware datetimes
+            return False
+
     def __set__(self, instance, value):
-        field_name = self._get_fieldname(instance)
+        field_name = self._field_name or self._get_fieldname(instance)
         v_ = self._loader(value) if self._loader else value
         instance._data[field_name] = v_
 
@@ -124,6 +145,45 @@ class RefField(Field):
         return val.id
 
 
+def prefetch(models, *paths):
+    """
+    resolves the RefFields named by paths for all models at once, with one
+    multi-get per referenced class and level instead of a get per model.
+    nested references are dotted, eg. prefetch(outfits, 'pants.brand').
+    returns the models.
+    """
+    tree = {}
+    for path in paths:
+        name, _, rest = path.partition('.')
+        subpaths = tree.setdefault(name, [])
+        if rest:
+            subpaths.append(rest)
+    for name, subpaths in tree.iteritems():
+        targets = []
+        pending = {}
+        for m in models:
+            if m is None:
+                continue
+            field = getattr(m.__class__, name, None)
+            if not isinstance(field, RefField):
+                raise ValueError('{} is not a RefField of {}'.format(
+                    name, m.__class__.__name__) )
+            if name in m._data:
+                targets.append(m._data[name])
+            elif m._raw_data.get(name):
+                pending.setdefault(field._cls, []).append(
+                    (m, m._raw_data[name]) )
+        for cls, pairs in pending.iteritems():
+            loaded = cls.load_many(set(docid for _, docid in pairs))
+            loaded = {x.id: x for x in loaded}
+            for m, docid in pairs:
+                m._data[name] = loaded.get(docid)
+                targets.append(m._data[name])
+        if subpaths:
+            prefetch(targets, *subpaths)
+    return models
+
+
 class OptionField(Field):
 
     def __verify_choice(self, ch):
@@ -160,16 +220,45 @@ class ByteField(Field):
     """
     Loads b64encoded data from the database.
     Must be assigned b64 data when created.
+
+    Large values can be stored compressed.  connections whose docs can hold
+    raw bytes (see BaseConnection.binary_values), eg. with a msgpack
+    DocumentCodec, get the compressed bytes,
+    others "<method>:<b64 data>".  b64 never holds a ':' nor a nul byte, so
+    all of them load alike.
     """
 
     def _byte_loader(self, instr):
-        return b64decode(instr) if instr else ''
-
-    def __init__(self, **kw):
+        if not instr:
+            return ''
+        if is_packed(instr):
+            return unpack_bytes(instr)
+        method, marked, data = instr.partition(':')
+        if not marked:
+            return b64decode(instr)
+        return decompress(b64decode(data), method)
+
+    def __init__(self, compression=None, threshold=1024, **kw):
+        """
+        compression - 'zlib' or 'lz4' to compress values of threshold bytes
+                      and up when saving
+        """
+        if compression is not None:
+            # fail at class creation, not at the first save
+            compress('', compression)
+        self._compression = compression
+        self._threshold = threshold
         super(ByteField, self).__init__(loader=self._byte_loader, **kw)
 
     def to_d(self, instance):
-        return b64encode(self._get_value(instance) or '')
+        value = self._get_value(instance) or ''
+        if self._compression and len(value) >= self._threshold:
+            packed = compress(value, self._compression)
+            if len(packed) < len(value):
+                if getattr(get_connection(), 'binary_values', False):
+                    return pack_bytes(packed, self._compression)
+                return '{}:{}'.format(self._compression, b64encode(packed))
+        return b64encode(value)
 
 
 class BooleanField(Field):
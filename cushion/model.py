@@ -1,6 +1,16 @@
 
+from collections import OrderedDict
+from random import random
+from time import sleep
+
 from .field import Field
-from .persist import Persist
+from .persist import Persist, get_write_behind
+from .persist.base import MISSING, copy_doc
+from .persist.cache import current_identity_map
+from .persist.exceptions import (
+    BulkPersistenceError, DocumentConflict, DocumentNotFound,
+    PersistenceError )
+from .query import Query
 from .view import View
 
 
@@ -12,6 +22,25 @@ class DocTypeNotFound(Exception):
     """ Raised when document tries to instantiate without a doc type """
 
 
+def _mutations(old, new, path=()):
+    """
+    sub-document mutations, as (op, path, value), turning old into new.
+    dicts are compared key by key, anything else is replaced whole.
+    """
+    if not (path and isinstance(old, dict) and isinstance(new, dict)):
+        return [] if old == new else [('upsert', path, new)]
+    ops = []
+    for k,v in new.iteritems():
+        if k not in old:
+            ops.append(('upsert', path + (k,), v))
+        elif old[k] != v:
+            ops.extend(_mutations(old[k], v, path + (k,)))
+    for k in old:
+        if k not in new:
+            ops.append(('remove', path + (k,), None))
+    return ops
+
+
 class NewModelClass(type):
     """ Metaclass for inheriting field lists """
 
@@ -27,9 +56,14 @@ class NewModelClass(type):
     def __setattr__(cls, name, value):
         """ Catching new field additions to classes """
         super(NewModelClass, cls).__setattr__(name, value)
-        if isinstance(value, Field):
-            # Update the fields, because they have changed
-            cls._update_fields()
+        if isinstance(value, (Field, View)):
+            # Update the fields, because they have changed, subclasses
+            # inherit the new field too
+            classes = [cls]
+            while classes:
+                c = classes.pop()
+                c._update_fields()
+                classes.extend(c.__subclasses__())
 
 
 class Model(object):
@@ -38,6 +72,19 @@ class Model(object):
 
     __fields = None
     __id = None
+    __cas = None
+    # the doc as last loaded or saved, to find what changed since
+    __persisted = None
+
+    # write durability for this model, eg. {'persist_to': 1} or {} for none.
+    # None uses the connection's default.
+    durability = None
+
+    # queue saves with the active write behind, see set_write_behind
+    write_behind = False
+
+    # only save over the doc when it still has the cas it was loaded with
+    check_cas = False
 
     @property
     def id(self):
@@ -47,13 +94,17 @@ class Model(object):
     def id(self, value):
         self.__id = value
 
+    @property
+    def cas(self):
+        """ cas of the doc as last loaded or saved """
+        return self.__cas
+
     @property
     def type(self):
         return self.__class__.__name__.lower()
 
     def __init__(self, *a, **kw):
         super(Model, self).__init__()
-        self.__class__._update_fields()
         self._data = {}
         self._raw_data = {}
         if 'type' in kw:
@@ -77,12 +128,28 @@ class Model(object):
 
     @classmethod
     def _update_fields(cls):
+        """
+        resolves the fields of the class once, binding each field to its
+        name and keeping an ordered (name, field) table for serializing,
+        and finds the views
+        """
         cls.__fields = {}
+        table = []
+        views = []
         for attr_key in dir(cls):
             attr = getattr(cls, attr_key)
+            if isinstance(attr, View):
+                views.append(attr)
             if not isinstance(attr, Field):
                 continue
             cls.__fields[attr.id] = attr_key
+            attr._field_name = attr_key
+            table.append((attr_key, attr))
+        cls._field_table = tuple(table)
+        cls._field_names = frozenset(name for name, _ in table)
+        # views whose cached results a save or delete makes stale, caches
+        # may be attached to them later
+        cls._views = tuple(views)
 
     @classmethod
     def load(cls, docid):
@@ -90,33 +157,253 @@ class Model(object):
             # shortcircuit load and just return None for matching doc if
             # docid is None
             return None
-        doc = Persist().get(docid)
+        scoped = current_identity_map()
+        if scoped is not None and (cls, docid) in scoped:
+            return scoped[(cls, docid)]
+        return cls._fetch(docid)
+
+    @classmethod
+    def _fetch(cls, docid):
+        doc, cas = Persist().get(docid, with_cas=True)
         if not doc: return None
+        return cls._from_doc(docid, doc, cas)
+
+    @classmethod
+    def load_many(cls, docids):
+        """
+        loads many documents in one round trip.  models are returned in the
+        order of the given ids, ids with no document are skipped.
+        """
+        docids = [d for d in docids if d is not None]
+        if not docids: return []
+        scoped = current_identity_map() or {}
+        wanted = set(d for d in docids if (cls, d) not in scoped)
+        docs = Persist().get_multi(list(wanted), with_cas=True) \
+            if wanted else {}
+        models = {}
+        for docid in docids:
+            if (cls, docid) in scoped:
+                models[docid] = scoped[(cls, docid)]
+            elif docid not in models and docs.get(docid, (None,))[0]:
+                doc, cas = docs[docid]
+                models[docid] = cls._from_doc(docid, doc, cas)
+        return [models[docid] for docid in docids if docid in models]
+
+    @classmethod
+    def _from_doc(cls, docid, doc, cas=None):
+        scoped = current_identity_map()
+        if scoped is not None and (cls, docid) in scoped:
+            return scoped[(cls, docid)]
         # only load fields with non None values
         if '_id' not in doc:
             doc['_id'] = docid
-        return cls(
-            **{k:v for k,v in doc.iteritems() if v is not None} )
+        fields = cls._field_names
+        model = cls(**{k:v for k,v in doc.iteritems()
+            if v is not None and k not in fields})
+        # field values are kept raw and decoded when first read
+        model._raw_data.update((k, v) for k,v in doc.iteritems()
+            if v is not None and k in fields)
+        model.__persisted = copy_doc(doc)
+        model.__cas = cas
+        if scoped is not None:
+            scoped[(cls, docid)] = model
+        return model
 
     @property
     def _fields(self):
         """ Property wrapper for class fields """
         return self.__class__.__fields
 
-    def save(self):
+    def _to_doc(self):
+        raw, decoded = self._raw_data, self._data
+        persisted = self.__persisted or {}
         data = {}
-        for name in self.__fields.values():
-            attr = getattr(self.__class__, name)
-            data[name] = attr.to_d(self)
+        for name, field in self._field_table:
+            if name in raw and name not in decoded:
+                # never read, goes back as it was loaded
+                data[name] = raw[name]
+                continue
+            value = field.to_d(self)
+            if name in persisted and value != persisted[name] \
+                    and field.same(persisted[name], value):
+                # not changed, only spelled otherwise when stored
+                value = persisted[name]
+            data[name] = value
         data['type'] = self.type
-        key, cas = Persist().set(self.__id, data)
-        if not self.__id:
+        return data
+
+    def _changes(self, data):
+        """ mutations since the last load or save, for data from _to_doc """
+        persisted = self.__persisted
+        ops = []
+        for k,v in data.iteritems():
+            if k not in persisted:
+                ops.append(('upsert', (k,), v))
+            else:
+                ops.extend(_mutations(persisted[k], v, (k,)))
+        return ops
+
+    @property
+    def is_dirty(self):
+        """ True when the model has changes that a save would write """
+        if not self.__id or self.__persisted is None:
+            return True
+        return bool(self._changes(self._to_doc()))
+
+    def save(self, durability=None, check_cas=None):
+        """
+        saves the model.  models that came from persistence only send the
+        fields (or dict keys) that changed since, and nothing when clean.
+        durability - overrides the durability of the model for this save
+        check_cas - overrides check_cas of the model for this save, when
+                    set a doc changed since it was loaded is not written
+                    over and DocumentConflict is raised.  such saves are
+                    never deferred, and a model loaded without a cas
+                    can't make them.
+        """
+        if durability is None:
+            durability = self.durability
+        if check_cas is None:
+            check_cas = self.check_cas
+        if check_cas and self.__persisted is not None and self.__cas is None:
+            raise PersistenceError(
+                'no cas to check for {}'.format(self.__id) )
+        cas = self.__cas if check_cas and self.__id else None
+        data = self._to_doc()
+        if self.__id and self.__persisted is not None:
+            changes = self._changes(data)
+            if not changes:
+                return self
+        if self.write_behind and not check_cas \
+                and get_write_behind() is not None:
+            # whole docs are queued so that later saves coalesce.  views
+            # go stale again once the write lands.
+            key, cas = Persist().set(
+                self.__id, data, durability=durability, deferred=True,
+                on_written=self._invalidate_views)
             self.__id = key
-        self.__cas = cas
+            self.__cas = cas
+        elif not (self.__id and self.__persisted is not None
+                and self._update(changes, durability, cas)):
+            key, cas = Persist().set(
+                self.__id, data, durability=durability, cas=cas)
+            if not self.__id:
+                self.__id = key
+                scoped = current_identity_map()
+                if scoped is not None:
+                    scoped[(self.__class__, key)] = self
+            self.__cas = cas
+        self.__persisted = copy_doc(data)
+        self._invalidate_views()
         return self
 
+    def _update(self, changes, durability, cas):
+        """
+        writes the changes in place, returns False when the whole doc has
+        to be written instead: the connection can't apply that many, or
+        the doc is gone and is stored anew.
+        """
+        persist = Persist()
+        if not persist.can_update(changes):
+            return False
+        try:
+            self.__cas = persist.update(self.__id, changes,
+                durability=durability, cas=cas, doctype=self.type)
+        except DocumentNotFound:
+            return False
+        return True
+
+    @classmethod
+    def _invalidate_views(cls):
+        for view in cls._views:
+            if view.cache is not None:
+                view.cache.invalidate(view.design, view.name)
+
+    @staticmethod
+    def save_many(models, durability=None):
+        """
+        saves many models in batches, one per durability asked for.  ids
+        and cas values are assigned to every model that was stored.  if
+        some of them failed, the rest are still saved and a
+        BulkPersistenceError listing the failures is raised.
+        durability - for all of them, defaults to each model's own
+        """
+        models = list(models)
+        if not models: return models
+        batches = OrderedDict()
+        for m in models:
+            level = m.durability if durability is None else durability
+            key = tuple(sorted(level.items())) if level is not None else None
+            batches.setdefault(key, []).append(m)
+        persist = Persist()
+        errors = {}
+        for key, batch in batches.iteritems():
+            docs = [m._to_doc() for m in batch]
+            results, failed = persist.set_multi(
+                [(m.__id, doc) for m, doc in zip(batch, docs)],
+                durability=dict(key) if key is not None else None )
+            errors.update(failed)
+            for m, doc, (docid, cas) in zip(batch, docs, results):
+                if docid in failed: continue
+                if not m.__id:
+                    m.__id = docid
+                m.__cas = cas
+                m.__persisted = copy_doc(doc)
+        for cls in set(m.__class__ for m in models):
+            cls._invalidate_views()
+        if errors:
+            raise BulkPersistenceError(errors)
+        return models
+
+    @classmethod
+    def update(cls, docid, fn, retries=5, backoff=0.01):
+        """
+        loads the doc, applies fn(model) and saves it only if nobody else
+        wrote the doc in between.  on a conflict the doc is reloaded and fn
+        applied again, up to retries times with jittered exponential backoff
+        starting at backoff seconds.  returns the saved model, or None when
+        there is no doc.
+        """
+        writer = get_write_behind()
+        if writer is not None and writer.pending(docid) is not MISSING:
+            # a queued write has no cas to check against yet
+            writer.flush()
+        for attempt in range(retries + 1):
+            model = cls._fetch(docid)
+            if model is None:
+                return None
+            fn(model)
+            try:
+                return model.save(check_cas=True)
+            except DocumentConflict:
+                if attempt == retries:
+                    raise
+                sleep(backoff * (2 ** attempt) * (0.5 + random()))
+
     def delete(self):
-        return Persist().delete(self.__id)
+        self.__persisted = None
+        scoped = current_identity_map()
+        if scoped is not None:
+            scoped.pop((self.__class__, self.__id), None)
+        try:
+            return Persist().delete(self.__id, doctype=self.type)
+        finally:
+            self._invalidate_views()
+
+    @classmethod
+    def where(cls, **conditions):
+        """ a Query over the docs of this model, see Query.where """
+        return Query(cls).where(**conditions)
+
+    @classmethod
+    def create_index(cls, *names):
+        """ indexes fields for queries, see Query """
+        persist = Persist()
+        for name in names:
+            if name not in cls._field_names:
+                raise ValueError('{} is not a field of {}'.format(
+                    name, cls.__name__) )
+            persist.index_create(cls.__name__.lower(), name)
 
     @classmethod
     def viewlist(cls):
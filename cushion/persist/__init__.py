@@ -1,34 +1,134 @@
 
 from json import dumps, loads
 from textwrap import dedent
+from time import time
 from uuid import uuid4
 
-from .base import BaseConnection
-from .exceptions import InvalidConnectionType
+from .base import MISSING, BaseConnection
+from .exceptions import DocumentConflict, InvalidConnectionType
+from .pool import ConnectionPool
 
 
 ActiveConnection = None
+ActiveCache = None
+ActiveWriter = None
+ActiveMetrics = None
 
 
 class Persist(object):
-    """ proxy object for db related calls """
+    """
+    proxy object for db related calls.  while metrics are set Persist()
+    makes InstrumentedPersist proxies, which record the calls.
+    """
+
+    def __new__(cls, *a, **kw):
+        if cls is Persist and ActiveMetrics is not None:
+            cls = InstrumentedPersist
+        return object.__new__(cls)
 
     def __init__(self, *a, **kw):
         if ActiveConnection is None:
             raise InvalidConnectionType()
 
-    def get(self, docid):
-        return ActiveConnection.get(docid)
+    def get(self, docid, with_cas=False):
+        """ with_cas - return (doc, cas) instead of just the doc """
+        if ActiveWriter is not None:
+            # a deferred write not flushed yet is the latest state
+            doc = ActiveWriter.pending(docid)
+            if doc is not MISSING:
+                return (doc, None) if with_cas else doc
+        if ActiveCache is not None:
+            return ActiveCache.get(ActiveConnection, docid, with_cas)
+        return ActiveConnection.get(docid, with_cas=with_cas)
+
+    def get_multi(self, docids, with_cas=False):
+        """ with_cas - map ids to (doc, cas) instead of just the doc """
+        pending = {}
+        if ActiveWriter is not None:
+            for docid in docids:
+                doc = ActiveWriter.pending(docid)
+                if doc is not MISSING:
+                    pending[docid] = (doc, None) if with_cas else doc
+            docids = [d for d in docids if d not in pending]
+        if ActiveCache is not None:
+            docs = ActiveCache.get_multi(ActiveConnection, docids, with_cas)
+        else:
+            docs = ActiveConnection.get_multi(docids, with_cas=with_cas)
+        docs.update(pending)
+        return docs
+
+    def set(self, docid, value, durability=None, deferred=False, cas=None,
+            on_written=None):
+        """
+        deferred - queue the write with the active write behind, when there
+                   is one, instead of writing now.  the cas is then None.
+        cas - only write over the doc if it still has this cas, raises
+              DocumentConflict otherwise
+        on_written - with deferred, called once the queued write landed
+        """
+        if deferred and ActiveWriter is not None:
+            return ActiveWriter.enqueue(
+                docid, value, durability, on_written), None
+        try:
+            key, cas = ActiveConnection.set(
+                docid, value, durability=durability, cas=cas)
+        except DocumentConflict:
+            if ActiveCache is not None:
+                ActiveCache.invalidate(docid)
+            raise
+        if ActiveCache is not None:
+            ActiveCache.store(key, value, cas)
+        return key, cas
+
+    def set_multi(self, items, durability=None):
+        results, errors = ActiveConnection.set_multi(
+            items, durability=durability)
+        if ActiveCache is not None:
+            for (key, cas), (_, value) in zip(results, items):
+                if key not in errors:
+                    ActiveCache.store(key, value, cas)
+        return results, errors
 
-    def set(self, docid, value):
-        return ActiveConnection.set(docid, value)
+    def update(self, docid, mutations, durability=None, cas=None,
+            doctype=None):
+        """ doctype - type of the doc, the target its metrics are kept by """
+        try:
+            cas = ActiveConnection.update(
+                docid, mutations, durability=durability, cas=cas)
+        except DocumentConflict:
+            if ActiveCache is not None:
+                ActiveCache.invalidate(docid)
+            raise
+        if ActiveCache is not None:
+            ActiveCache.apply(docid, mutations, cas)
+        return cas
 
-    def delete(self, docid):
-        return ActiveConnection.delete(docid)
+    def can_update(self, mutations):
+        """ whether update applies these mutations in place """
+        limit = ActiveConnection.max_update_ops
+        return limit is None or len(mutations) <= limit
+
+    def delete(self, docid, doctype=None):
+        """ doctype - type of the doc, the target its metrics are kept by """
+        if ActiveWriter is not None and ActiveWriter.discard(docid) \
+                and ActiveConnection.cas(docid) is None:
+            # only ever queued, never written, so nothing more to delete
+            return None
+        result = ActiveConnection.delete(docid)
+        if ActiveCache is not None:
+            ActiveCache.invalidate(docid)
+        return result
 
     def query(self, *a, **kw):
         return ActiveConnection.query(*a, **kw)
 
+    def find(self, select):
+        """ runs a Select, returns [(docid, doc, cas), ...] """
+        return ActiveConnection.find(select)
+
+    def index_create(self, doctype, field):
+        return ActiveConnection.index_create(doctype, field)
+
     def view_create(self, *a, **kw):
         return ActiveConnection.view_create(*a, **kw)
 
@@ -39,10 +139,119 @@ class Persist(object):
         return ActiveConnection.design_view_create(*a, **kw)
 
 
-def set_connection(conn):
+def _doc_type(*docs):
+    """ the type shared by all the docs, or None """
+    types = set(doc.get('type') if isinstance(doc, dict) else None
+        for doc in docs)
+    return types.pop() if len(types) == 1 else None
+
+
+class InstrumentedPersist(Persist):
+    """ Persist recording its calls in the active Metrics """
+
+    def _call(self, metrics, op, target, fn, *a, **kw):
+        """ returns (result, seconds), errors are recorded and raised """
+        start = time()
+        try:
+            return fn(*a, **kw), time() - start
+        except Exception as e:
+            metrics.record(op, target, time() - start, error=e)
+            raise
+
+    def get(self, docid, with_cas=False):
+        metrics = ActiveMetrics
+        result, seconds = self._call(metrics, 'get', None,
+            super(InstrumentedPersist, self).get, docid, with_cas)
+        doc = result[0] if with_cas else result
+        metrics.record('get', _doc_type(doc), seconds,
+            bytes_in=metrics.size(doc))
+        return result
+
+    def get_multi(self, docids, with_cas=False):
+        metrics = ActiveMetrics
+        docs, seconds = self._call(metrics, 'get_multi', None,
+            super(InstrumentedPersist, self).get_multi, docids, with_cas)
+        values = [v[0] for v in docs.itervalues()] if with_cas \
+            else docs.values()
+        metrics.record('get_multi', _doc_type(*values), seconds,
+            bytes_in=sum(metrics.size(doc) for doc in values))
+        return docs
+
+    def set(self, docid, value, durability=None, deferred=False, cas=None,
+            on_written=None):
+        if deferred and ActiveWriter is not None:
+            # timed when the write behind flushes it
+            return super(InstrumentedPersist, self).set(
+                docid, value, durability, deferred, cas, on_written)
+        metrics, target = ActiveMetrics, _doc_type(value)
+        result, seconds = self._call(metrics, 'set', target,
+            super(InstrumentedPersist, self).set,
+            docid, value, durability, deferred, cas)
+        metrics.record('set', target, seconds,
+            bytes_out=metrics.size(value))
+        return result
+
+    def set_multi(self, items, durability=None):
+        metrics = ActiveMetrics
+        target = _doc_type(*[value for _, value in items])
+        result, seconds = self._call(metrics, 'set_multi', target,
+            super(InstrumentedPersist, self).set_multi, items, durability)
+        metrics.record('set_multi', target, seconds,
+            bytes_out=sum(metrics.size(value) for _, value in items))
+        return result
+
+    def update(self, docid, mutations, durability=None, cas=None,
+            doctype=None):
+        metrics = ActiveMetrics
+        cas, seconds = self._call(metrics, 'update', doctype,
+            super(InstrumentedPersist, self).update,
+            docid, mutations, durability, cas)
+        metrics.record('update', doctype, seconds,
+            bytes_out=sum(metrics.size(value) for _, _, value in mutations))
+        return cas
+
+    def delete(self, docid, doctype=None):
+        metrics = ActiveMetrics
+        result, seconds = self._call(metrics, 'delete', doctype,
+            super(InstrumentedPersist, self).delete, docid)
+        metrics.record('delete', doctype, seconds)
+        return result
+
+    def query(self, design, name, **kw):
+        metrics, target = ActiveMetrics, '{}/{}'.format(design, name)
+        # rows are read right away, lazy results would time nothing
+        rows, seconds = self._call(metrics, 'query', target,
+            lambda: list(super(InstrumentedPersist, self).query(
+                design, name, **kw)) )
+        size = 0
+        if metrics.sizer is not None:
+            for r in rows:
+                size += metrics.size(r.value)
+                doc = getattr(r, 'doc', None)
+                if doc is not None:
+                    size += metrics.size(doc.value)
+        metrics.record('query', target, seconds, bytes_in=size)
+        return rows
+
+    def find(self, select):
+        metrics = ActiveMetrics
+        rows, seconds = self._call(metrics, 'find', select.doctype,
+            super(InstrumentedPersist, self).find, select)
+        metrics.record('find', select.doctype, seconds,
+            bytes_in=sum(metrics.size(doc) for _, doc, _ in rows))
+        return rows
+
+
+def set_connection(conn, pool_size=10, **pool_kw):
+    """
+    conn is a connection, or a factory of connections to pool.  pools take
+    pool_size and the other options of ConnectionPool as keywords.
+    """
     global ActiveConnection
     if not isinstance(conn, BaseConnection):
-        raise InvalidConnectionType()
+        if not callable(conn):
+            raise InvalidConnectionType()
+        conn = ConnectionPool(conn, size=pool_size, **pool_kw)
     ActiveConnection = conn
 
 
@@ -51,3 +260,43 @@ def get_connection():
     return ActiveConnection
 
 
+def set_cache(cache):
+    """ puts a DocumentCache in front of the connection, None removes it """
+    global ActiveCache
+    ActiveCache = cache
+
+
+def get_cache():
+    global ActiveCache
+    return ActiveCache
+
+
+def set_write_behind(writer):
+    """
+    installs a WriteBehind for deferred saves, None removes it.  the one it
+    replaces is closed, flushing what it still had pending.
+    """
+    global ActiveWriter
+    previous, ActiveWriter = ActiveWriter, writer
+    if previous is not None and previous is not writer:
+        previous.close()
+
+
+def get_write_behind():
+    global ActiveWriter
+    return ActiveWriter
+
+
+def set_metrics(metrics):
+    """
+    starts recording Persist calls in a Metrics, None stops it.  Persist()
+    only hands out instrumented proxies meanwhile, so calls cost nothing
+    more while metrics are off.
+    """
+    global ActiveMetrics
+    ActiveMetrics = metrics
+
+
+def get_metrics():
+    global ActiveMetrics
+    return ActiveMetrics
@@ -1,5 +1,172 @@
+from collections import OrderedDict, namedtuple
+from time import time
+
+# marks a value that isn't there, where None could be a real value
+MISSING = object()
 
 
 class BaseConnection(object):
     """ the base connection type.. python needs interfaces """
-    pass
+
+    # docs can hold raw bytes values, eg. compressed ByteFields.  stores of
+    # plain json can't, they get base64 text instead.
+    binary_values = False
+    # most mutations update applies in place, None for no limit.  past it,
+    # or at 0, models save their whole doc instead.
+    max_update_ops = None
+
+
+def apply_mutations(doc, mutations):
+    """
+    applies sub-document mutations, as (op, path, value) with op 'upsert' or
+    'remove' and path a tuple of keys, to doc in place
+    """
+    for op, path, value in mutations:
+        parent = doc
+        for k in path[:-1]:
+            parent = parent.setdefault(k, {})
+        if op == 'remove':
+            parent.pop(path[-1], None)
+        else:
+            parent[path[-1]] = value
+    return doc
+
+
+def copy_doc(value):
+    """
+    copy of a doc, eg. for change tracking.  docs are plain json, so only
+    dicts and lists need copying, which is much cheaper than a deepcopy.
+    """
+    if isinstance(value, dict):
+        return {k: copy_doc(v) for k,v in value.iteritems()}
+    if isinstance(value, list):
+        return [copy_doc(v) for v in value]
+    return value
+
+
+DURABILITY_KEYS = ('persist_to', 'replicate_to')
+
+
+def durability_kw(durability, default):
+    """
+    driver keywords for a durability, a dict like {'persist_to': 1,
+    'replicate_to': 1}.  {} asks for none, None falls back to default.
+    """
+    if durability is None:
+        durability = default
+    unknown = set(durability) - set(DURABILITY_KEYS)
+    if unknown:
+        raise ValueError(
+            'unknown durability setting(s): {}'.format(', '.join(unknown)) )
+    return dict(durability)
+
+
+# comparisons of a Select, see Query.where
+OPERATORS = ('eq', 'ne', 'lt', 'lte', 'gt', 'gte', 'in')
+
+
+class Select(namedtuple('Select', 'doctype where order_by limit offset')):
+    """
+    a query for the docs of one type, as connections run it.
+    where - ((field, op, value), ...) conditions that must all hold, op is
+            one of OPERATORS and the value of 'in' a list
+    order_by - ((field, descending), ...)
+    limit, offset - None for no limit, no offset
+    """
+    __slots__ = ()
+
+    @property
+    def shape(self):
+        """ the query less its values, which compiles to one statement """
+        return (self.doctype, tuple((f, op) for f, op, _ in self.where),
+            self.order_by, self.limit is not None, self.offset is not None)
+
+    @property
+    def params(self):
+        """ the values of the query, in the order of the statement """
+        params = [value for _, _, value in self.where]
+        if self.limit is not None:
+            params.append(self.limit)
+        if self.offset is not None:
+            params.append(self.offset)
+        return params
+
+
+class QueryProfile(object):
+    """
+    where the time of one view query went, phase by phase, with its row
+    counts.  see View.__call__(profile=True).
+    """
+
+    def __init__(self, view):
+        self.view = view
+        # phase => seconds, in the order the phases ran
+        self.phases = OrderedDict()
+        # wall clock of the whole call, phases included
+        self.elapsed = None
+        self.rows_mapped = 0
+        self.rows_scanned = 0
+        self.rows_returned = 0
+        self.docs_fetched = 0
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    @property
+    def other(self):
+        """ seconds of the call not in any phase """
+        if self.elapsed is None:
+            return 0.0
+        return max(0.0, self.elapsed - sum(self.phases.itervalues()))
+
+    def as_dict(self):
+        return {
+            'view': self.view,
+            'elapsed': self.elapsed,
+            'phases': dict(self.phases, other=self.other),
+            'rows_mapped': self.rows_mapped,
+            'rows_scanned': self.rows_scanned,
+            'rows_returned': self.rows_returned,
+            'docs_fetched': self.docs_fetched }
+
+    def __str__(self):
+        lines = ['{} {:.3f}ms'.format(self.view, (self.elapsed or 0) * 1e3)]
+        for name, seconds in self.phases.items() + [('other', self.other)]:
+            lines.append('  {:<10} {:>9.3f}ms'.format(name, seconds * 1e3))
+        lines.append(
+            '  rows mapped {}, scanned {}, returned {}, docs fetched {}'
+            .format(self.rows_mapped, self.rows_scanned, self.rows_returned,
+                    self.docs_fetched) )
+        return '\n'.join(lines)
+
+
+class _Phase(object):
+    """ adds the time spent inside it to a phase of a QueryProfile """
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time()
+
+    def __exit__(self, *exc):
+        phases = self.profile.phases
+        phases[self.name] = phases.get(self.name, 0.0) + time() - self.start
+
+
+class _NoPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def profile_phase(profile, name):
+    """ times a phase into profile, a no-op when profile is None """
+    return _NO_PHASE if profile is None else profile.phase(name)
@@ -0,0 +1,294 @@
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from copy import deepcopy
+from json import dumps
+from threading import Lock, local
+from time import time
+
+from .base import apply_mutations, copy_doc
+
+
+class DocumentCache(object):
+    """
+    bounded lru cache of documents in front of a connection.  install it
+    with set_cache(...), then Persist reads through it and writes through
+    it.  callers always get their own copy of a cached doc.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None, revalidate=False):
+        """
+        maxsize - most docs kept, least recently used ones are evicted
+        ttl - optional seconds a doc stays cached
+        revalidate - check the cas of a cached doc with the connection on
+                     every hit, refetching it when it changed
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.revalidate = revalidate
+        # docid => (doc, cas, expires)
+        self._docs = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def stats(self):
+        return {
+            'size': len(self._docs),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions }
+
+    def _lookup(self, docid):
+        """ returns the cached (doc, cas) or None, counting hits and misses """
+        with self._lock:
+            entry = self._docs.pop(docid, None)
+            if entry is not None and entry[2] is not None \
+                    and entry[2] < time():
+                # expired, drop it
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # most recently used goes last
+            self._docs[docid] = entry
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def store(self, docid, doc, cas=None):
+        if doc is None:
+            return self.invalidate(docid)
+        expires = time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._docs.pop(docid, None)
+            self._docs[docid] = (deepcopy(doc), cas, expires)
+            while len(self._docs) > self.maxsize:
+                self._docs.popitem(last=False)
+                self.evictions += 1
+
+    def apply(self, docid, mutations, cas):
+        """ applies sub-document mutations to a cached doc, if there is one """
+        with self._lock:
+            entry = self._docs.get(docid)
+            if entry is not None:
+                doc, _, expires = entry
+                self._docs[docid] = (
+                    apply_mutations(doc, deepcopy(mutations)), cas, expires)
+
+    def invalidate(self, docid):
+        with self._lock:
+            self._docs.pop(docid, None)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+
+    def get(self, conn, docid, with_cas=False):
+        """ reads a doc through the cache, fetching it from conn on a miss """
+        cached = self._lookup(docid)
+        if cached is not None and self.revalidate \
+                and conn.cas(docid) != cached[1]:
+            cached = None
+        if cached is None:
+            doc, cas = conn.get(docid, with_cas=True)
+            self.store(docid, doc, cas)
+        else:
+            doc, cas = deepcopy(cached[0]), cached[1]
+        return (doc, cas) if with_cas else doc
+
+    def get_multi(self, conn, docids, with_cas=False):
+        found, missing = {}, []
+        for docid in docids:
+            cached = self._lookup(docid)
+            if cached is not None and self.revalidate \
+                    and conn.cas(docid) != cached[1]:
+                cached = None
+            if cached is None:
+                missing.append(docid)
+            else:
+                found[docid] = (deepcopy(cached[0]), cached[1])
+        if missing:
+            fetched = conn.get_multi(missing, with_cas=True)
+            for docid, (doc, cas) in fetched.iteritems():
+                self.store(docid, doc, cas)
+            found.update(fetched)
+        if with_cas:
+            return found
+        return {k:doc for k,(doc, _) in found.iteritems()}
+
+
+# view query params taking a boolean, which may come in as strings
+BOOLEAN_PARAMS = ('include_docs', 'descending', 'reduce', 'group',
+    'inclusive_end')
+
+STALE_POLICIES = (False, 'ok', 'update_after')
+
+
+class CachedDoc(object):
+    def __init__(self, key, value, cas=None):
+        self.key = key
+        self.value = value
+        self.cas = cas
+
+
+class CachedRow(object):
+    """ a view row served from a ViewCache, like the connection's rows """
+
+    def __init__(self, key, docid, value, doc=None):
+        self.key = key
+        self.docid = docid
+        self.value = value
+        self.doc = doc
+
+
+class ViewCache(object):
+    """
+    bounded lru cache of view query results, opt-in per view with
+    View(..., cache=ViewCache()).  results are keyed by the view and its
+    query params, and go stale when a model the view is on (see
+    Model.viewlist) is saved or deleted, and deferred saves again once
+    they are written.  writes made around the models, eg. straight through
+    Persist, go unnoticed.  callers always get their own copy of cached
+    rows.
+    """
+
+    def __init__(self, maxsize=100, ttl=None, stale=False):
+        """
+        maxsize - most results kept, least recently used ones are evicted
+        ttl - optional seconds a result stays cached, whatever the policy
+        stale - what a write does to the cached results of a view: False
+                drops them, 'ok' keeps serving them until they expire and
+                'update_after' serves them once more, querying again the
+                time after.  'ok' needs a ttl.
+        """
+        if stale not in STALE_POLICIES:
+            raise ValueError('unknown stale policy: {}'.format(stale))
+        if stale == 'ok' and ttl is None:
+            raise ValueError("stale='ok' needs a ttl, results would never "
+                "be refreshed")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale = stale
+        # (view key, params) => (rows, generation, expires)
+        self._results = OrderedDict()
+        # view key => writes seen, results of older generations are stale
+        self._generations = defaultdict(int)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def stats(self):
+        return {
+            'size': len(self._results),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'evictions': self.evictions }
+
+    @staticmethod
+    def _params(kw):
+        """ query params as a key, the same however they were spelled """
+        params = {}
+        for k, v in kw.iteritems():
+            if k == 'profile':
+                continue
+            if k in BOOLEAN_PARAMS:
+                v = bool(v) and v != 'false'
+            params[k] = v
+        return dumps(params, sort_keys=True)
+
+    def _lookup(self, key):
+        """ returns the cached rows or None, counting hits and misses """
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is not None and entry[2] is not None \
+                    and entry[2] < time():
+                entry = None
+            if entry is not None and \
+                    entry[1] != self._generations[key[0]]:
+                if self.stale == 'ok':
+                    self.stale_hits += 1
+                elif self.stale == 'update_after':
+                    # served this once, not kept
+                    self.stale_hits += 1
+                    return entry[0]
+                else:
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._results[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def _store(self, key, rows, generation):
+        expires = time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (rows, generation, expires)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+                self.evictions += 1
+
+    def query(self, design, name, kw, run):
+        """
+        the rows of a view query, from the cache or else run() and cached
+        run - runs the query on the connection
+        """
+        key = ((design, name), self._params(kw))
+        rows = self._lookup(key)
+        if rows is None:
+            # a write while the query runs leaves its result stale
+            generation = self._generations[key[0]]
+            rows = [(r.key, r.docid, copy_doc(r.value),
+                None if getattr(r, 'doc', None) is None else
+                (r.doc.key, copy_doc(r.doc.value),
+                 getattr(r.doc, 'cas', None))) for r in run()]
+            self._store(key, rows, generation)
+        return [CachedRow(k, docid, copy_doc(value),
+            None if doc is None else
+            CachedDoc(doc[0], copy_doc(doc[1]), doc[2]))
+            for k, docid, value, doc in rows]
+
+    def invalidate(self, design, name):
+        """ the results of a view go stale, see stale """
+        with self._lock:
+            self._generations[(design, name)] += 1
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+_scopes = local()
+
+
+@contextmanager
+def identity_map():
+    """
+    scopes an identity map, eg. to a request: inside it, loading the same
+    model twice gives back the same instance.  scopes nest and are per
+    thread.
+    """
+    stack = _scopes.__dict__.setdefault('stack', [])
+    stack.append({})
+    try:
+        yield stack[-1]
+    finally:
+        stack.pop()
+
+
+def current_identity_map():
+    """ the innermost identity map of this thread, or None """
+    stack = getattr(_scopes, 'stack', None)
+    return stack[-1] if stack else None
@@ -1,49 +1,271 @@
 
-from json import dumps, loads
+import re
+from json import dumps
 from textwrap import dedent
 from uuid import uuid4
 
+from couchbase import FMT_BYTES, FMT_JSON
 from couchbase.bucket import Bucket
+from couchbase.exceptions import CouchbaseError, KeyExistsError, \
+    NotFoundError
+from couchbase.transcoder import Transcoder
 from couchbase.views.iterator import View
+try:
+    import couchbase.subdocument as SD
+except ImportError:
+    # drivers before 2.1 have no sub-document api
+    SD = None
+try:
+    from couchbase.n1ql import N1QLQuery
+except ImportError:
+    # nor do the early 2.0 ones have n1ql, find needs it
+    N1QLQuery = None
 
-from .base import BaseConnection
-from .exceptions import PersistenceError
+from .base import BaseConnection, apply_mutations, durability_kw, \
+    profile_phase
+from .codec import MAGIC, DocumentCodec
+from .exceptions import DocumentConflict, DocumentNotFound, \
+    PersistenceError
+from .n1ql import compile_statement, escape, index_name
+
+
+# the server refuses multi mutations with more specs than this
+MAX_SUBDOC_OPS = 16
+
+_plain_path_key = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _subdoc_path(path):
+    """ joins a tuple of keys into a sub-document path, escaping as needed """
+    return '.'.join(
+        k if _plain_path_key.match(k) else '`{}`'.format(k.replace('`', '``'))
+        for k in path )
+
+
+class CodecTranscoder(Transcoder):
+    """
+    stores json docs through a DocumentCodec.  docs it can't keep as plain
+    json are flagged as bytes, other formats are left to the driver.
+    """
+
+    def __init__(self, codec):
+        super(CodecTranscoder, self).__init__()
+        self.codec = codec
+
+    def encode_value(self, value, format):
+        if format != FMT_JSON:
+            return super(CodecTranscoder, self).encode_value(value, format)
+        payload, is_json = self.codec.encode(value)
+        return payload, FMT_JSON if is_json else FMT_BYTES
+
+    def decode_value(self, value, flags):
+        if flags == FMT_JSON or bytes(value[:len(MAGIC)]) == MAGIC:
+            return self.codec.decode(bytes(value))
+        return super(CodecTranscoder, self).decode_value(value, flags)
 
 
 class CouchbaseConnection(BaseConnection):
     """ connects to a couchbase server """
 
-    def __init__(self, bucket, host=None, password=None):
+    def __init__(self, bucket, host=None, password=None, durability=None,
+            codec=None):
+        """
+        durability - default for writes, eg. {'persist_to': 1,
+                     'replicate_to': 1}, {} for none.  waits for a disk
+                     flush on the master by default.
+        codec - a DocumentCodec for docs, eg. DocumentCodec('ujson') or
+                DocumentCodec('msgpack', compression='lz4').  the driver's
+                json is used by default.  views only index plain json docs.
+        """
         connstr = 'couchbase://{h}/{b}'.format(
             h=(host or 'localhost'),
             b=bucket )
-        self._cb = Bucket(connstr, password=password)
+        kw = {}
+        if codec is not None:
+            if not isinstance(codec, DocumentCodec):
+                codec = DocumentCodec(codec)
+            kw['transcoder'] = CodecTranscoder(codec)
+        self._cb = Bucket(connstr, password=password, **kw)
+        self.binary_values = codec is not None and codec.binary
+        # without the sub-document api every update reads and replaces
+        self.max_update_ops = MAX_SUBDOC_OPS if SD is not None else 0
+        self.bucket = bucket
+        self.durability = durability_kw(durability, {'persist_to': 1})
+        # n1ql of each Select.shape run so far.  values are parameters, so
+        # there are only as many as there are queries in the code.
+        self._statements = {}
 
-    def get(self, key):
+    def get(self, key, with_cas=False):
         result = self._cb.get(key, quiet=True)
+        if with_cas:
+            if result.success: return result.value, result.cas
+            return None, None
         if result.success: return result.value
 
-    def set(self, key, value):
+    def get_multi(self, keys, with_cas=False):
+        results = self._cb.get_multi(keys, quiet=True)
+        if with_cas:
+            return {k:(r.value, r.cas)
+                for k,r in results.iteritems() if r.success}
+        return {k:r.value for k,r in results.iteritems() if r.success}
+
+    def cas(self, key):
+        """ the current cas of a doc from the master, without fetching it """
+        result = self._cb.observe(key, master_only=True)
+        for info in result.value:
+            if info.from_master:
+                return info.cas
+
+    def set(self, key, value, durability=None, cas=None):
+        """ with a cas, only replaces a doc that still has that cas """
         if key is None:
             key = uuid4().hex
-        encoded_val = dumps(value)
-        result = self._cb.upsert(key, value, persist_to=1)
+        durability = durability_kw(durability, self.durability)
+        if cas is not None:
+            try:
+                result = self._cb.replace(key, value, cas=cas, **durability)
+            except (KeyExistsError, NotFoundError):
+                raise DocumentConflict(key)
+        else:
+            result = self._cb.upsert(key, value, **durability)
         if result.success:
             return result.key, result.cas
         raise PersistenceError()
 
+    def set_multi(self, items, durability=None):
+        """
+        items => list of (key, value) pairs, keys of None get generated
+        returns ([(key, cas), ...], {key: error}) with results in input order
+        and a cas of None for every key that failed
+        """
+        items = [(key or uuid4().hex, value) for key,value in items]
+        try:
+            results = self._cb.upsert_multi(
+                dict(items), **durability_kw(durability, self.durability))
+        except CouchbaseError as e:
+            # some keys failed, the rest were still stored
+            results = e.all_results
+        ret, errors = [], {}
+        for key,_ in items:
+            result = results[key]
+            if result.success:
+                ret.append((key, result.cas))
+            else:
+                ret.append((key, None))
+                errors[key] = PersistenceError(
+                    'upsert failed for {}: rc={}'.format(key, result.rc) )
+        return ret, errors
+
+    def update(self, key, mutations, durability=None, cas=None):
+        """
+        applies (op, path, value) mutations to an existing doc through the
+        sub-document api, returns the new cas.  with a cas, only updates a
+        doc that still has that cas.  raises DocumentNotFound without one.
+        past max_update_ops the doc is read, mutated and replaced instead.
+        """
+        durability = durability_kw(durability, self.durability)
+        if SD is None or len(mutations) > MAX_SUBDOC_OPS:
+            return self._update_whole(key, mutations, durability, cas)
+        specs = []
+        for op, path, value in mutations:
+            if op == 'remove':
+                specs.append(SD.remove(_subdoc_path(path)))
+            else:
+                specs.append(SD.upsert(
+                    _subdoc_path(path), value, create_parents=True))
+        if cas is not None:
+            durability['cas'] = cas
+        try:
+            result = self._cb.mutate_in(key, *specs, **durability)
+        except KeyExistsError:
+            raise DocumentConflict(key)
+        except NotFoundError:
+            raise DocumentNotFound('no document to update: {}'.format(key))
+        except CouchbaseError as e:
+            raise PersistenceError(
+                'update failed for {}: {}'.format(key, e) )
+        return result.cas
+
+    def _update_whole(self, key, mutations, durability, cas=None, retries=5):
+        """ read, mutate and replace the whole doc, guarded by cas """
+        for _ in range(retries):
+            result = self._cb.get(key, quiet=True)
+            if not result.success:
+                raise DocumentNotFound(
+                    'no document to update: {}'.format(key) )
+            if cas is not None and result.cas != cas:
+                raise DocumentConflict(key)
+            doc = apply_mutations(result.value, mutations)
+            try:
+                result = self._cb.replace(
+                    key, doc, cas=result.cas, **durability)
+            except KeyExistsError:
+                if cas is not None:
+                    raise DocumentConflict(key)
+                # changed under us, go again
+                continue
+            return result.cas
+        raise PersistenceError('update kept conflicting for {}'.format(key))
+
     def delete(self, key):
         return self._cb.remove(key, quiet=True)
 
-    def query(self, design, name, **kw):
-        return self._cb.query(design, name, **kw)
+    def query(self, design, name, profile=None, **kw):
+        """
+        profile - a QueryProfile to fill in.  the server's map, scan and doc
+                  fetches can't be told apart here, they are all 'request'.
+        """
+        if profile is None:
+            return self._cb.query(design, name, **kw)
+        with profile_phase(profile, 'request'):
+            # the driver pages lazily, read it all while timing
+            rows = list(self._cb.query(design, name, **kw))
+        profile.rows_returned = len(rows)
+        if kw.get('include_docs'):
+            profile.docs_fetched = len(rows)
+        return rows
+
+    def find(self, select):
+        """
+        runs a Select as n1ql, returns [(docid, doc, cas), ...].  statements
+        are compiled once per shape and run prepared: the driver has the
+        server plan each one once and reuses that plan from then on.
+        """
+        if N1QLQuery is None:
+            raise PersistenceError(
+                'queries without a view need n1ql, which this couchbase '
+                'driver lacks' )
+        statement = self._statements.get(select.shape)
+        if statement is None:
+            statement = self._statements[select.shape] = \
+                compile_statement(select, self.bucket)
+        query = N1QLQuery(statement, *select.params)
+        query.adhoc = False
+        return [(r['id'], r['doc'], r['cas'])
+            for r in self._cb.n1ql_query(query)]
+
+    def index_create(self, doctype, field):
+        """ a secondary index on field over the docs of doctype, for find """
+        manager = self._cb.bucket_manager()
+        if not hasattr(manager, 'n1ql_index_create'):
+            raise PersistenceError(
+                'index_create needs a couchbase driver that manages n1ql '
+                'indexes (2.1 or later)' )
+        manager.n1ql_index_create(
+            index_name(doctype, field),
+            fields=[escape(field)],
+            condition='`type` = {}'.format(dumps(doctype)),
+            ignore_exists=True )
 
     def design_view_create(self, design, views, syncwait=5):
         """
         design => name of design document
         views => dict { 'viewname': {'map':...} }
         """
-        views_d = {'views': views }
+        # only ship what the server understands, eg. no python maps
+        views_d = {'views': {
+            name:{k:v for k,v in d.iteritems() if k in ('map', 'reduce')}
+            for name,d in views.iteritems() } }
         return self._cb.design_create(
             design,
             views_d,
@@ -0,0 +1,227 @@
+import zlib
+from abc import ABCMeta, abstractmethod
+from json import dumps, loads
+
+# faster or smaller codecs are used when they are installed
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+# starts every payload that isn't plain json, followed by a codec tag and a
+# compression tag.  json never starts with a nul byte, so docs written
+# before or without it still decode as they are.
+MAGIC = '\x00cu'
+
+NO_COMPRESSION = '-'
+
+
+class Codec(object):
+    """ turns documents into bytes and back """
+
+    __metaclass__ = ABCMeta
+
+    # name to pick it by, and a single byte tag marking its payloads
+    name = None
+    tag = None
+    # plain json payloads can be indexed by views and read by other clients
+    json = True
+    # docs can hold raw bytes values, eg. compressed ByteFields
+    binary = False
+
+    @abstractmethod
+    def encode(self, doc):
+        pass
+
+    @abstractmethod
+    def decode(self, data):
+        pass
+
+
+class JsonCodec(Codec):
+    name = 'json'
+    tag = 'j'
+
+    def encode(self, doc):
+        return dumps(doc, separators=(',', ':'))
+
+    def decode(self, data):
+        return loads(data)
+
+
+class UJsonCodec(Codec):
+    name = 'ujson'
+    tag = 'u'
+
+    def encode(self, doc):
+        return ujson.dumps(doc, escape_forward_slashes=False)
+
+    def decode(self, data):
+        return ujson.loads(data)
+
+
+class OrJsonCodec(Codec):
+    name = 'orjson'
+    tag = 'o'
+
+    def encode(self, doc):
+        return orjson.dumps(doc)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """ smaller and faster than json, but views can't index its docs """
+    name = 'msgpack'
+    tag = 'm'
+    json = False
+    binary = True
+
+    def encode(self, doc):
+        return msgpack.packb(doc, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+_installed = {
+    'json': True,
+    'ujson': ujson is not None,
+    'orjson': orjson is not None,
+    'msgpack': msgpack is not None }
+_codecs = [JsonCodec, UJsonCodec, OrJsonCodec, MsgpackCodec]
+
+# name => (tag, compress, decompress)
+COMPRESSORS = {'zlib': ('z', zlib.compress, zlib.decompress)}
+if lz4 is not None:
+    COMPRESSORS['lz4'] = ('4', lz4.compress, lz4.decompress)
+
+
+def available_codecs():
+    """ names of the codecs that can be used here """
+    return [c.name for c in _codecs if _installed[c.name]]
+
+
+def get_codec(name=None):
+    """ a codec by name, or the fastest json codec installed for None """
+    if name is None:
+        name = 'orjson' if orjson else 'ujson' if ujson else 'json'
+    for c in _codecs:
+        if c.name == name:
+            if not _installed[name]:
+                raise ValueError('codec {} is not installed'.format(name))
+            return c()
+    raise ValueError('unknown codec: {}'.format(name))
+
+
+def compress(data, method):
+    if method not in COMPRESSORS:
+        raise ValueError('compression {} is not available'.format(method))
+    return COMPRESSORS[method][1](data)
+
+
+def decompress(data, method):
+    if method not in COMPRESSORS:
+        raise ValueError('compression {} is not available'.format(method))
+    return COMPRESSORS[method][2](data)
+
+
+def pack_bytes(data, method):
+    """
+    compressed data as a raw bytes value for docs, marked like payloads.
+    it's a bytearray so that json codecs refuse it rather than mangle it.
+    """
+    return bytearray(MAGIC + COMPRESSORS[method][0] + data)
+
+
+def is_packed(value):
+    return isinstance(value, (bytes, bytearray)) and \
+        value[:len(MAGIC)] == MAGIC
+
+
+def unpack_bytes(value):
+    """ the data of a pack_bytes value, decompressed """
+    value = bytes(value)
+    ctag, data = value[len(MAGIC)], value[len(MAGIC) + 1:]
+    for tag, _, decompress_ in COMPRESSORS.itervalues():
+        if tag == ctag:
+            return decompress_(data)
+    raise ValueError('unknown compression marker: {!r}'.format(ctag))
+
+
+class DocumentCodec(object):
+    """
+    encodes whole documents for a connection, optionally compressing the
+    large ones.  payloads are marked with how they were written, so docs
+    written with other settings, or before there was a codec, still decode.
+    """
+
+    def __init__(self, codec=None, compression=None, threshold=1024):
+        """
+        codec - a Codec or codec name, the fastest json codec by default
+        compression - 'zlib' or 'lz4' to compress encoded docs, None not to.
+                      compressed docs are opaque to views.
+        threshold - size in bytes from which docs are compressed
+        """
+        if codec is None or isinstance(codec, basestring):
+            codec = get_codec(codec)
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError(
+                'compression {} is not available'.format(compression) )
+        self.codec = codec
+        self.compression = compression
+        self.threshold = threshold
+        self._json = codec if codec.json else get_codec()
+        self._by_tag = {c.tag: c() for c in _codecs if _installed[c.name]}
+        self._by_tag[codec.tag] = codec
+        self._compressors = {
+            tag: decompress_ for tag, _, decompress_
+            in COMPRESSORS.itervalues() }
+
+    @property
+    def binary(self):
+        """ whether docs can hold raw bytes values, only binary codecs can """
+        return self.codec.binary
+
+    def encode(self, doc):
+        """ returns (payload, is_json), plain json payloads are unmarked """
+        codec = self.codec
+        data = codec.encode(doc)
+        ctag = NO_COMPRESSION
+        if self.compression and len(data) >= self.threshold:
+            tag, compress_, _ = COMPRESSORS[self.compression]
+            packed = compress_(data)
+            # not worth it when it doesn't shrink
+            if len(packed) < len(data):
+                data, ctag = packed, tag
+        if ctag == NO_COMPRESSION and codec.json:
+            return data, True
+        return MAGIC + codec.tag + ctag + data, False
+
+    def decode(self, payload):
+        if not payload.startswith(MAGIC):
+            return self._json.decode(payload)
+        n = len(MAGIC)
+        tag, ctag, data = payload[n], payload[n + 1], payload[n + 2:]
+        if ctag != NO_COMPRESSION:
+            if ctag not in self._compressors:
+                raise ValueError(
+                    'unknown compression marker: {!r}'.format(ctag) )
+            data = self._compressors[ctag](data)
+        if tag not in self._by_tag:
+            raise ValueError('unknown codec marker: {!r}'.format(tag))
+        return self._by_tag[tag].decode(data)
@@ -13,3 +13,25 @@ class PersistenceError(Exception):
     pass
 
 
+class DocumentConflict(PersistenceError):
+    """ Document changed since it was read, its cas no longer matches """
+    pass
+
+
+class DocumentNotFound(PersistenceError):
+    """ Document to update doesn't exist """
+    pass
+
+
+class BulkPersistenceError(PersistenceError):
+    """ Error encountered for some documents of a batch persistence call """
+
+    def __init__(self, errors):
+        super(BulkPersistenceError, self).__init__(
+            'failed to persist {} document(s)'.format(len(errors)) )
+        self.errors = errors
+
+
+class PoolTimeout(PersistenceError):
+    """ No pooled connection became free within the checkout timeout """
+    pass
@@ -1,29 +1,299 @@
 
-import operator
+import marshal
+import os
+import sys
+from types import CodeType, FunctionType
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from hashlib import sha1
+from itertools import count, islice
+from multiprocessing import Pool
 from uuid import uuid4
 
 import execjs
 
-from .base import BaseConnection
+from .base import MISSING, BaseConnection, apply_mutations, \
+    durability_kw, profile_phase
+from .codec import get_codec
+from .exceptions import DocumentConflict, DocumentNotFound, \
+    PersistenceError
+from .snapshot import (
+    WriteLog, load_rows, read_snapshot, replay_log, write_snapshot )
 
 
 mapwrap = '''
-function map_wrapper(doc, meta, outq) {
+function map_batch(batch) {
+    var outq = []
+    var meta
     function emit(key, val) {
-        emit.outq.push([key, val, meta.id])
+        outq.push([key, val, meta.id])
     }
-    emit.outq = outq
     var mapf = %MAPF%
-    mapf(doc, meta)
-    return emit.outq
+    for (var i = 0; i < batch.length; i++) {
+        meta = batch[i][1]
+        mapf(batch[i][0], meta)
+    }
+    return outq
+}
+'''
+
+redwrap = '''
+function reduce_wrapper(keys, values, rereduce) {
+    function sum(values) {
+        var total = 0
+        for (var i = 0; i < values.length; i++) {
+            total += values[i]
+        }
+        return total
+    }
+    var redf = %REDF%
+    return redf(keys, values, rereduce)
+}
+
+function reduce_batch(calls) {
+    var out = []
+    for (var i = 0; i < calls.length; i++) {
+        out.push(reduce_wrapper(calls[i][0], calls[i][1], calls[i][2]))
+    }
+    return out
 }
 '''
 
+# compiled map contexts by source hash, shared by connections and re-syncs
+_compiled = {}
+
+
+def compile_map(mapf):
+    """ returns (source hash, compiled js context) for a map function """
+    src = mapwrap.replace('%MAPF%', mapf.strip())
+    digest = sha1(src.encode('utf-8')).hexdigest()
+    if digest not in _compiled:
+        _compiled[digest] = execjs.compile(src)
+    return digest, _compiled[digest]
+
+
+class PyReducer(object):
+    """ a builtin reduce, see compile_reduce """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, keys, values, rereduce):
+        return self.fn(keys, values, rereduce)
+
+    def many(self, calls):
+        """ reduces each (keys, values, rereduce) of calls """
+        return [self.fn(*call) for call in calls]
+
+
+class JsReducer(PyReducer):
+    """ a js reduce, every batch of calls is a single runtime call """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    def __call__(self, keys, values, rereduce):
+        return self.ctx.call('reduce_wrapper', keys, values, rereduce)
+
+    def many(self, calls):
+        if not calls:
+            return []
+        return self.ctx.call('reduce_batch', calls)
+
+
+def compile_reduce(redf):
+    """
+    returns a reducer, called as reducer(keys, values, rereduce) or
+    reducer.many([(keys, values, rereduce), ...]), for a builtin reduce
+    name or js reduce source
+    """
+    redf = redf.strip()
+    if redf in builtin_reducers:
+        return PyReducer(builtin_reducers[redf])
+    src = redwrap.replace('%REDF%', redf)
+    digest = sha1(src.encode('utf-8')).hexdigest()
+    if digest not in _compiled:
+        _compiled[digest] = execjs.compile(src)
+    return JsReducer(_compiled[digest])
+
+
+def _count(keys, values, rereduce):
+    return sum(values) if rereduce else len(values)
+
+
+def _sum(keys, values, rereduce):
+    return sum(values)
+
+
+def _stats(keys, values, rereduce):
+    if not rereduce:
+        return {
+            'sum': sum(values),
+            'count': len(values),
+            'min': min(values),
+            'max': max(values),
+            'sumsqr': sum(v * v for v in values) }
+    return {
+        'sum': sum(v['sum'] for v in values),
+        'count': sum(v['count'] for v in values),
+        'min': min(v['min'] for v in values),
+        'max': max(v['max'] for v in values),
+        'sumsqr': sum(v['sumsqr'] for v in values) }
+
+
+builtin_reducers = {'_count': _count, '_sum': _sum, '_stats': _stats}
+
+
+def _code_names(code):
+    """ the names code and the functions nested in it refer to """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def _fingerprint(value, seen):
+    """
+    what a map depends on, as marshallable values: functions are their
+    code, defaults, closure cells and the helper functions they call.
+    other globals are left out, maps may well keep state in them.  raises
+    ValueError for anything marshal can't take.
+    """
+    if isinstance(value, FunctionType):
+        if value in seen:
+            return ('function', value.__name__)
+        seen.add(value)
+        cells = tuple(_fingerprint(c.cell_contents, seen)
+            for c in value.__closure__ or ())
+        defaults = tuple(_fingerprint(d, seen)
+            for d in value.__defaults__ or ())
+        helpers = tuple((name, _fingerprint(value.__globals__[name], seen))
+            for name in sorted(_code_names(value.__code__))
+            if isinstance(value.__globals__.get(name), FunctionType))
+        return (marshal.dumps(value.__code__), cells, defaults, helpers)
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(v, seen) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((_fingerprint(k, seen), _fingerprint(v, seen))
+            for k,v in value.iteritems()))
+    # raises ValueError itself for what it can't take
+    marshal.dumps(value)
+    return value
+
+
+def pymap_digest(pymapf):
+    """
+    identifies a python map, to know its saved index, or None when what it
+    depends on can't be told apart, and then its index is never saved
+    """
+    try:
+        return sha1(marshal.dumps(_fingerprint(pymapf, set()))).hexdigest()
+    except ValueError:
+        return None
+
+
+# what map workers work on: (connection, views, keys).  it is set before
+# the workers are forked, so they inherit it rather than have every doc
+# pickled over to them.
+_shard_state = None
+
+
+def _map_shard(bounds):
+    """ maps docs keys[lo:hi] through every view, sorted rows per view """
+    conn, views, keys = _shard_state
+    lo, hi = bounds
+    items = [(k, conn.data[k]) for k in keys[lo:hi]]
+    shard = []
+    for view in views:
+        rows = []
+        for docid, kvs in conn._map_many(view, items).iteritems():
+            rows.extend(MemIndex._rows(docid, kvs))
+        rows.sort()
+        shard.append(rows)
+    return shard
+
+
+def _truthy(v):
+    """ query params may come in as strings """
+    return bool(v) and v != 'false'
+
+
+INF = float('inf')
+
+# rows per block of an index whose reduction is cached, blocks split at
+# twice this
+REDUCE_BLOCK = 128
+# a block whose reduction is not cached
+UNREDUCED = object()
+
+# group_level for group=true, rows only reduce together on equal keys
+GROUP_EXACT = 'exact'
+
+
+def _group_key(key, group_level):
+    """ the key a row reduces under, None groups everything together """
+    if group_level is None:
+        return None
+    if group_level == GROUP_EXACT or not isinstance(key, list):
+        return key
+    return key[:group_level]
+
+
+def _collate(value):
+    """
+    sort key of a json value in n1ql order: missing, null, false, true,
+    numbers, strings, arrays, objects
+    """
+    if value is MISSING:
+        return (0,)
+    if value is None:
+        return (1,)
+    if isinstance(value, bool):
+        return (2, value)
+    if isinstance(value, (int, long, float)):
+        return (3, value)
+    if isinstance(value, basestring):
+        return (4, value)
+    if isinstance(value, list):
+        return (5, tuple(_collate(v) for v in value))
+    return (6, tuple(sorted((k, _collate(v)) for k,v in value.iteritems())))
+
+
+def _holds(value, op, operand):
+    """
+    whether a doc value meets a condition, operand being the collated value
+    (a set of them for 'in').  missing and null values meet none.
+    """
+    if value is MISSING or value is None:
+        return False
+    key = _collate(value)
+    if op == 'eq':
+        return key == operand
+    if op == 'ne':
+        return key != operand
+    if op == 'lt':
+        return key < operand
+    if op == 'lte':
+        return key <= operand
+    if op == 'gt':
+        return key > operand
+    if op == 'gte':
+        return key >= operand
+    return key in operand
+
+
+def _operand(op, value):
+    if op == 'in':
+        return set(_collate(v) for v in value)
+    return _collate(value)
+
 
 class MemDoc(object):
-    def __init__(self, docid, value):
+    def __init__(self, docid, value, cas=None):
         self.key = docid
         self.value = value
+        self.cas = cas
 
 
 class MemResult(object):
@@ -44,74 +314,668 @@ class MemResultSet(object):
             yield r
 
 
+class MemIndex(object):
+    """
+    sorted rows of one view, kept current as documents change.  rows look
+    like (key, docid, n, value) where n orders the emits of a single doc.
+
+    for reduces the rows are split in blocks, each starting at a (key,
+    docid, n) bound, whose reductions are cached.  a write only drops the
+    cached reduction of the block it falls in, and queries rereduce the
+    cached blocks with what they don't cover whole.
+    """
+
+    def __init__(self, emitted=None):
+        # emitted => {docid: [(key, value), ...]}
+        self._bydoc = {}
+        rows = []
+        for docid, kvs in (emitted or {}).iteritems():
+            drows = self._rows(docid, kvs)
+            if drows:
+                self._bydoc[docid] = drows
+                rows.extend(drows)
+        rows.sort()
+        self.rows = rows
+        # row keys, parallel to rows, for bisecting on key alone
+        self.keys = [r[0] for r in rows]
+        # block bounds, made on the first reduce, and their reductions
+        self._blocks = None
+        self._partials = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ an index of rows that are sorted already, eg. from a snapshot """
+        index = cls()
+        index.rows = rows
+        index.keys = [r[0] for r in rows]
+        index._bydoc = None
+        return index
+
+    @property
+    def bydoc(self):
+        """ docid => its rows, worked out when first needed """
+        if self._bydoc is None:
+            bydoc = {}
+            for r in self.rows:
+                bydoc.setdefault(r[1], []).append(r)
+            self._bydoc = bydoc
+        return self._bydoc
+
+    @staticmethod
+    def _rows(docid, kvs):
+        return [(k, docid, n, v) for n,(k,v) in enumerate(kvs)]
+
+    def add(self, docid, kvs):
+        drows = self._rows(docid, kvs)
+        for r in drows:
+            pos = bisect_left(self.rows, r)
+            self.rows.insert(pos, r)
+            self.keys.insert(pos, r[0])
+            self._touch_block(r, split=True)
+        if drows:
+            self.bydoc[docid] = drows
+
+    def remove(self, docid):
+        drows = self.bydoc.pop(docid, ())
+        for r in drows:
+            pos = bisect_left(self.rows, r)
+            del self.rows[pos]
+            del self.keys[pos]
+            self._touch_block(r)
+
+    def forget_reductions(self):
+        """ drops the cached reductions, eg. for another reduce """
+        if self._blocks is not None:
+            self._partials = [UNREDUCED] * len(self._blocks)
+
+    def _block_span(self, i):
+        """ the (start, end) rows of block i """
+        blocks = self._blocks
+        start = bisect_left(self.rows, blocks[i]) if i else 0
+        end = bisect_left(self.rows, blocks[i + 1]) \
+            if i + 1 < len(blocks) else len(self.rows)
+        return start, end
+
+    def _touch_block(self, row, split=False):
+        """ drops the reduction of the block of row, splitting it if big """
+        if self._blocks is None:
+            return
+        i = bisect_right(self._blocks, row[:3]) - 1
+        self._partials[i] = UNREDUCED
+        if split:
+            start, end = self._block_span(i)
+            if end - start > 2 * REDUCE_BLOCK:
+                self._blocks.insert(i + 1,
+                    self.rows[start + REDUCE_BLOCK][:3])
+                self._partials.insert(i + 1, UNREDUCED)
+
+    def bounds(self, descending=False, **kw):
+        """ returns the (lo, hi) slice of rows matching key/startkey/endkey """
+        lo, hi = 0, len(self.rows)
+        if 'key' in kw:
+            lo = bisect_left(self.keys, kw['key'])
+            hi = bisect_right(self.keys, kw['key'])
+        # descending queries walk from startkey down to endkey
+        low, high = ('endkey', 'startkey') if descending else \
+            ('startkey', 'endkey')
+        if low in kw:
+            if low + '_docid' in kw:
+                lo = max(lo, bisect_left(
+                    self.rows, (kw[low], kw[low + '_docid'])) )
+            else:
+                lo = max(lo, bisect_left(self.keys, kw[low]))
+        if high in kw:
+            if high + '_docid' in kw:
+                # past every emit of that doc under that key
+                hi = min(hi, bisect_right(
+                    self.rows, (kw[high], kw[high + '_docid'], INF)) )
+            else:
+                hi = min(hi, bisect_right(self.keys, kw[high]))
+        return lo, max(lo, hi)
+
+    def scan(self, descending=False, skip=0, limit=None, **kw):
+        """ returns the matching rows in query order """
+        lo, hi = self.bounds(descending=descending, **kw)
+        if descending:
+            hi = max(lo, hi - skip)
+            if limit is not None:
+                lo = max(lo, hi - limit)
+            return self.rows[lo:hi][::-1]
+        lo = min(hi, lo + skip)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return self.rows[lo:hi]
+
+
+    def _groups(self, lo, hi, group_level):
+        """ the (group key, start, end) row spans of lo:hi """
+        groups = []
+        keys = self.keys
+        start = lo
+        while start < hi:
+            gkey = _group_key(keys[start], group_level)
+            if group_level is None:
+                end = hi
+            elif group_level == GROUP_EXACT:
+                end = min(hi, bisect_right(keys, keys[start], start))
+            else:
+                end = start + 1
+                while end < hi and _group_key(keys[end], group_level) == gkey:
+                    end += 1
+            groups.append((gkey, start, end))
+            start = end
+        return groups
+
+    def _parts(self, start, end):
+        """
+        what rows start:end reduce from: ('block', i, start, end) for the
+        blocks they cover whole, ('rows', None, start, end) for the rest
+        """
+        blocks = self._blocks
+        i = bisect_right(blocks, self.rows[start][:3]) - 1
+        parts = []
+        pos = start
+        while pos < end:
+            bstart, bend = self._block_span(i)
+            i += 1
+            if bend <= pos:
+                continue
+            if bstart == pos and bend <= end:
+                parts.append(('block', i - 1, bstart, bend))
+            else:
+                parts.append(('rows', None, pos, min(bend, end)))
+            pos = min(bend, end)
+        return parts
+
+    def reduce(self, reducer, group_level=None, descending=False, skip=0,
+            limit=None, **kw):
+        """
+        returns [(group key, value), ...] in query order for the matching
+        rows.  blocks reduced once are cached until a write into them, the
+        rest is reduced in one batch of reducer calls and the pieces of a
+        group rereduced together in another.
+        """
+        if self._blocks is None:
+            self._blocks = [()] + [r[:3]
+                for r in self.rows[REDUCE_BLOCK::REDUCE_BLOCK]]
+            self.forget_reductions()
+        lo, hi = self.bounds(descending=descending, **kw)
+        groups = self._groups(lo, hi, group_level)
+        if descending:
+            groups = groups[::-1]
+        end = None if limit is None else skip + limit
+        groups = groups[skip:end]
+        partials = self._partials
+        plans = [self._parts(start, end) for _, start, end in groups]
+        # first the pieces not reduced yet, blocks once however often used
+        todo = []
+        for parts in plans:
+            for part in parts:
+                if part[0] == 'rows' or partials[part[1]] is UNREDUCED:
+                    todo.append(part)
+        calls, seen = [], set()
+        for kind, i, start, end in todo:
+            if kind == 'block':
+                if i in seen:
+                    continue
+                seen.add(i)
+            rows = self.rows[start:end]
+            calls.append(([[r[0], r[1]] for r in rows],
+                [r[3] for r in rows], False))
+        reduced = iter(reducer.many(calls))
+        values = {}
+        for kind, i, start, end in todo:
+            if kind == 'block':
+                if partials[i] is UNREDUCED:
+                    partials[i] = next(reduced)
+            else:
+                values[(start, end)] = next(reduced)
+        pieces = [[partials[i] if kind == 'block' else values[(start, end)]
+            for kind, i, start, end in parts] for parts in plans]
+        # then the groups of more than one piece
+        rereduced = iter(reducer.many(
+            [(None, p, True) for p in pieces if len(p) > 1]))
+        return [(gkey, p[0] if len(p) == 1 else next(rereduced))
+            for (gkey, _, _), p in zip(groups, pieces)]
+
+
+class FieldIndex(object):
+    """
+    the docs of one type sorted by the value of a field, for find.  docs
+    without the field, or with it null, meet no condition and are left out.
+    """
+
+    def __init__(self, doctype, field, items=()):
+        # items => (docid, doc) pairs to start with
+        self.doctype = doctype
+        self.field = field
+        # docid => collated value
+        self.bydoc = {}
+        for docid, doc in items:
+            key = self._key(doc)
+            if key is not None:
+                self.bydoc[docid] = key
+        # (collated value, docid), sorted, and the values alone to bisect
+        self.entries = sorted(
+            (k, docid) for docid, k in self.bydoc.iteritems())
+        self.keys = [e[0] for e in self.entries]
+
+    def _key(self, doc):
+        if doc is None or doc.get('type') != self.doctype:
+            return None
+        value = doc.get(self.field)
+        return None if value is None else _collate(value)
+
+    def add(self, docid, doc):
+        key = self._key(doc)
+        if key is None:
+            return
+        pos = bisect_left(self.entries, (key, docid))
+        self.entries.insert(pos, (key, docid))
+        self.keys.insert(pos, key)
+        self.bydoc[docid] = key
+
+    def remove(self, docid):
+        key = self.bydoc.pop(docid, None)
+        if key is None:
+            return
+        pos = bisect_left(self.entries, (key, docid))
+        del self.entries[pos]
+        del self.keys[pos]
+
+    def docids(self, op, operand):
+        """
+        ids of the docs meeting a condition on the field, None for
+        conditions the index can't narrow down ('ne')
+        """
+        keys = self.keys
+        if op == 'in':
+            return [docid for key in sorted(operand)
+                for docid in self.docids('eq', key)]
+        if op == 'eq':
+            lo, hi = bisect_left(keys, operand), bisect_right(keys, operand)
+        elif op == 'gt':
+            lo, hi = bisect_right(keys, operand), len(keys)
+        elif op == 'gte':
+            lo, hi = bisect_left(keys, operand), len(keys)
+        elif op == 'lt':
+            lo, hi = 0, bisect_left(keys, operand)
+        elif op == 'lte':
+            lo, hi = 0, bisect_right(keys, operand)
+        else:
+            return None
+        return [e[1] for e in self.entries[lo:hi]]
+
+
 class MemConnection(BaseConnection):
 
-    def __init__(self):
+    def __init__(self, map_batch_size=500, durability=None, path=None,
+            map_workers=1, parallel_threshold=10000):
+        """
+        map_batch_size => docs sent to the js runtime per call when building
+                          an index
+        map_workers => processes building indexes, eg. cpu_count().  docs
+                       are split in shards mapped by a pool of forked
+                       workers, whose rows are merged into the index.
+        parallel_threshold => fewest docs for which a pool is worth it,
+                              smaller builds stay in this process
+        durability => default for writes, only recorded in .durabilities
+        path => snapshot file to keep docs and view indexes in, see dump().
+                one that exists is opened, its docs decoded as they are
+                read.  writes are logged to path + '.log' until the next
+                dump.
+        """
         self.designs = {}
+        # (doc type, field) => FieldIndex
+        self.field_indexes = {}
         self.data = {}
+        # per key cas, bumped on every write
+        self.cas_values = {}
+        self._cas_counter = count(1)
+        self.map_batch_size = map_batch_size
+        self.map_workers = map_workers
+        self.parallel_threshold = parallel_threshold
+        self.durability = durability_kw(durability, {})
+        # per key durability of the last write, for tests to assert on
+        self.durabilities = {}
+        self.path = path
+        self._log = None
+        self._codec = get_codec()
+        # indexes from the snapshot not picked up by a view yet, view key
+        # => (map digest, marshalled rows)
+        self._saved_views = {}
+        # keys written since the snapshot, stale in its indexes
+        self._since_snapshot = set()
+        if path is not None:
+            self._open(path)
+
+    def _open(self, path):
+        if os.path.exists(path):
+            self.data, self._saved_views = read_snapshot(path, self._codec)
+        log_path = path + '.log'
+        self._since_snapshot = replay_log(log_path, self.data, self._codec)
+        self._log = WriteLog(log_path, self._codec)
+
+    def dump(self, path=None):
+        """
+        writes every doc and the built view indexes to a snapshot, by
+        default the connection's own path whose write log is then emptied.
+        opening a snapshot only maps it, and views created with the same
+        map pick their index up from it instead of rebuilding it.
+        """
+        path = path or self.path
+        views = {}
+        for view_key, view in self.designs.iteritems():
+            if view['index'] is not None and view['digest'] is not None:
+                # bring it up to date first
+                views[view_key] = (
+                    view['digest'], self._index(view).rows)
+        saved = {}
+        if not self._since_snapshot:
+            # still current, carried over for views not created yet
+            saved = {k: v for k,v in self._saved_views.iteritems()
+                if k not in views}
+        rows = {k: (digest, load_rows(blob))
+            for k,(digest, blob) in saved.iteritems()}
+        rows.update(views)
+        write_snapshot(path, self.data, rows, self._codec)
+        if path == self.path and self._log is not None:
+            self._log.truncate()
+            self._since_snapshot = set()
+            self._saved_views = saved
+
+    def close(self):
+        """ closes the write log and the mapped snapshot """
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if hasattr(self.data, 'close'):
+            self.data.close()
+
+    def _cas(self, key):
+        cas = self.cas_values.get(key)
+        if cas is None and key in self.data:
+            # loaded from a snapshot, never written here
+            cas = self.cas_values[key] = next(self._cas_counter)
+        return cas
 
-    def get(self, key):
-        return self.data.get(key, None)
+    def get(self, key, with_cas=False):
+        doc = self.data.get(key, None)
+        if with_cas:
+            return doc, self._cas(key)
+        return doc
 
-    def set(self, key, value):
+    def get_multi(self, keys, with_cas=False):
+        if with_cas:
+            return {k:(self.data[k], self._cas(k))
+                for k in keys if k in self.data}
+        return {k:self.data[k] for k in keys if k in self.data}
+
+    def cas(self, key):
+        return self._cas(key)
+
+    def _touch(self, key, durability):
+        self.durabilities[key] = durability_kw(durability, self.durability)
+        cas = self.cas_values[key] = next(self._cas_counter)
+        self._reindex(key)
+        return cas
+
+    def _check_cas(self, key, cas):
+        if cas is not None and self._cas(key) != cas:
+            raise DocumentConflict(key)
+
+    def set(self, key, value, durability=None, cas=None):
         if key is None:
             key = uuid4().hex
+        self._check_cas(key, cas)
         self.data[key] = value
-        return key, uuid4().hex # fake cas
+        if self._log is not None:
+            self._log.set(key, value)
+        return key, self._touch(key, durability)
+
+    def set_multi(self, items, durability=None):
+        return [self.set(k, v, durability) for k,v in items], {}
+
+    def update(self, key, mutations, durability=None, cas=None):
+        if key not in self.data:
+            raise DocumentNotFound('no document to update: {}'.format(key))
+        self._check_cas(key, cas)
+        apply_mutations(self.data[key], mutations)
+        if self._log is not None:
+            self._log.update(key, mutations)
+        return self._touch(key, durability)
 
     def delete(self, key):
         del self.data[key]
+        if self._log is not None:
+            self._log.delete(key)
+        self.cas_values.pop(key, None)
+        self.durabilities.pop(key, None)
+        self._reindex(key)
+
+    def _map_many(self, view, items):
+        """
+        runs the view map over (docid, doc) pairs, returns
+        {docid: [(key, value), ...]} for every doc that emitted something
+        """
+        emitted = defaultdict(list)
+        pymapf = view['pymapf']
+        if pymapf:
+            for docid, doc in items:
+                meta = {'id': docid}
+                emitted[docid].extend(pymapf(doc, meta))
+            return emitted
+        items = iter(items)
+        while True:
+            batch = [[d, {'id': k}] for k,d in
+                islice(items, self.map_batch_size)]
+            if not batch:
+                break
+            for k,v,docid in view['mapf'].call('map_batch', batch):
+                emitted[docid].append((k, v))
+        return emitted
 
-    def query(self, design, name, **kw):
-        # **note** NO REDUCE YET
+    def build_indexes(self, profile=None):
+        """
+        builds the index of every view that has none yet, eg. to warm up
+        before queries.  they are otherwise built when first queried.
+        """
+        views = [v for v in self.designs.itervalues() if v['index'] is None]
+        if views:
+            self._build(views, profile)
+
+    def _parallel(self):
+        # workers inherit the docs by forking, which windows can't do
+        return self.map_workers > 1 and sys.platform != 'win32' \
+            and len(self.data) >= self.parallel_threshold
+
+    def _build(self, views, profile=None):
+        """ builds the indexes of views over all docs """
+        if not self._parallel():
+            for view in views:
+                with profile_phase(profile, 'map'):
+                    emitted = self._map_many(view, self.data.iteritems())
+                with profile_phase(profile, 'index'):
+                    view['index'] = MemIndex(emitted)
+                view['pending'] = set()
+        else:
+            with profile_phase(profile, 'map'):
+                shards = self._map_sharded(views)
+            with profile_phase(profile, 'index'):
+                for n, view in enumerate(views):
+                    rows = []
+                    for shard in shards:
+                        rows.extend(shard[n])
+                    # sorted runs, which the sort merges in linear time
+                    rows.sort()
+                    view['index'] = MemIndex.from_rows(rows)
+                    view['pending'] = set()
+        if profile is not None:
+            profile.rows_mapped = len(self.data)
+
+    def _map_sharded(self, views):
+        """ maps all docs with a pool of workers, see _map_shard """
+        global _shard_state
+        keys = list(self.data)
+        # a few shards per worker, so that uneven ones even out
+        size = -(-len(keys) // (self.map_workers * 4))
+        _shard_state = (self, views, keys)
+        pool = Pool(self.map_workers)
+        try:
+            return pool.map(_map_shard,
+                [(lo, lo + size) for lo in range(0, len(keys), size)])
+        finally:
+            pool.terminate()
+            pool.join()
+            _shard_state = None
+
+    def _index(self, view, profile=None):
+        """
+        the view index, built over all docs the first time it's used.  docs
+        written since the last query get re-mapped here in one batch.
+        """
+        if view['index'] is None:
+            self._build([view], profile)
+        elif view['pending']:
+            index, pending = view['index'], view['pending']
+            view['pending'] = set()
+            items = [(k, self.data[k]) for k in pending if k in self.data]
+            with profile_phase(profile, 'map'):
+                emitted = self._map_many(view, items)
+            with profile_phase(profile, 'index'):
+                for key in pending:
+                    index.remove(key)
+                    index.add(key, emitted.get(key, []))
+            if profile is not None:
+                profile.rows_mapped = len(items)
+        return view['index']
+
+    def _reindex(self, key):
+        """ flags the changed doc for re-mapping in every built index """
+        if self.path is not None:
+            self._since_snapshot.add(key)
+        if self.field_indexes:
+            doc = self.data.get(key)
+            for index in self.field_indexes.itervalues():
+                index.remove(key)
+                index.add(key, doc)
+        for view in self.designs.itervalues():
+            if view['index'] is not None:
+                view['pending'].add(key)
+
+    def query(self, design, name, profile=None, **kw):
+        """ profile - a QueryProfile to fill in, with every phase """
         view_key = '/'.join((design, name))
         if view_key not in self.designs:
             raise Exception('view not found')
         view = self.designs[view_key]
-        mapf_ctx = view.get('mapf')
-        redf_ctx = view.get('redf')
-        include_docs = False
-        if 'include_docs' in kw:
-            if kw['include_docs'] and kw['include_docs'] is not 'false':
-                include_docs = True
-        descending = bool(kw.get('descending', False))
-        if descending:
-            cmpop = operator.ge
-        else:
-            cmpop = operator.le
-        outq = []
-        # each entry looks like  [key, val, _id]
-        for k,d in self.data.iteritems():
-            meta = {'id': k}
-            outq = mapf_ctx.call('map_wrapper', d, meta, outq)
-        if 'key' in kw:
-            outq = filter(lambda x: cmp(x[0], kw['key'])==0, outq)
-        if 'startkey' in kw:
-            outq = filter(lambda x: cmpop(cmp(kw['startkey'], x[0]),0), outq)
-        if 'endkey' in kw:
-            outq = filter(lambda x: cmpop(cmp(x[0], kw['endkey']),0), outq)
-        outq.sort(key=operator.itemgetter(0), reverse=descending)
-        results = []
-        for k in outq:
-            r_ = MemResult(key=k[0], docid=k[2], value=k[1])
+        include_docs = _truthy(kw.get('include_docs', False))
+        descending = _truthy(kw.get('descending', False))
+        scan_kw = {k:kw[k] for k in ('key', 'startkey', 'endkey',
+            'startkey_docid', 'endkey_docid', 'skip', 'limit') if k in kw}
+        index = self._index(view, profile)
+        if profile is not None:
+            lo, hi = index.bounds(descending=descending, **scan_kw)
+            profile.rows_scanned = hi - lo
+        if view['redf'] and _truthy(kw.get('reduce', True)):
+            group_level = None
+            if _truthy(kw.get('group', False)):
+                group_level = GROUP_EXACT
+            elif kw.get('group_level'):
+                group_level = int(kw['group_level'])
+            with profile_phase(profile, 'reduce'):
+                rows = index.reduce(view['redf'], group_level=group_level,
+                    descending=descending, **scan_kw)
+                results = [MemResult(key=k, docid=None, value=v)
+                    for k,v in rows]
+            if profile is not None:
+                profile.rows_returned = len(results)
+            return MemResultSet(results)
+        with profile_phase(profile, 'scan'):
+            rows = index.scan(descending=descending, **scan_kw)
+            results = [MemResult(key=key, docid=docid, value=value)
+                for key, docid, _, value in rows]
+        if include_docs:
+            with profile_phase(profile, 'fetch'):
+                for r_ in results:
+                    r_.doc = MemDoc(r_.docid, self.data[r_.docid],
+                        self._cas(r_.docid))
+        if profile is not None:
+            profile.rows_returned = len(results)
             if include_docs:
-                r_.doc = MemDoc(k[2], self.data[k[2]])
-            results.append(r_)
-        if 'skip' in kw:
-            results = results[kw['skip']:]
-        if 'limit' in kw:
-            results = results[:kw['limit']]
+                profile.docs_fetched = len(results)
         return MemResultSet(results, include_docs)
 
+    def find(self, select):
+        """
+        evaluates a Select over the docs, returns [(docid, doc, cas), ...].
+        the field index narrowing the conditions down to the fewest docs
+        picks the docs to check, without one every doc is checked.
+        """
+        conds = [(field, op, _operand(op, value))
+            for field, op, value in select.where]
+        docids = None
+        for field, op, operand in conds:
+            index = self.field_indexes.get((select.doctype, field))
+            found = index.docids(op, operand) if index else None
+            if found is not None and (docids is None or
+                    len(found) < len(docids)):
+                docids = found
+        data = self.data
+        if docids is None:
+            items = data.iteritems()
+        else:
+            items = ((docid, data[docid]) for docid in docids)
+        rows = sorted((docid, doc) for docid, doc in items
+            if doc.get('type') == select.doctype and
+            all(_holds(doc.get(field, MISSING), op, operand)
+                for field, op, operand in conds) )
+        # stable sorts, the last one by the first field
+        for field, desc in reversed(select.order_by):
+            rows.sort(key=lambda r: _collate(r[1].get(field, MISSING)),
+                reverse=desc)
+        start = select.offset or 0
+        end = None if select.limit is None else start + select.limit
+        return [(docid, doc, self._cas(docid))
+            for docid, doc in rows[start:end]]
+
+    def index_create(self, doctype, field):
+        """ indexes field over the docs of doctype, for find """
+        if (doctype, field) not in self.field_indexes:
+            self.field_indexes[(doctype, field)] = FieldIndex(
+                doctype, field, self.data.iteritems())
+
     def design_view_create(self, design, views, syncwait=5):
         for v,d in views.iteritems():
-            mapf = execjs.compile(mapwrap.replace('%MAPF%', d['map'].strip()))
-            view = dict(mapf=mapf)
-            self.designs["/".join((design, v))] = view
+            pymapf = d.get('pymap')
+            if pymapf:
+                source, mapf = pymapf, None
+                digest = pymap_digest(pymapf)
+            else:
+                source, mapf = compile_map(d['map'])
+                digest = source
+            redf = compile_reduce(d['reduce']) if d.get('reduce') else None
+            view = dict(mapf=mapf, pymapf=pymapf, redf=redf, source=source,
+                digest=digest, index=None, pending=set())
+            view_key = "/".join((design, v))
+            old = self.designs.get(view_key)
+            saved = self._saved_views.pop(view_key, None)
+            if old and old['source'] == source:
+                # same map as before, the index is still good
+                view['index'] = old['index']
+                view['pending'] = old['pending']
+                if view['index'] is not None:
+                    # the reduce may have changed
+                    view['index'].forget_reductions()
+            elif saved and digest is not None and saved[0] == digest:
+                # from the snapshot, re-mapping what changed since
+                view['index'] = MemIndex.from_rows(load_rows(saved[1]))
+                view['pending'] = set(self._since_snapshot)
+            self.designs[view_key] = view
 
     def view_create(self, design, name, mapf, redf=None, syncwait=5):
-        doc = { 'views': { name : { 'map': mapf, 'reduce': redf } } }
-        self.design_view_create(design, doc)
+        views = { name : { 'map': mapf, 'reduce': redf } }
+        self.design_view_create(design, views)
 
     def view_destroy(self, design):
         prefix = design + "/"
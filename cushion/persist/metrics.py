@@ -0,0 +1,212 @@
+import logging
+import socket
+from bisect import bisect_left
+from collections import deque
+from json import dumps
+from threading import Lock
+from time import time
+
+
+log = logging.getLogger(__name__)
+
+
+# upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0)
+
+
+def json_size(doc):
+    """ bytes of doc as json, a sizer for Metrics """
+    return len(dumps(doc, separators=(',', ':'))) if doc is not None else 0
+
+
+class OpStats(object):
+    """ count, errors, bytes and a latency histogram of one kind of call """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one more slot for what falls past the last bucket
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def observe(self, seconds, bytes_in, bytes_out, error):
+        self.bucket_counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        if error is not None:
+            self.errors += 1
+
+    def percentile(self, p):
+        """
+        upper bound of the bucket holding the p-th percentile (0-100), inf
+        when it is past the last bucket and None without observations
+        """
+        if not self.count:
+            return None
+        rank, seen = p / 100.0 * self.count, 0
+        for bound, n in zip(self.buckets + (float('inf'),),
+                self.bucket_counts):
+            seen += n
+            if seen >= rank:
+                return bound
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'seconds': self.seconds,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99) }
+
+
+class Metrics(object):
+    """
+    collects the calls made through Persist: counts, errors, bytes and
+    latency histograms per operation, and per operation and target.  the
+    target of a query is its 'design/view', of doc reads and writes the doc
+    type when there is one.  install it with set_metrics(...).
+    """
+
+    def __init__(self, slow_threshold=None, slow_log_size=100,
+            buckets=DEFAULT_BUCKETS, sizer=None):
+        """
+        slow_threshold - seconds from which calls are logged as slow
+        slow_log_size - most slow calls kept in slow_log
+        buckets - upper bounds of the latency histograms, in seconds
+        sizer - callable(doc) giving its size in bytes, eg. json_size.
+                bytes are not counted without one, sizing is not free.
+        """
+        self.slow_threshold = slow_threshold
+        self.slow_log = deque(maxlen=slow_log_size)
+        self.buckets = tuple(buckets)
+        self.sizer = sizer
+        self.listeners = []
+        # op => OpStats, (op, target) => OpStats
+        self.ops = {}
+        self.targets = {}
+        self._lock = Lock()
+
+    def add_listener(self, listener):
+        """
+        listener - callable(op, target, seconds, error) called after every
+                   call, error is None when it succeeded
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def size(self, doc):
+        return self.sizer(doc) if self.sizer is not None else 0
+
+    def record(self, op, target, seconds, bytes_in=0, bytes_out=0,
+            error=None):
+        with self._lock:
+            for stats, key in ((self.ops, op), (self.targets, (op, target))):
+                if key not in stats:
+                    stats[key] = OpStats(self.buckets)
+                stats[key].observe(seconds, bytes_in, bytes_out, error)
+            slow = self.slow_threshold is not None \
+                and seconds >= self.slow_threshold
+            if slow:
+                self.slow_log.append((time(), op, target, seconds))
+        if slow:
+            log.warning('slow %s of %s took %.3fs', op, target, seconds)
+        for listener in self.listeners:
+            try:
+                listener(op, target, seconds, error)
+            except Exception:
+                log.exception('metrics listener failed')
+
+    def stats(self):
+        """ {op: stats} and {(op, target): stats} as plain dicts """
+        with self._lock:
+            return (
+                {k: v.stats() for k,v in self.ops.iteritems()},
+                {k: v.stats() for k,v in self.targets.iteritems()} )
+
+    def reset(self):
+        with self._lock:
+            self.ops.clear()
+            self.targets.clear()
+            self.slow_log.clear()
+
+
+def _label(value):
+    return unicode(value or '').replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(metrics, prefix='cushion'):
+    """
+    the metrics in the prometheus text exposition format, each metric
+    family as its TYPE line followed by all of its samples
+    """
+    with metrics._lock:
+        targets = [(u'op="{}",target="{}"'.format(_label(op), _label(target)),
+            s) for (op, target), s in sorted(metrics.targets.iteritems())]
+    lines = ['# TYPE {}_op_seconds histogram'.format(prefix)]
+    for labels, s in targets:
+        seen = 0
+        for bound, n in zip(s.buckets, s.bucket_counts):
+            seen += n
+            lines.append(u'{}_op_seconds_bucket{{{},le="{}"}} {}'.format(
+                prefix, labels, repr(bound), seen))
+        lines.append(u'{}_op_seconds_bucket{{{},le="+Inf"}} {}'.format(
+            prefix, labels, s.count))
+        lines.append(u'{}_op_seconds_sum{{{}}} {}'.format(
+            prefix, labels, repr(s.seconds)))
+        lines.append(u'{}_op_seconds_count{{{}}} {}'.format(
+            prefix, labels, s.count))
+    lines.append('# TYPE {}_op_errors_total counter'.format(prefix))
+    for labels, s in targets:
+        lines.append(u'{}_op_errors_total{{{}}} {}'.format(
+            prefix, labels, s.errors))
+    lines.append('# TYPE {}_op_bytes_total counter'.format(prefix))
+    for labels, s in targets:
+        for direction, n in (('in', s.bytes_in), ('out', s.bytes_out)):
+            lines.append(u'{}_op_bytes_total{{{},direction="{}"}} {}'.format(
+                prefix, labels, direction, n))
+    return u'\n'.join(lines) + u'\n'
+
+
+class StatsdExporter(object):
+    """
+    a metrics listener sending timings and error counts to a statsd daemon
+    over udp, eg. metrics.add_listener(StatsdExporter()).  sends are fire
+    and forget, a daemon that is down costs nothing but the packets.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='cushion'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, op, target):
+        parts = [self.prefix, op]
+        if target:
+            parts.append(
+                ''.join(c if c.isalnum() else '_' for c in target))
+        return '.'.join(parts)
+
+    def __call__(self, op, target, seconds, error):
+        name = self._name(op, target)
+        lines = ['{}:{:.3f}|ms'.format(name, seconds * 1000)]
+        if error is not None:
+            lines.append('{}.errors:1|c'.format(name))
+        try:
+            self._sock.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+    def close(self):
+        self._sock.close()
@@ -0,0 +1,50 @@
+from itertools import count
+from json import dumps
+
+
+# Select operators as n1ql
+N1QL_OPERATORS = {
+    'eq': '=',
+    'ne': '!=',
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>=',
+    'in': 'IN' }
+
+
+def escape(name):
+    """ a keyspace or field name as a n1ql identifier """
+    return '`{}`'.format(name.replace('`', '``'))
+
+
+def compile_statement(select, keyspace):
+    """
+    compiles a Select to n1ql with a positional parameter per value, in the
+    order of select.params.  the doc type is inlined rather than a
+    parameter so that indexes partial on it can be used, which leaves one
+    statement per select.shape.
+    """
+    params = ('${}'.format(n) for n in count(1))
+    conds = ['d.`type` = {}'.format(dumps(select.doctype))]
+    for field, op, _ in select.where:
+        conds.append('d.{} {} {}'.format(
+            escape(field), N1QL_OPERATORS[op], next(params)) )
+    parts = [
+        'SELECT META(d).id AS id, META(d).cas AS cas, d AS doc',
+        'FROM {} d'.format(escape(keyspace)),
+        'WHERE ' + ' AND '.join(conds) ]
+    if select.order_by:
+        parts.append('ORDER BY ' + ', '.join(
+            'd.{} {}'.format(escape(field), 'DESC' if desc else 'ASC')
+            for field, desc in select.order_by ))
+    if select.limit is not None:
+        parts.append('LIMIT ' + next(params))
+    if select.offset is not None:
+        parts.append('OFFSET ' + next(params))
+    return ' '.join(parts)
+
+
+def index_name(doctype, field):
+    """ name of the secondary index on field for the docs of doctype """
+    return 'cushion_{}_{}'.format(doctype, field)
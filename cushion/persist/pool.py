@@ -0,0 +1,154 @@
+from contextlib import contextmanager
+from Queue import Empty, Queue
+from threading import Lock, local
+
+from .base import BaseConnection
+from .exceptions import PoolTimeout
+
+
+def _pooled(name):
+    """ a connection method that runs on a pooled connection """
+    def method(self, *a, **kw):
+        with self.connection() as conn:
+            return getattr(conn, name)(*a, **kw)
+    method.__name__ = name
+    return method
+
+
+class ConnectionPool(BaseConnection):
+    """
+    bounded pool of connections made by a factory.  the pool is itself a
+    connection, so it can be the active one: every call checks out a
+    connection for its duration, or with per_thread uses the connection
+    bound to the calling thread.
+    """
+
+    def __init__(self, factory, size=10, timeout=None, health_check=None,
+            per_thread=False):
+        """
+        factory - callable making a new connection
+        size - most connections ever open at once
+        timeout - seconds to wait for a free connection before PoolTimeout,
+                  None waits forever
+        health_check - optional callable(conn) returning False for a
+                       connection that should be dropped, run on checkout
+        per_thread - bind a connection to each thread on its first call,
+                     until release() is called from that thread
+        """
+        self._factory = factory
+        self.size = size
+        self.timeout = timeout
+        self._health_check = health_check
+        self.per_thread = per_thread
+        self._idle = Queue()
+        self._lock = Lock()
+        self._local = local()
+        self.created = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.discarded = 0
+        # attributes shared by the connections, asked of the first one used
+        self._shared = {}
+
+    def _shared_attr(name):
+        def get(self):
+            if name not in self._shared:
+                with self.connection() as conn:
+                    self._shared[name] = getattr(conn, name)
+            return self._shared[name]
+        return property(get)
+
+    binary_values = _shared_attr('binary_values')
+    max_update_ops = _shared_attr('max_update_ops')
+    del _shared_attr
+
+    def stats(self):
+        idle = self._idle.qsize()
+        return {
+            'size': self.size,
+            'created': self.created,
+            'idle': idle,
+            'in_use': self.created - idle,
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+            'discarded': self.discarded }
+
+    def checkout(self):
+        with self._lock:
+            self.checkouts += 1
+        while True:
+            with self._lock:
+                try:
+                    conn = self._idle.get_nowait()
+                except Empty:
+                    conn = None
+                    create = self.created < self.size
+                    if create:
+                        # claim the slot now, connect outside of the lock
+                        self.created += 1
+                    else:
+                        self.waits += 1
+            if conn is None:
+                if create:
+                    try:
+                        return self._factory()
+                    except Exception:
+                        with self._lock:
+                            self.created -= 1
+                        raise
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise PoolTimeout()
+            if self._health_check is None or self._health_check(conn):
+                return conn
+            with self._lock:
+                # unhealthy, make room for a new one
+                self.created -= 1
+                self.discarded += 1
+
+    def checkin(self, conn):
+        self._idle.put(conn)
+
+    def release(self):
+        """ returns the connection bound to this thread to the pool """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            self.checkin(conn)
+
+    @contextmanager
+    def connection(self):
+        if self.per_thread:
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = self.checkout()
+            yield conn
+            return
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    get = _pooled('get')
+    get_multi = _pooled('get_multi')
+    cas = _pooled('cas')
+    set = _pooled('set')
+    set_multi = _pooled('set_multi')
+    update = _pooled('update')
+    delete = _pooled('delete')
+    view_create = _pooled('view_create')
+    view_destroy = _pooled('view_destroy')
+    design_view_create = _pooled('design_view_create')
+    find = _pooled('find')
+    index_create = _pooled('index_create')
+
+    def query(self, *a, **kw):
+        # rows are read while the connection is still checked out
+        with self.connection() as conn:
+            return list(conn.query(*a, **kw))
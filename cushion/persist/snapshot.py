@@ -0,0 +1,229 @@
+import gc
+import marshal
+import mmap
+import os
+import struct
+from array import array
+from collections import MutableMapping
+from contextlib import contextmanager
+from itertools import chain, count, izip
+
+from .base import MISSING, apply_mutations
+
+
+# snapshot files start with MAGIC and end with the offset of their table
+# followed by MAGIC again.  in between are the encoded docs back to back,
+# then the table: the keys, where each doc ends and the view index rows.
+MAGIC = 'CUSHSNP1'
+TRAILER = struct.Struct('<Q8s')
+# marshal format, readable by any python 2
+MARSHAL_VERSION = 2
+
+
+@contextmanager
+def _no_gc():
+    """ building many objects at once goes much faster without the gc """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class SnapshotData(MutableMapping):
+    """
+    the docs of a memory-mapped snapshot.  a doc is decoded the first time
+    it's read and kept from then on, as are docs written since.
+    """
+
+    def __init__(self, mm, start, keys, ends, codec):
+        self._mm = mm
+        self._start = start
+        # where each doc ends, relative to start, indexed by slot
+        self._ends = ends
+        # keys still only in the file => slot
+        self._slots = dict(izip(keys, count()))
+        # decoded or written docs
+        self._docs = {}
+        self._decode = codec.decode
+
+    def raw(self, key):
+        """ the encoded doc of a key still only in the file """
+        slot = self._slots[key]
+        begin = self._ends[slot - 1] if slot else 0
+        return self._mm[self._start + begin:self._start + self._ends[slot]]
+
+    def __getitem__(self, key):
+        try:
+            return self._docs[key]
+        except KeyError:
+            pass
+        doc = self._docs[key] = self._decode(self.raw(key))
+        del self._slots[key]
+        return doc
+
+    def __setitem__(self, key, doc):
+        self._docs[key] = doc
+        self._slots.pop(key, None)
+
+    def __delitem__(self, key):
+        if self._docs.pop(key, MISSING) is MISSING \
+                and self._slots.pop(key, MISSING) is MISSING:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._docs or key in self._slots
+
+    def __iter__(self):
+        # over copies, reading docs moves them from one dict to the other
+        return chain(list(self._docs), list(self._slots))
+
+    def __len__(self):
+        return len(self._docs) + len(self._slots)
+
+    def encoded(self, encode):
+        """ (key, encoded doc) pairs, copying the ones never decoded as is """
+        for key, doc in self._docs.iteritems():
+            yield key, encode(doc)
+        for key in self._slots:
+            yield key, self.raw(key)
+
+    def close(self):
+        self._mm.close()
+
+
+def write_snapshot(path, data, views, codec):
+    """
+    writes docs and view index rows to path, replacing it only once the new
+    snapshot is complete.
+    data - {key: doc}, or a SnapshotData
+    views - {view key: (digest, rows)}, rows that can't be marshalled are
+            left out
+    """
+    if isinstance(data, SnapshotData):
+        docs = data.encoded(codec.encode)
+    else:
+        docs = ((k, codec.encode(doc)) for k, doc in data.iteritems())
+    keys, ends, end = [], array('L'), 0
+    saved = {}
+    for view_key, (digest, rows) in views.iteritems():
+        try:
+            saved[view_key] = (digest, marshal.dumps(rows, MARSHAL_VERSION))
+        except ValueError:
+            # eg. a python map emitting values json doesn't have
+            continue
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        for key, blob in docs:
+            f.write(blob)
+            end += len(blob)
+            keys.append(key)
+            ends.append(end)
+        table = {
+            'keys': keys,
+            'ends': ends.tostring(),
+            'itemsize': ends.itemsize,
+            'views': saved }
+        f.write(marshal.dumps(table, MARSHAL_VERSION))
+        f.write(TRAILER.pack(len(MAGIC) + end, MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def read_snapshot(path, codec):
+    """
+    maps a snapshot, returns (SnapshotData, {view key: (digest, rows blob)})
+    with the rows left to load_rows
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    table_at, magic = TRAILER.unpack(mm[-TRAILER.size:])
+    if mm[:len(MAGIC)] != MAGIC or magic != MAGIC:
+        mm.close()
+        raise ValueError('not a snapshot: {}'.format(path))
+    with _no_gc():
+        table = marshal.loads(mm[table_at:-TRAILER.size])
+        ends = array('L')
+        if ends.itemsize != table['itemsize']:
+            mm.close()
+            raise ValueError('snapshot written on another platform')
+        ends.fromstring(table['ends'])
+        data = SnapshotData(mm, len(MAGIC), table['keys'], ends, codec)
+    return data, table['views']
+
+
+def load_rows(blob):
+    with _no_gc():
+        return marshal.loads(blob)
+
+
+class WriteLog(object):
+    """
+    append-only log of the writes made since the last snapshot, a json
+    record per line
+    """
+
+    def __init__(self, path, codec):
+        self.path = path
+        self._encode = codec.encode
+        self._f = open(path, 'ab')
+
+    def set(self, key, doc):
+        self._write(['s', key, doc])
+
+    def update(self, key, mutations):
+        self._write(['u', key, mutations])
+
+    def delete(self, key):
+        self._write(['d', key])
+
+    def _write(self, record):
+        self._f.write(self._encode(record) + '\n')
+        self._f.flush()
+
+    def truncate(self):
+        self._f.close()
+        self._f = open(self.path, 'wb')
+
+    def close(self):
+        self._f.close()
+
+
+def replay_log(path, data, codec):
+    """
+    applies the writes logged at path to data, returns the keys written.
+    a last record cut short is cut off the log too, so that the next
+    writes don't get appended to it.
+    """
+    written = set()
+    if not os.path.exists(path):
+        return written
+    with open(path, 'rb') as f:
+        lines = f.read().split('\n')
+    end = 0
+    for n, line in enumerate(lines):
+        start, end = end, end + len(line) + 1
+        if not line:
+            continue
+        try:
+            record = codec.decode(line)
+        except ValueError:
+            if n == len(lines) - 1:
+                # cut short by a crash while writing it, never happened
+                with open(path, 'r+b') as f:
+                    f.truncate(start)
+                break
+            raise
+        op, key = record[0], record[1]
+        if op == 's':
+            data[key] = record[2]
+        elif op == 'u':
+            apply_mutations(data[key], record[2])
+        else:
+            data.pop(key, None)
+        written.add(key)
+    return written
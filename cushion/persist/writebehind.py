@@ -0,0 +1,163 @@
+import atexit
+import logging
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Event, Lock, Thread
+from uuid import uuid4
+
+from . import Persist
+from .base import MISSING
+
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehind(object):
+    """
+    queues deferred saves and writes them in batches from a background
+    thread.  saves of the same id coalesce into the latest state, so a doc
+    saved many times between flushes is written once.  install it with
+    set_write_behind(...); models opt in with write_behind = True.
+    """
+
+    def __init__(self, max_batch=500, interval=1.0, on_error=None):
+        """
+        max_batch - pending docs that trigger a flush right away
+        interval - most seconds a save waits before it is flushed
+        on_error - callable({docid: error}) for writes that failed, they
+                   are logged otherwise
+        """
+        self.max_batch = max_batch
+        self.interval = interval
+        self.on_error = on_error
+        # docid => (doc, durability, on_written), oldest first
+        self._pending = OrderedDict()
+        # the batch being written, still readable until it has landed
+        self._inflight = {}
+        self._lock = Lock()
+        # one flush at a time, so saves of a doc land in order, and no
+        # discard while a batch is being written
+        self._flush_lock = Lock()
+        self._wake = Event()
+        self._closed = False
+        self.flushes = 0
+        self.written = 0
+        self.coalesced = 0
+        self._thread = Thread(target=self._run, name='cushion-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def enqueue(self, docid, doc, durability=None, on_written=None):
+        """
+        queues a write, returns the docid, generated when None.
+        on_written - called without arguments once the write has landed,
+                     once per flush however many docs share it
+        """
+        if self._closed:
+            raise RuntimeError('write behind is closed')
+        if docid is None:
+            docid = uuid4().hex
+        with self._lock:
+            if self._pending.pop(docid, None) is not None:
+                self.coalesced += 1
+            self._pending[docid] = (deepcopy(doc), durability, on_written)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wake.set()
+        return docid
+
+    def pending(self, docid):
+        """ a copy of the doc waiting to be written, or MISSING """
+        with self._lock:
+            entry = self._pending.get(docid) or self._inflight.get(docid)
+        return MISSING if entry is None else deepcopy(entry[0])
+
+    def discard(self, docid):
+        """
+        drops the queued write of a doc, returns whether there was one.  a
+        flush under way is waited for, so that its batch can't land after.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending.pop(docid, None)
+        return pending is not None
+
+    def flush(self):
+        """
+        writes everything pending now, one batch per durability.  callbacks
+        run once the flush lock is released, so they may write, delete or
+        flush themselves.
+        """
+        callbacks, errors = self._write()
+        for on_written in callbacks:
+            try:
+                on_written()
+            except Exception:
+                log.exception('write behind callback failed')
+        if errors:
+            self._report(errors)
+
+    def _write(self):
+        """ writes the pending docs, returns (on_written callbacks, errors) """
+        with self._flush_lock:
+            persist = Persist()
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+                self._inflight = pending
+            if not pending:
+                return (), {}
+            batches = OrderedDict()
+            for docid, (doc, durability, _) in pending.iteritems():
+                level = tuple(sorted(durability.items())) \
+                    if durability is not None else None
+                batches.setdefault(level, []).append((docid, doc))
+            errors = {}
+            for level, items in batches.iteritems():
+                durability = dict(level) if level is not None else None
+                try:
+                    _, failed = persist.set_multi(items, durability=durability)
+                except Exception as e:
+                    failed = {docid: e for docid, _ in items}
+                errors.update(failed)
+                self.written += len(items) - len(failed)
+            with self._lock:
+                self._inflight = {}
+            self.flushes += 1
+            callbacks = set(on_written
+                for docid, (_, _, on_written) in pending.iteritems()
+                if on_written is not None and docid not in errors)
+        return callbacks, errors
+
+    def _report(self, errors):
+        if self.on_error is None:
+            log.error('write behind failed for %d doc(s): %r',
+                len(errors), errors)
+            return
+        try:
+            self.on_error(errors)
+        except Exception:
+            log.exception('write behind error callback failed')
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._closed:
+                break
+            try:
+                self.flush()
+            except Exception:
+                log.exception('write behind flush failed')
+
+    def close(self):
+        """ stops the background thread and drains what is still pending """
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
@@ -0,0 +1,100 @@
+from datetime import datetime
+
+from .persist import Persist
+from .persist.base import OPERATORS, Select
+
+
+def _doc_value(value):
+    """ a value as docs hold it, eg. a model as its id """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, '_raw_data'):
+        # models, as RefFields keep them
+        return value.id
+    return value
+
+
+class Query(object):
+    """
+    query over the docs of a model without a view, eg.
+    Shoe.where(size=11).order_by('color').limit(50).  every step returns a
+    new query, which runs each time it's iterated.  couchbase connections
+    run it as n1ql, see CouchbaseConnection.find, and need an index on the
+    fields, see Model.create_index.
+    """
+
+    def __init__(self, model, where=(), order_by=(), limit=None,
+            offset=None):
+        self.model = model
+        self._where = where
+        self._order_by = order_by
+        self._limit = limit
+        self._offset = offset
+
+    def _copy(self, **kw):
+        args = dict(where=self._where, order_by=self._order_by,
+            limit=self._limit, offset=self._offset)
+        args.update(kw)
+        return Query(self.model, **args)
+
+    def _check_field(self, name):
+        if name not in self.model._field_names:
+            raise ValueError('{} is not a field of {}'.format(
+                name, self.model.__name__) )
+
+    def where(self, **conditions):
+        """
+        adds conditions that must all hold.  keywords are field names,
+        optionally followed by a double underscore and one of eq (the
+        default), ne, lt, lte, gt, gte or in, eg. price__lt=50 or
+        color__in=['red', 'blue'].
+        """
+        where = list(self._where)
+        for key, value in sorted(conditions.iteritems()):
+            name, _, op = key.partition('__')
+            op = op or 'eq'
+            self._check_field(name)
+            if op not in OPERATORS:
+                raise ValueError('unknown operator {} in {}'.format(op, key))
+            if op == 'in':
+                value = [_doc_value(v) for v in value]
+            else:
+                value = _doc_value(value)
+            where.append((name, op, value))
+        return self._copy(where=tuple(where))
+
+    def order_by(self, *names):
+        """ sorts by fields, a name starting with - sorts descending """
+        order_by = list(self._order_by)
+        for name in names:
+            desc = name.startswith('-')
+            name = name.lstrip('-')
+            self._check_field(name)
+            order_by.append((name, desc))
+        return self._copy(order_by=tuple(order_by))
+
+    def limit(self, n):
+        return self._copy(limit=n)
+
+    def offset(self, n):
+        return self._copy(offset=n)
+
+    @property
+    def select(self):
+        """ the Select that connections run """
+        return Select(self.model.__name__.lower(), self._where,
+            self._order_by, self._limit, self._offset)
+
+    def all(self):
+        """ runs the query, returns the models """
+        from_doc = self.model._from_doc
+        return [from_doc(docid, doc, cas)
+            for docid, doc, cas in Persist().find(self.select)]
+
+    def first(self):
+        """ the first model, or None """
+        models = self.limit(1).all()
+        return models[0] if models else None
+
+    def __iter__(self):
+        return iter(self.all())
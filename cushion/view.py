@@ -1,19 +1,38 @@
 
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import defaultdict
+from json import dumps, loads
+from time import time
 
+from .columns import ROW_COLUMNS, columns
+from .field import prefetch as prefetch_refs
 from .persist import Persist
+from .persist.base import QueryProfile, profile_phase
 
 MAXVAL = u'\u0fff' # useful for queries boundaries
 
 class View(object):
 
-    def __init__(self, design_name, view_name, mapf, redf=None, wrapper=None):
+    def __init__(self, design_name, view_name, mapf, redf=None, wrapper=None,
+            pymapf=None, cache=None):
+        """
+        mapf - javascript source of the map function
+        redf - optional reduce, a builtin (_count, _sum, _stats) or
+               javascript source
+        pymapf - optional python equivalent of mapf, used by connections
+                 that map in process.  called as pymapf(doc, meta) and
+                 returns an iterable of (key, value) pairs
+        cache - optional ViewCache for the results of calls, iter() always
+                queries
+        """
         super(View, self).__init__()
         self.design = design_name
         self.name = view_name
         self.mapf = mapf
         self.redf = redf
+        self.pymapf = pymapf
+        self.cache = cache
         self._wrapper = wrapper
 
     def __get__(self, instance, cls=None):
@@ -21,21 +40,171 @@ class View(object):
         self._wrapper = cls or instance.__class__
         return self
 
-    def __call__(self, wrapper=None, **kw):
+    def __call__(self, wrapper=None, prefetch=None, profile=False, **kw):
+        """
+        queries the view, wrapping docs in models when include_docs is set.
+        prefetch - RefField paths to resolve for all the models in one go
+        profile - return (results, QueryProfile) instead, with the time spent
+                  per phase of the query and its row counts
+        """
+        if not profile:
+            return self._query(wrapper, prefetch, None, kw)
+        qp = QueryProfile('/'.join((self.design, self.name)))
+        start = time()
+        ret = self._query(wrapper, prefetch, qp, kw)
+        qp.elapsed = time() - start
+        return ret, qp
+
+    def _query(self, wrapper, prefetch, qp, kw):
         ret = []
-        result = Persist().query(self.design, self.name, **kw)
+        if qp is not None:
+            kw['profile'] = qp
+        result = self._rows(kw)
         if not result: return ret
         wr_ = wrapper or self._wrapper
-        for r in result:
-            if wr_ and kw.get('include_docs', False):
-                docd = r.doc.value
-                if '_id' not in docd:
-                    docd['_id'] = r.doc.key
-                ret.append( wr_(**r.doc.value) )
-            else:
-                ret.append( r.doc or r )
+        include_docs = kw.get('include_docs', False)
+        with profile_phase(qp, 'wrap'):
+            for r in result:
+                ret.append(self._wrap(r, wr_, include_docs))
+        if prefetch:
+            with profile_phase(qp, 'prefetch'):
+                self._prefetch(ret, prefetch)
         return ret
 
+    def _rows(self, kw):
+        """ the rows of a query, through the cache when there is one """
+        if self.cache is not None:
+            return self.cache.query(self.design, self.name, kw,
+                lambda: Persist().query(self.design, self.name, **kw))
+        return Persist().query(self.design, self.name, **kw)
+
+    def to_columns(self, fields, wrapper=None, arrow=False, **kw):
+        """
+        queries the view into typed columns, see columns.columns.  docs are
+        read as they are, no models are made.
+        fields - names of fields of the wrapper model, or 'id', 'key' and
+                 'value' of the rows.  reduced rows have no docs, so views
+                 with a reduce need reduce=False for fields.
+        arrow - return a pyarrow RecordBatch instead of numpy arrays
+        """
+        if any(name not in ROW_COLUMNS for name in fields):
+            if self.redf and kw.get('reduce', True) not in (False, 'false'):
+                raise ValueError(
+                    '{}/{} reduces, doc fields need reduce=False'.format(
+                        self.design, self.name) )
+            kw['include_docs'] = True
+        return columns(self._rows(kw), wrapper or self._wrapper, fields,
+            arrow)
+
+    @staticmethod
+    def _prefetch(items, paths):
+        prefetch_refs(
+            [m for m in items if hasattr(m, '_raw_data')], *paths)
+
+    def iter(self, page_size=100, cursor=None, wrapper=None, prefetch=None,
+            **kw):
+        """
+        lazily iterates the view page by page, see ViewIterator.  pass the
+        cursor of an earlier iteration to resume right after its last row.
+        """
+        return ViewIterator(self, page_size, cursor,
+            wrapper or self._wrapper, prefetch, kw)
+
+    @staticmethod
+    def _wrap(r, wr_, include_docs):
+        if r.docid is None:
+            # reduced rows have no doc to wrap
+            return r
+        if wr_ and include_docs:
+            docd = r.doc.value
+            if hasattr(wr_, '_from_doc'):
+                # models keep the doc raw and decode fields when read
+                return wr_._from_doc(
+                    r.doc.key, docd, getattr(r.doc, 'cas', None))
+            if '_id' not in docd:
+                docd['_id'] = r.doc.key
+            return wr_(**docd)
+        return r.doc or r
+
+
+class ViewIterator(object):
+    """
+    pages through a view with keyset cursors: each page starts at the key
+    and docid of the last row seen (startkey + startkey_docid) instead of
+    using an ever growing skip.  the rows of that key and docid already
+    seen are dropped from the page, counted since a doc can emit a key more
+    than once, so rows deleted or moved between pages don't shift it.
+    rows are wrapped as they are yielded, and .cursor is a token for the
+    last one, usable to resume later.
+    """
+
+    def __init__(self, view, page_size, cursor, wrapper, prefetch, kw):
+        self.view = view
+        self.page_size = page_size
+        self.cursor = cursor
+        self._wrapper = wrapper
+        self._prefetch = prefetch
+        self._kw = kw
+
+    @staticmethod
+    def encode_cursor(key, docid, seen=1):
+        """ seen - rows of that key and docid yielded so far """
+        return urlsafe_b64encode(dumps([key, docid, seen]))
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """ returns (key, docid, seen) """
+        decoded = loads(urlsafe_b64decode(str(cursor)))
+        if len(decoded) == 2:
+            # from before cursors counted
+            decoded.append(1)
+        return tuple(decoded)
+
+    def __iter__(self):
+        kw = dict(self._kw)
+        limit = kw.pop('limit', None)
+        include_docs = kw.get('include_docs', False)
+        if self.cursor:
+            kw.pop('skip', None)
+        yielded = 0
+        persist = Persist()
+        while True:
+            page_size = self.page_size
+            if limit is not None:
+                page_size = min(page_size, limit - yielded)
+                if page_size <= 0:
+                    return
+            key = docid = None
+            seen = 0
+            if self.cursor:
+                # continue from the last row, which comes again with any
+                # other rows of its key and docid seen already
+                key, docid, seen = self.decode_cursor(self.cursor)
+                kw.pop('skip', None)
+                kw.update(startkey=key, startkey_docid=docid)
+            fetch = page_size + seen
+            rows = list(persist.query(
+                self.view.design, self.view.name, limit=fetch, **kw))
+            drop = 0
+            while drop < min(seen, len(rows)) and \
+                    (rows[drop].key, rows[drop].docid) == (key, docid):
+                drop += 1
+            new = rows[drop:drop + page_size]
+            page = [self.view._wrap(r, self._wrapper, include_docs)
+                for r in new]
+            if self._prefetch:
+                self.view._prefetch(page, self._prefetch)
+            for r, item in zip(new, page):
+                if (r.key, r.docid) == (key, docid):
+                    seen += 1
+                else:
+                    key, docid, seen = r.key, r.docid, 1
+                self.cursor = self.encode_cursor(key, docid, seen)
+                yielded += 1
+                yield item
+            if len(rows) < fetch:
+                return
+
 
 def sync_all(list_of_views):
     """
@@ -46,6 +215,7 @@ def sync_all(list_of_views):
     for v in list_of_views:
         d = {'map':v.mapf}
         if v.redf: d['reduce'] = v.redf
+        if v.pymapf: d['pymap'] = v.pymapf
         designs[v.design][v.name] = d
 
     persist = Persist()
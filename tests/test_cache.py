@@ -0,0 +1,237 @@
+import unittest
+from time import sleep
+
+from ..cushion.model import Model
+from ..cushion.field import IntegerField, TextField, RefField
+from ..cushion.persist import (
+    set_connection, get_connection, set_cache, set_write_behind )
+from ..cushion.persist.cache import DocumentCache, ViewCache, identity_map
+from ..cushion.persist.mem import MemConnection
+from ..cushion.persist.writebehind import WriteBehind
+from ..cushion.view import View, sync_all
+
+
+class Tenant(Model):
+    name = TextField()
+
+
+class Account(Model):
+    tenant = RefField(Tenant)
+
+
+def map_by_seats(doc, meta):
+    if doc.get('type') == 'desk':
+        yield doc['seats'], None
+
+
+class Desk(Model):
+    seats = IntegerField()
+    by_seats = View(
+        'desk', 'by_seats',
+        '''
+        function(doc) {
+            if (doc.type == "desk") {
+                emit(doc.seats, null)
+            }
+        }
+        ''',
+        pymapf=map_by_seats,
+        cache=ViewCache(maxsize=2) )
+
+
+class CountingMemConnection(MemConnection):
+    """ counts the reads that reach it """
+
+    def __init__(self):
+        super(CountingMemConnection, self).__init__()
+        self.reads = 0
+        self.queries = 0
+
+    def query(self, *a, **kw):
+        self.queries += 1
+        return super(CountingMemConnection, self).query(*a, **kw)
+
+    def get(self, key, with_cas=False):
+        self.reads += 1
+        return super(CountingMemConnection, self).get(key, with_cas)
+
+    def get_multi(self, keys, with_cas=False):
+        self.reads += 1
+        return super(CountingMemConnection, self).get_multi(keys, with_cas)
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = CountingMemConnection()
+        set_connection(self.conn)
+        self.cache = DocumentCache(maxsize=2)
+        set_cache(self.cache)
+
+    def tearDown(self):
+        set_cache(None)
+
+    def test_write_through(self):
+        t = Tenant(name='acme').save()
+        self.assertEqual('acme', Tenant.load(t.id).name)
+        self.assertEqual(0, self.conn.reads)
+        t.name = 'acme inc'
+        t.save()
+        self.assertEqual('acme inc', Tenant.load(t.id).name)
+        t.delete()
+        self.assertEqual(None, Tenant.load(t.id))
+        self.assertEqual(1, self.conn.reads)
+
+    def test_lru_eviction(self):
+        ids = [Tenant(name=str(i)).save().id for i in range(3)]
+        self.assertEqual(2, len(self.cache))
+        self.assertEqual(1, self.cache.evictions)
+        Tenant.load(ids[0])
+        self.assertEqual(1, self.conn.reads)
+        Tenant.load(ids[0])
+        self.assertEqual(1, self.conn.reads)
+        self.assertEqual(
+            {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1,
+             'evictions': 2},
+            self.cache.stats() )
+
+    def test_ttl(self):
+        set_cache(DocumentCache(ttl=0.01))
+        t = Tenant(name='acme').save()
+        sleep(0.02)
+        Tenant.load(t.id)
+        self.assertEqual(1, self.conn.reads)
+
+    def test_revalidate(self):
+        set_cache(DocumentCache(revalidate=True))
+        t = Tenant(name='acme').save()
+        # written behind the cache's back
+        get_connection().set(t.id, {'type': 'tenant', 'name': 'other'})
+        self.assertEqual('other', Tenant.load(t.id).name)
+
+    def test_copies(self):
+        t = Tenant(name='acme').save()
+        Tenant.load(t.id)._raw_data['name'] = 'mangled'
+        doc = self.cache.get(self.conn, t.id)
+        doc['name'] = 'mangled'
+        self.assertEqual('acme', Tenant.load(t.id).name)
+
+    def test_load_many(self):
+        ids = [Tenant(name=str(i)).save().id for i in range(2)]
+        self.cache.clear()
+        self.assertEqual(['0', '1'], [t.name for t in Tenant.load_many(ids)])
+        self.assertEqual(['0', '1'], [t.name for t in Tenant.load_many(ids)])
+        self.assertEqual(1, self.conn.reads)
+
+    def test_identity_map(self):
+        set_cache(None)
+        t = Tenant(name='acme').save()
+        a = Account(tenant=t).save()
+        with identity_map():
+            t0 = Tenant.load(t.id)
+            assert t0 is Tenant.load(t.id)
+            assert t0 is Account.load(a.id).tenant
+            assert [t0] == Tenant.load_many([t.id])
+            assert t0 is Tenant.load_many([t.id])[0]
+        assert t0 is not Tenant.load(t.id)
+
+
+class TestViewCache(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = CountingMemConnection()
+        set_connection(self.conn)
+        sync_all(Desk.viewlist())
+        self.cache = Desk.by_seats.cache = ViewCache(maxsize=2)
+        self.desks = [Desk(seats=i).save() for i in range(3)]
+
+    def tearDown(self):
+        Desk.by_seats.cache = ViewCache(maxsize=2)
+
+    def seats(self, **kw):
+        return [d.seats for d in Desk.by_seats(include_docs=True, **kw)]
+
+    def test_hits(self):
+        self.assertEqual([0, 1, 2], self.seats())
+        # the same params, however spelled
+        self.assertEqual([0, 1, 2], self.seats())
+        self.assertEqual([2, 1, 0], self.seats(descending='true'))
+        self.assertEqual([2, 1, 0], self.seats(descending=True))
+        self.assertEqual(2, self.conn.queries)
+        self.seats(limit=1)
+        self.assertEqual(
+            {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 3,
+             'stale_hits': 0, 'evictions': 1},
+            self.cache.stats() )
+
+    def test_copies(self):
+        desk = Desk.by_seats(include_docs=True)[0]
+        desk.seats = 9
+        self.conn.data[desk.id]['seats'] = 8
+        self.assertEqual([0, 1, 2], self.seats())
+
+    def test_invalidated_by_writes(self):
+        self.seats()
+        self.desks[0].seats = 5
+        self.desks[0].save()
+        self.assertEqual([1, 2, 5], self.seats())
+        self.desks[1].delete()
+        self.assertEqual([2, 5], self.seats())
+        Model.save_many([Desk(seats=3)])
+        self.assertEqual([2, 3, 5], self.seats())
+        self.assertEqual(4, self.conn.queries)
+        # an unchanged model writes nothing
+        self.desks[2].save()
+        self.seats()
+        self.assertEqual(4, self.conn.queries)
+
+    def test_invalidated_by_flush(self):
+        writer = WriteBehind(interval=60)
+        set_write_behind(writer)
+        Desk.write_behind = True
+        try:
+            desk = Desk(seats=7).save()
+            # queued, not in the view yet
+            self.assertEqual([0, 1, 2], self.seats())
+            writer.flush()
+            self.assertEqual([0, 1, 2, 7], self.seats())
+            desk.seats = 8
+            desk.save()
+            self.seats()
+            writer.flush()
+            self.assertEqual([0, 1, 2, 8], self.seats())
+        finally:
+            del Desk.write_behind
+            set_write_behind(None)
+
+    def test_stale_ok(self):
+        cache = Desk.by_seats.cache = ViewCache(stale='ok', ttl=60)
+        self.seats()
+        Desk(seats=7).save()
+        self.assertEqual([0, 1, 2], self.seats())
+        # run out the ttl
+        for key, (rows, generation, _) in cache._results.items():
+            cache._results[key] = (rows, generation, 0)
+        self.assertEqual([0, 1, 2, 7], self.seats())
+
+    def test_cache_attached_later(self):
+        Desk.by_seats.cache = None
+        Desk(seats=7).save()
+        Desk.by_seats.cache = ViewCache()
+        self.assertEqual([0, 1, 2, 7], self.seats())
+        Desk(seats=8).save()
+        self.assertEqual([0, 1, 2, 7, 8], self.seats())
+
+    def test_stale_update_after(self):
+        Desk.by_seats.cache = ViewCache(stale='update_after')
+        self.seats()
+        Desk(seats=7).save()
+        self.assertEqual([0, 1, 2], self.seats())
+        self.assertEqual([0, 1, 2, 7], self.seats())
+        self.assertEqual(2, self.conn.queries)
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            ViewCache(stale='sometimes')
+        with self.assertRaises(ValueError):
+            ViewCache(stale='ok')
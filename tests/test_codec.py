@@ -0,0 +1,110 @@
+import unittest
+from base64 import b64encode
+from json import dumps
+
+from ..cushion.model import Model
+from ..cushion.field import ByteField, TextField
+from ..cushion.persist import get_connection, set_connection
+from ..cushion.persist.codec import (
+    MAGIC, Codec, DocumentCodec, available_codecs, get_codec, COMPRESSORS )
+from ..cushion.persist.mem import MemConnection
+
+
+class BinaryMemConnection(MemConnection):
+    """ keeps docs as they are given, bytes and all """
+    binary_values = True
+
+
+class Attachment(Model):
+    name = TextField()
+    body = ByteField(compression='zlib', threshold=64)
+
+
+DOC = {'name': u'caf\xe9', 'n': 3, 'f': 1.5, 'ok': True, 'none': None,
+    'tags': [u'a', u'b'], 'nested': {'x': [1, {'y': u'z'}]},
+    'text': u'lorem ipsum ' * 200}
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_roundtrip(self):
+        for name in available_codecs():
+            for compression in [None] + sorted(COMPRESSORS):
+                codec = DocumentCodec(name, compression=compression)
+                payload, is_json = codec.encode(DOC)
+                self.assertEqual(DOC, codec.decode(payload))
+                self.assertEqual(
+                    get_codec(name).json and not compression, is_json)
+
+    def test_threshold(self):
+        codec = DocumentCodec('json', compression='zlib', threshold=1024)
+        payload, is_json = codec.encode({'a': 1})
+        assert is_json and not payload.startswith(MAGIC)
+        payload, is_json = codec.encode(DOC)
+        assert not is_json and payload.startswith(MAGIC)
+        self.assertLess(len(payload), len(dumps(DOC)) / 4)
+
+    def test_mixed_docs(self):
+        old = dumps(DOC)
+        for name in available_codecs():
+            self.assertEqual(DOC, DocumentCodec(name).decode(old))
+        plain = DocumentCodec('json')
+        for name in available_codecs():
+            payload, _ = DocumentCodec(name, compression='zlib').encode(DOC)
+            self.assertEqual(DOC, plain.decode(payload))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            get_codec('nope')
+        with self.assertRaises(ValueError):
+            DocumentCodec(compression='nope')
+        with self.assertRaises(ValueError):
+            DocumentCodec().decode(MAGIC + '?-{}')
+        with self.assertRaises(TypeError):
+            Codec()
+
+    @unittest.skipIf('msgpack' not in available_codecs(),
+        'msgpack is not installed')
+    def test_binary_values(self):
+        doc = {'name': u'a', 'body': bytearray(MAGIC + 'z\x00\xff')}
+        codec = DocumentCodec('msgpack')
+        assert codec.binary
+        payload, is_json = codec.encode(doc)
+        assert not is_json
+        self.assertEqual({'name': u'a', 'body': MAGIC + 'z\x00\xff'},
+            codec.decode(payload))
+        # json codecs keep docs json, and refuse bytes
+        for name in available_codecs():
+            if get_codec(name).json:
+                assert not DocumentCodec(name).binary
+                with self.assertRaises(TypeError):
+                    DocumentCodec(name).encode(doc)
+
+    def test_byte_field(self):
+        set_connection(MemConnection())
+        blob = 'spam ' * 100
+        a = Attachment(name='a', body=b64encode(blob)).save()
+        raw = Attachment.load(a.id).rawval('body')
+        assert raw.startswith('zlib:'), raw
+        self.assertLess(len(raw), len(b64encode(blob)))
+        self.assertEqual(blob, Attachment.load(a.id).body)
+        # small and old uncompressed values
+        a = Attachment(name='b', body=b64encode('hi')).save()
+        self.assertEqual(b64encode('hi'), Attachment.load(a.id).rawval('body'))
+        self.assertEqual('hi', Attachment.load(a.id).body)
+
+    @unittest.skipIf('msgpack' not in available_codecs(),
+        'msgpack is not installed')
+    def test_byte_field_binary(self):
+        set_connection(BinaryMemConnection())
+        blob = 'spam ' * 100
+        a = Attachment(name='a', body=b64encode(blob)).save()
+        raw = Attachment.load(a.id).rawval('body')
+        # compressed bytes rather than base64 text
+        assert raw.startswith(MAGIC), raw
+        self.assertLess(len(raw), len(blob) / 4)
+        self.assertEqual(blob, Attachment.load(a.id).body)
+        codec = DocumentCodec('msgpack')
+        payload, _ = codec.encode(get_connection().get(a.id))
+        a = Attachment._from_doc(a.id, codec.decode(payload))
+        self.assertEqual(blob, a.body)
@@ -0,0 +1,117 @@
+import unittest
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+import iso8601
+
+from ..cushion.model import Model
+from ..cushion.field import (
+    BooleanField, DateTimeField, FloatField, IntegerField, TextField )
+from ..cushion.persist import get_connection, set_connection
+from ..cushion.persist.mem import MemConnection
+from ..cushion.view import View, sync_all
+
+
+def map_by_day(doc, meta):
+    if doc.get('type') == 'sale':
+        yield doc['day'], doc.get('amount')
+
+
+class Sale(Model):
+    day = IntegerField()
+    amount = FloatField()
+    paid = BooleanField()
+    at = DateTimeField()
+    note = TextField()
+
+    by_day = View(
+        'sale', 'by_day',
+        '''
+        function(doc) {
+            if (doc.type == "sale") {
+                emit(doc.day, doc.amount)
+            }
+        }
+        ''',
+        pymapf=map_by_day )
+
+    total_by_day = View(
+        'sale', 'total_by_day',
+        '''
+        function(doc) {
+            if (doc.type == "sale") {
+                emit(doc.day, doc.amount)
+            }
+        }
+        ''',
+        redf='_sum',
+        pymapf=map_by_day )
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestColumns(unittest.TestCase):
+
+    def setUp(self):
+        set_connection(MemConnection())
+        sync_all(Sale.viewlist())
+        at = datetime(2016, 3, 1, 12, 30)
+        self.sales = [
+            Sale(day=1, amount=9.5, paid=True, at=at, note=u'first').save(),
+            Sale(day=2, amount=1.25, paid=False,
+                at=at.replace(tzinfo=iso8601.UTC) + timedelta(hours=1),
+                note=u'second').save(),
+            Sale(day=3).save() ]
+
+    def test_dtypes(self):
+        cols = Sale.by_day.to_columns(
+            ['id', 'key', 'day', 'amount', 'paid', 'at', 'note'])
+        self.assertEqual(
+            ['id', 'key', 'day', 'amount', 'paid', 'at', 'note'], list(cols))
+        self.assertEqual([s.id for s in self.sales], list(cols['id']))
+        self.assertEqual(numpy.int64, cols['day'].dtype)
+        self.assertEqual([1, 2, 3], cols['day'].tolist())
+        self.assertEqual(numpy.float64, cols['amount'].dtype)
+        self.assertEqual([9.5, 1.25], cols['amount'][:2].tolist())
+        assert numpy.isnan(cols['amount'][2])
+        self.assertEqual(numpy.bool_, cols['paid'].dtype)
+        self.assertEqual([True, False, False], cols['paid'].tolist())
+        self.assertEqual(numpy.dtype('datetime64[us]'), cols['at'].dtype)
+        self.assertEqual(
+            [datetime(2016, 3, 1, 12, 30), datetime(2016, 3, 1, 13, 30)],
+            cols['at'][:2].tolist())
+        assert numpy.isnat(cols['at'][2])
+        self.assertEqual(object, cols['note'].dtype)
+        self.assertEqual([u'first', u'second', u''], cols['note'].tolist())
+
+    def test_query_params(self):
+        cols = Sale.by_day.to_columns(['amount'], key=2, limit=1)
+        self.assertEqual([1.25], cols['amount'].tolist())
+        cols = Sale.total_by_day.to_columns(
+            ['key', 'value'], group=True, endkey=2)
+        self.assertEqual([1, 2], cols['key'].tolist())
+        self.assertEqual([9.5, 1.25], cols['value'].tolist())
+
+    def test_datetime_forms(self):
+        conn = get_connection()
+        for day, at in [(4, '2016-03-01T08:30:00-05:00'),
+                        (5, '2016-03-01T13:30:00Z'),
+                        (6, '20160301T133000Z')]:
+            conn.set(None, {'type': 'sale', 'day': day, 'at': at})
+        cols = Sale.by_day.to_columns(['at'], startkey=4)
+        self.assertEqual([datetime(2016, 3, 1, 13, 30)] * 3,
+            cols['at'].tolist())
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            Sale.by_day.to_columns(['price'])
+
+    def test_reduce_fields(self):
+        with self.assertRaises(ValueError):
+            Sale.total_by_day.to_columns(['key', 'amount'])
+        cols = Sale.total_by_day.to_columns(['key', 'amount'], reduce=False,
+            endkey=2)
+        self.assertEqual([1, 2], cols['key'].tolist())
+        self.assertEqual([9.5, 1.25], cols['amount'].tolist())
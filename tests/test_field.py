@@ -7,7 +7,7 @@ import execjs
 from ..cushion.model import Model, DocTypeMismatch, DocTypeNotFound
 from ..cushion.field import (
     Field, BooleanField, TextField, IntegerField, FloatField, RefField,
-    DateTimeField, ListField, DictField, ByteField, OptionField
+    DateTimeField, ListField, DictField, ByteField, OptionField, prefetch
     )
 
 from ..cushion.persist import set_connection
@@ -38,6 +38,27 @@ class Outter(Model):
     some = RefField(Something)
 
 
+class Outfit(Model):
+    top = RefField(Outter)
+    spare = RefField(Outter)
+
+
+class MultiGetCountingConnection(MemConnection):
+
+    def __init__(self):
+        super(MultiGetCountingConnection, self).__init__()
+        self.gets = 0
+
+    def get(self, key, with_cas=False):
+        self.gets += 1
+        return super(MultiGetCountingConnection, self).get(key, with_cas)
+
+    def get_multi(self, keys, with_cas=False):
+        self.gets += 1
+        return super(MultiGetCountingConnection, self).get_multi(
+            keys, with_cas)
+
+
 class TestField(unittest.TestCase):
 
     def setUp(self):
@@ -131,3 +152,44 @@ class TestField(unittest.TestCase):
         assert len(s.dd)==1, "bogus len"
         s0 = Something.load(s.id)
         assert s.dd['feh'] == s0.dd['feh']
+
+    def test_prefetch(self):
+        conn = MultiGetCountingConnection()
+        set_connection(conn)
+        outfits = []
+        for i in range(5):
+            s = Something(txt=str(i)).save()
+            o = Outter(some=s).save()
+            outfits.append(Outfit(top=o).save().id)
+        outfits = Outfit.load_many(outfits)
+        conn.gets = 0
+        prefetch(outfits, 'top.some', 'spare')
+        self.assertEqual(2, conn.gets)
+        self.assertEqual(
+            [str(i) for i in range(5)], [o.top.some.txt for o in outfits])
+        self.assertEqual(None, outfits[0].spare)
+        self.assertEqual(2, conn.gets)
+        with self.assertRaises(ValueError):
+            prefetch(outfits, 'nope')
+
+    def test_lazy_decode(self):
+        conn = MemConnection()
+        set_connection(conn)
+        conn.set('lazy', {'type': 'something', 'd': 'not a date',
+            'pic': b64encode('img'), 'll': '[1, 2]'})
+        s = Something.load('lazy')
+        self.assertEqual({}, s._data)
+        self.assertEqual('img', s.pic)
+        self.assertEqual([1, 2], s.ll)
+        # decoded when read, not when loaded
+        with self.assertRaises(ValueError):
+            s.d
+        # assignments still validate right away
+        with self.assertRaises(ValueError):
+            s.d = 'still not a date'
+        s.txt = 'touched'
+        s.save()
+        doc = conn.get('lazy')
+        self.assertEqual('not a date', doc['d'])
+        self.assertEqual(b64encode('img'), doc['pic'])
+        self.assertEqual(u'touched', doc['txt'])
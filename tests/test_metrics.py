@@ -0,0 +1,133 @@
+import socket
+import unittest
+
+from ..cushion.model import Model
+from ..cushion.field import IntegerField
+from ..cushion.view import View, sync_all
+from ..cushion.persist import (
+    Persist, InstrumentedPersist, set_connection, set_metrics )
+from ..cushion.persist.mem import MemConnection
+from ..cushion.persist.metrics import (
+    Metrics, StatsdExporter, json_size, prometheus_text )
+
+
+def map_by_level(doc, meta):
+    if doc.get('type') == 'gauge':
+        yield doc['level'], None
+
+
+class Gauge(Model):
+    level = IntegerField()
+    by_level = View(
+        'gauge', 'by_level',
+        '''
+        function(doc) {
+            if (doc.type == "gauge") {
+                emit(doc.level, null)
+            }
+        }
+        ''',
+        pymapf=map_by_level )
+
+
+class FailingConnection(MemConnection):
+
+    def delete(self, key):
+        raise IOError('down')
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FailingConnection()
+        set_connection(self.conn)
+        sync_all(Gauge.viewlist())
+        self.metrics = Metrics(slow_threshold=0, sizer=json_size)
+        self.calls = []
+        self.metrics.add_listener(
+            lambda *call: self.calls.append(call[:2]))
+        set_metrics(self.metrics)
+
+    def tearDown(self):
+        set_metrics(None)
+
+    def test_disabled(self):
+        set_metrics(None)
+        self.assertEqual(Persist, type(Persist()))
+        Gauge(level=1).save()
+        self.assertEqual([], self.calls)
+
+    def test_records(self):
+        assert isinstance(Persist(), InstrumentedPersist)
+        g = Gauge(level=1).save()
+        Gauge.load(g.id)
+        g.level = 2
+        g.save()
+        Gauge.by_level(include_docs=True)
+        with self.assertRaises(IOError):
+            g.delete()
+        self.assertEqual(
+            [('set', 'gauge'), ('get', 'gauge'), ('update', 'gauge'),
+             ('query', 'gauge/by_level'), ('delete', 'gauge')],
+            self.calls)
+        ops, targets = self.metrics.stats()
+        self.assertEqual(1, ops['delete']['errors'])
+        self.assertEqual(0, ops['get']['errors'])
+        self.assertEqual(json_size({'type': 'gauge', 'level': 1}),
+            ops['set']['bytes_out'])
+        self.assertEqual(json_size(self.conn.get(g.id)),
+            targets[('query', 'gauge/by_level')]['bytes_in'])
+        self.assertEqual(5, len(self.metrics.slow_log))
+
+    def test_percentile(self):
+        metrics = Metrics(buckets=(0.1, 1))
+        for seconds in (0.05, 0.05, 0.5, 5):
+            metrics.record('get', None, seconds)
+        stats = metrics.ops['get']
+        self.assertEqual(0.1, stats.percentile(50))
+        self.assertEqual(1, stats.percentile(75))
+        self.assertEqual(float('inf'), stats.percentile(99))
+
+    def test_prometheus(self):
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.record('query', 'a/"b"', 0.5, bytes_in=10)
+        metrics.record('query', 'a/"b"', 2, error=IOError())
+        metrics.record('get', 'c', 0.05)
+        text = prometheus_text(metrics)
+        labels = 'op="query",target="a/\\"b\\""'
+        for line in [
+                'cushion_op_seconds_bucket{%s,le="0.1"} 0' % labels,
+                'cushion_op_seconds_bucket{%s,le="1"} 1' % labels,
+                'cushion_op_seconds_bucket{%s,le="+Inf"} 2' % labels,
+                'cushion_op_seconds_sum{%s} 2.5' % labels,
+                'cushion_op_errors_total{%s} 1' % labels,
+                'cushion_op_bytes_total{%s,direction="in"} 10' % labels]:
+            assert line in text.splitlines(), line
+        # each family is its type line and then all of its samples
+        families = []
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                families.append(line.split()[2])
+            else:
+                name = line.split('{')[0]
+                assert name.startswith(families[-1]), line
+        self.assertEqual(['cushion_op_seconds', 'cushion_op_errors_total',
+            'cushion_op_bytes_total'], families)
+
+    def test_statsd(self):
+        daemon = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        daemon.bind(('127.0.0.1', 0))
+        daemon.settimeout(5)
+        exporter = StatsdExporter(port=daemon.getsockname()[1])
+        try:
+            exporter('query', 'gauge/by_level', 0.25, None)
+            exporter('delete', None, 0.001, IOError())
+            self.assertEqual(
+                'cushion.query.gauge_by_level:250.000|ms',
+                daemon.recv(1024))
+            self.assertEqual(
+                'cushion.delete:1.000|ms\ncushion.delete.errors:1|c',
+                daemon.recv(1024))
+        finally:
+            exporter.close()
+            daemon.close()
@@ -1,9 +1,14 @@
 import unittest
 
 from ..cushion.model import Model, DocTypeMismatch, DocTypeNotFound
-from ..cushion.field import Field, TextField
+from ..cushion.field import (
+    DateTimeField, Field, TextField, DictField, ListField )
 from ..cushion.persist import set_connection, get_connection
+from ..cushion.persist.exceptions import (
+    BulkPersistenceError, DocumentConflict, DocumentNotFound
+    )
 from ..cushion.persist.mem import MemConnection
+from ..cushion.view import View
 
 
 
@@ -19,12 +24,60 @@ class FakeModel(Model):
     def type(self):
         return "fake"
 
+    all_fakes = View('fake', 'all', 'function(doc) { emit(null) }')
     twentythree = Field(default=23)
     somestr = Field()
     txt = TextField()
     default_val = TextField(default='aaa')
 
 
+class Bulky(Model):
+    name = TextField()
+    tags = ListField()
+    attrs = DictField()
+
+
+class Stamped(Model):
+    at = DateTimeField()
+
+
+class RecordingMemConnection(MemConnection):
+    """ keeps the writes it was asked for """
+
+    def __init__(self):
+        super(RecordingMemConnection, self).__init__()
+        self.writes = []
+
+    def set(self, key, value, durability=None, cas=None):
+        self.writes.append(('set', key, value))
+        return super(RecordingMemConnection, self).set(
+            key, value, durability, cas)
+
+    def update(self, key, mutations, durability=None, cas=None):
+        self.writes.append(('update', key, mutations))
+        return super(RecordingMemConnection, self).update(
+            key, mutations, durability, cas)
+
+
+class FlakyMemConnection(MemConnection):
+    """ fails to store any document whose txt is 'fail' """
+
+    def set_multi(self, items, durability=None):
+        ok = [(k, v) for k,v in items if v.get('txt') != 'fail']
+        results, errors = super(FlakyMemConnection, self).set_multi(
+            ok, durability)
+        results = iter(results)
+        ret = []
+        for k,v in items:
+            if v.get('txt') == 'fail':
+                k = k or 'failedkey'
+                errors[k] = Exception('nope')
+                ret.append((k, None))
+            else:
+                ret.append(next(results))
+        return ret, errors
+
+
 class TestModel(unittest.TestCase):
 
     def setUp(self):
@@ -63,3 +116,220 @@ class TestModel(unittest.TestCase):
         d = get_connection().get(f.id)
         self.assertEqual(d['default_val'], 'aaa')
 
+    def test_load_many(self):
+        f0 = FakeModel(txt='zero').save()
+        f1 = FakeModel(txt='one').save()
+        res = FakeModel.load_many([f1.id, 'nope', f0.id, None])
+        self.assertEqual([f1.id, f0.id], [f.id for f in res])
+        self.assertEqual('one', res[0].txt)
+        self.assertEqual([], FakeModel.load_many([]))
+
+    def test_load_many_type_mismatch(self):
+        n = NoTypeModel().save()
+        with self.assertRaises(DocTypeMismatch):
+            FakeModel.load_many([n.id])
+
+    def test_save_many(self):
+        existing = FakeModel(txt='before').save()
+        existing.txt = 'after'
+        fresh = [FakeModel(txt=str(i)) for i in range(3)]
+        saved = FakeModel.save_many(fresh + [existing])
+        self.assertEqual(4, len(saved))
+        for f in fresh:
+            assert f.id, "id not assigned"
+            self.assertEqual(f.txt, FakeModel.load(f.id).txt)
+        self.assertEqual('after', FakeModel.load(existing.id).txt)
+
+    def test_save_many_partial_failure(self):
+        set_connection(FlakyMemConnection())
+        good, bad = FakeModel(txt='good'), FakeModel(txt='fail')
+        with self.assertRaises(BulkPersistenceError) as cm:
+            FakeModel.save_many([good, bad])
+        self.assertEqual(['failedkey'], cm.exception.errors.keys())
+        assert good.id, "good model was not saved"
+        assert bad.id is None, "failed model got an id"
+        self.assertEqual('good', FakeModel.load(good.id).txt)
+
+    def test_field_added_later(self):
+        class Base(Model):
+            pass
+
+        class Sub(Base):
+            pass
+
+        Base.late = TextField(default='late')
+        self.assertEqual(['late'], [name for name, _ in Sub._field_table])
+        s = Sub.load(Sub().save().id)
+        self.assertEqual('late', s.late)
+        self.assertEqual('late', get_connection().get(s.id)['late'])
+
+    def test_clean_save_is_noop(self):
+        conn = RecordingMemConnection()
+        set_connection(conn)
+        b = Bulky(name='x').save()
+        self.assertEqual(1, len(conn.writes))
+        b.save()
+        b2 = Bulky.load(b.id)
+        assert not b2.is_dirty
+        b2.save()
+        self.assertEqual(1, len(conn.writes))
+
+    def test_read_is_not_a_change(self):
+        conn = RecordingMemConnection()
+        set_connection(conn)
+        conn.data['s'] = {'type': 'stamped', 'at': '2016-03-01T12:30:00Z'}
+        s = Stamped.load('s')
+        s.at
+        assert not s.is_dirty
+        s.save()
+        self.assertEqual([], conn.writes)
+        s.at = s.at.replace(hour=13)
+        s.save()
+        self.assertEqual(
+            [('upsert', ('at',), '2016-03-01T13:30:00+00:00')],
+            conn.writes[-1][2])
+
+    def test_partial_update(self):
+        conn = RecordingMemConnection()
+        set_connection(conn)
+        b = Bulky(name='x', attrs={'keep': 1, 'gone': 2}).save()
+        b = Bulky.load(b.id)
+        b.tags.append('new')
+        b.attrs['added'] = 3
+        del b.attrs['gone']
+        assert b.is_dirty
+        b.save()
+        op, key, mutations = conn.writes[-1]
+        self.assertEqual(('update', b.id), (op, key))
+        self.assertEqual(sorted([
+            ('upsert', ('tags',), ['new']),
+            ('upsert', ('attrs', 'added'), 3),
+            ('remove', ('attrs', 'gone'), None) ]), sorted(mutations))
+        doc = conn.get(b.id)
+        self.assertEqual(['new'], doc['tags'])
+        self.assertEqual({'keep': 1, 'added': 3}, doc['attrs'])
+        self.assertEqual('x', doc['name'])
+        # and now it's clean again
+        b.save()
+        self.assertEqual(2, len(conn.writes))
+
+    def test_update_fallbacks(self):
+        conn = RecordingMemConnection()
+        set_connection(conn)
+        b = Bulky.load(Bulky(name='x').save().id)
+        # deleted meanwhile, stored anew
+        conn.delete(b.id)
+        b.name = 'y'
+        b.save()
+        self.assertEqual('set', conn.writes[-1][0])
+        self.assertEqual('y', conn.get(b.id)['name'])
+        with self.assertRaises(DocumentNotFound):
+            conn.update('missing', [('upsert', ('name',), 'z')])
+        # unless its cas is checked
+        b = Bulky.load(b.id)
+        conn.delete(b.id)
+        b.name = 'z'
+        with self.assertRaises(DocumentConflict):
+            b.save(check_cas=True)
+        # more changes than the connection updates in place
+        b = Bulky.load(Bulky(name='x').save().id)
+        conn.max_update_ops = 1
+        b.name = 'y'
+        b.tags = ['a']
+        b.save()
+        self.assertEqual('set', conn.writes[-1][0])
+        self.assertEqual(['a'], conn.get(b.id)['tags'])
+        conn.max_update_ops = 0
+        b.name = 'z'
+        b.save()
+        self.assertEqual('set', conn.writes[-1][0])
+
+    def test_durability(self):
+        conn = MemConnection(durability={'persist_to': 1})
+        set_connection(conn)
+
+        class Session(Model):
+            durability = {}
+            name = TextField()
+
+        f = FakeModel().save()
+        self.assertEqual({'persist_to': 1}, conn.durabilities[f.id])
+        s = Session(name='a').save()
+        self.assertEqual({}, conn.durabilities[s.id])
+        s.name = 'b'
+        s.save(durability={'persist_to': 1, 'replicate_to': 1})
+        self.assertEqual(
+            {'persist_to': 1, 'replicate_to': 1}, conn.durabilities[s.id])
+        sessions = Model.save_many([Session(), Session()])
+        self.assertEqual({}, conn.durabilities[sessions[0].id])
+
+        class Ledger(Model):
+            durability = {'persist_to': 1, 'replicate_to': 1}
+            name = TextField()
+
+        # mixed levels go in a batch each, none weakened
+        mixed = Model.save_many([Session(), Ledger(), FakeModel()])
+        self.assertEqual(
+            [{}, {'persist_to': 1, 'replicate_to': 1}, {'persist_to': 1}],
+            [conn.durabilities[m.id] for m in mixed])
+        f.txt = 'changed'
+        with self.assertRaises(ValueError):
+            f.save(durability={'persist_to_disk': 1})
+
+    def test_cas_conflict(self):
+        f = FakeModel(txt='a').save()
+        mine, theirs = FakeModel.load(f.id), FakeModel.load(f.id)
+        self.assertEqual(f.cas, mine.cas)
+        theirs.txt = 'theirs'
+        theirs.save()
+        mine.txt = 'mine'
+        with self.assertRaises(DocumentConflict):
+            mine.save(check_cas=True)
+        self.assertEqual('theirs', FakeModel.load(f.id).txt)
+        # unconditional saves still go through
+        mine.save()
+        self.assertEqual('mine', FakeModel.load(f.id).txt)
+
+    def test_wrapped_cas(self):
+        conn = get_connection()
+        f = FakeModel(txt='a').save()
+        conn.design_view_create('fake', {'all': {
+            'map': 'function(doc) { emit(null) }',
+            'pymap': lambda doc, meta: [(None, None)] }})
+        mine = FakeModel.all_fakes(include_docs=True)[0]
+        self.assertEqual(f.cas, mine.cas)
+        theirs = FakeModel.load(f.id)
+        theirs.txt = 'theirs'
+        theirs.save()
+        mine.txt = 'mine'
+        with self.assertRaises(DocumentConflict):
+            mine.save(check_cas=True)
+
+    def test_update_retries(self):
+        f = FakeModel(txt='0').save()
+        calls = []
+
+        def bump(model):
+            calls.append(model.txt)
+            if len(calls) == 1:
+                # someone else gets in first
+                other = FakeModel.load(f.id)
+                other.txt = '5'
+                other.save()
+            model.txt = str(int(model.txt) + 1)
+
+        res = FakeModel.update(f.id, bump, backoff=0)
+        self.assertEqual(['0', '5'], calls)
+        self.assertEqual('6', res.txt)
+        self.assertEqual('6', FakeModel.load(f.id).txt)
+        self.assertEqual(None, FakeModel.update('nope', bump))
+
+    def test_update_gives_up(self):
+        f = FakeModel(txt='0').save()
+
+        def always_conflict(model):
+            get_connection().set(f.id, get_connection().get(f.id))
+            model.txt = 'never'
+
+        with self.assertRaises(DocumentConflict):
+            FakeModel.update(f.id, always_conflict, retries=2, backoff=0)
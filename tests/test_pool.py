@@ -0,0 +1,60 @@
+import unittest
+from threading import Thread
+
+from ..cushion.model import Model
+from ..cushion.field import TextField
+from ..cushion.persist import set_connection, get_connection
+from ..cushion.persist.exceptions import PoolTimeout
+from ..cushion.persist.mem import MemConnection
+from ..cushion.persist.pool import ConnectionPool
+
+
+class Pooled(Model):
+    name = TextField()
+
+
+class TestPool(unittest.TestCase):
+
+    def test_set_connection_factory(self):
+        set_connection(MemConnection, pool_size=1)
+        pool = get_connection()
+        assert isinstance(pool, ConnectionPool)
+        p = Pooled(name='x').save()
+        self.assertEqual('x', Pooled.load(p.id).name)
+        stats = pool.stats()
+        self.assertEqual(1, stats['created'])
+        self.assertEqual(0, stats['in_use'])
+
+    def test_bounded(self):
+        pool = ConnectionPool(MemConnection, size=2, timeout=0.01)
+        c0, c1 = pool.checkout(), pool.checkout()
+        assert c0 is not c1
+        with self.assertRaises(PoolTimeout):
+            pool.checkout()
+        pool.checkin(c0)
+        assert c0 is pool.checkout()
+        self.assertEqual(1, pool.stats()['timeouts'])
+        self.assertEqual(1, pool.stats()['waits'])
+
+    def test_health_check(self):
+        pool = ConnectionPool(MemConnection, size=1,
+            health_check=lambda conn: not getattr(conn, 'broken', False))
+        conn = pool.checkout()
+        conn.broken = True
+        pool.checkin(conn)
+        assert conn is not pool.checkout()
+        self.assertEqual(1, pool.stats()['discarded'])
+
+    def test_per_thread(self):
+        pool = ConnectionPool(MemConnection, size=2, per_thread=True)
+        pool.set('k', {'v': 1})
+        self.assertEqual({'v': 1}, pool.get('k'))
+        seen = []
+        t = Thread(target=lambda: seen.append(pool.get('k')))
+        t.start()
+        t.join()
+        # the other thread got a connection of its own
+        self.assertEqual([None], seen)
+        self.assertEqual(2, pool.stats()['in_use'])
+        pool.release()
+        self.assertEqual(1, pool.stats()['in_use'])
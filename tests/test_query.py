@@ -0,0 +1,114 @@
+import unittest
+from datetime import datetime
+
+from ..cushion.model import Model
+from ..cushion.field import DateTimeField, IntegerField, RefField, TextField
+from ..cushion.persist import set_connection
+from ..cushion.persist.base import Select
+from ..cushion.persist.mem import MemConnection
+from ..cushion.persist.n1ql import compile_statement
+
+
+class Maker(Model):
+    name = TextField()
+
+
+class Shoe(Model):
+    size = IntegerField()
+    color = TextField()
+    made = DateTimeField()
+    maker = RefField(Maker)
+
+
+COLORS = ['red', 'blue', 'green']
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = MemConnection()
+        set_connection(self.conn)
+        self.maker = Maker(name='acme').save()
+        self.shoes = [Shoe(size=8 + i % 4, color=COLORS[i % 3],
+            maker=self.maker).save() for i in range(12)]
+        # not a shoe, but with a size
+        self.conn.set('other', {'type': 'boot', 'size': 9})
+
+    def ids(self, query):
+        return [m.id for m in query]
+
+    def expect(self, pred):
+        return sorted(s.id for s in self.shoes if pred(s))
+
+    def test_where(self):
+        self.assertEqual(self.expect(lambda s: s.size == 9),
+            sorted(self.ids(Shoe.where(size=9))))
+        self.assertEqual(
+            self.expect(lambda s: s.size > 9 and s.color != 'red'),
+            sorted(self.ids(Shoe.where(size__gt=9, color__ne='red'))))
+        self.assertEqual(
+            self.expect(lambda s: s.color in ('red', 'blue')),
+            sorted(self.ids(Shoe.where(color__in=['red', 'blue']))))
+        self.assertEqual(12, len(self.ids(Shoe.where(maker=self.maker))))
+        self.assertEqual([], self.ids(Shoe.where(size=None)))
+        shoe = Shoe.where(size=8).first()
+        assert isinstance(shoe, Shoe)
+        self.assertEqual(self.conn.cas(shoe.id), shoe.cas)
+
+    def test_order_and_limit(self):
+        shoes = list(Shoe.where().order_by('color', '-size'))
+        keys = [(s.color, s.size) for s in shoes]
+        self.assertEqual(
+            sorted(keys, key=lambda k: (k[0], -k[1])), keys)
+        page = Shoe.where(size__lte=9).order_by('size').offset(2).limit(3)
+        self.assertEqual([8, 9, 9], [s.size for s in page])
+
+    def test_field_index(self):
+        queries = [
+            Shoe.where(size=9),
+            Shoe.where(size__gte=9, color='blue'),
+            Shoe.where(size__lt=10).order_by('-color'),
+            Shoe.where(color__in=['green', 'red']).order_by('size'),
+            Shoe.where(color__ne='red') ]
+        before = [self.ids(q) for q in queries]
+        Shoe.create_index('size', 'color')
+        self.assertEqual(before, [self.ids(q) for q in queries])
+        index = self.conn.field_indexes[('shoe', 'size')]
+        # the boot isn't a shoe
+        self.assertEqual(12, len(index.entries))
+        # kept current on writes
+        shoe = self.shoes[0]
+        shoe.size = 30
+        shoe.save()
+        self.shoes[1].delete()
+        Shoe(size=30).save()
+        self.assertEqual(2, len(self.ids(Shoe.where(size=30))))
+        self.assertEqual(12, len(index.entries))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            Shoe.where(heel=2)
+        with self.assertRaises(ValueError):
+            Shoe.where(size__near=2)
+        with self.assertRaises(ValueError):
+            Shoe.where().order_by('-heel')
+
+    def test_compile(self):
+        made = datetime(2016, 3, 1)
+        query = Shoe.where(size__gte=9, made=made).order_by('-color')
+        select = query.limit(10).select
+        self.assertEqual(
+            Select('shoe', (('made', 'eq', made.isoformat()),
+                ('size', 'gte', 9)), (('color', True),), 10, None),
+            select)
+        self.assertEqual(
+            'SELECT META(d).id AS id, META(d).cas AS cas, d AS doc '
+            'FROM `shop` d WHERE d.`type` = "shoe" AND d.`made` = $1 '
+            'AND d.`size` >= $2 ORDER BY d.`color` DESC LIMIT $3',
+            compile_statement(select, 'shop'))
+        self.assertEqual([made.isoformat(), 9, 10], select.params)
+        # other values, same statement
+        other = Shoe.where(size__gte=1, made=made).order_by('-color') \
+            .limit(5).select
+        self.assertEqual(select.shape, other.shape)
+        self.assertNotEqual(select.shape, query.select.shape)
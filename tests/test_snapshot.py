@@ -0,0 +1,168 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..cushion.model import Model
+from ..cushion.field import IntegerField, TextField
+from ..cushion.persist import set_connection
+from ..cushion.persist.mem import MemConnection
+from ..cushion.persist.snapshot import SnapshotData
+from ..cushion.view import View, sync_all
+
+
+mapped = []
+
+
+def map_by_rank(doc, meta):
+    if doc.get('type') == 'player':
+        mapped.append(meta['id'])
+        yield doc['rank'], None
+
+
+class Player(Model):
+    name = TextField()
+    rank = IntegerField()
+
+    by_rank = View(
+        'player', 'by_rank',
+        '''
+        function(doc) {
+            if (doc.type == "player") {
+                emit(doc.rank, null)
+            }
+        }
+        ''',
+        pymapf=map_by_rank )
+
+
+def map_by(field):
+    def by(doc, meta):
+        if doc.get('type') == 'player':
+            yield doc[field], None
+    return by
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'fixture.snap')
+        del mapped[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reopen(self, conn):
+        conn.close()
+        conn = MemConnection(path=self.path)
+        set_connection(conn)
+        return conn
+
+    def fixture(self, n=5):
+        conn = MemConnection(path=self.path)
+        set_connection(conn)
+        sync_all(Player.viewlist())
+        for i in range(n):
+            Player(name='p{}'.format(i), rank=i).save()
+        return conn
+
+    def test_dump_and_open(self):
+        conn = self.fixture()
+        first = Player.by_rank(limit=1, include_docs=True)[0]
+        conn.dump()
+        conn = self.reopen(conn)
+        assert isinstance(conn.data, SnapshotData)
+        self.assertEqual(5, len(conn.data))
+        # nothing decoded until read
+        self.assertEqual({}, conn.data._docs)
+        self.assertEqual('p0', Player.load(first.id).name)
+        self.assertEqual(1, len(conn.data._docs))
+
+    def test_write_log(self):
+        conn = self.fixture()
+        conn.dump()
+        conn = self.reopen(conn)
+        sync_all(Player.viewlist())
+        p = Player(name='new', rank=9).save()
+        old = Player.by_rank(key=0, include_docs=True)[0]
+        old.name = 'renamed'
+        old.save()
+        Player.by_rank(key=1, include_docs=True)[0].delete()
+        conn = self.reopen(conn)
+        self.assertEqual('new', Player.load(p.id).name)
+        self.assertEqual('renamed', Player.load(old.id).name)
+        self.assertEqual(5, len(conn.data))
+        # a write cut short at the end of the log is ignored
+        with open(self.path + '.log', 'ab') as f:
+            f.write('["s", "half')
+        conn = self.reopen(conn)
+        self.assertEqual(5, len(conn.data))
+
+    def test_torn_log_reopened_twice(self):
+        conn = self.fixture(2)
+        conn.dump()
+        conn = self.reopen(conn)
+        p = Player(name='kept', rank=7).save()
+        with open(self.path + '.log', 'ab') as f:
+            f.write('["s", "half')
+        conn = self.reopen(conn)
+        q = Player(name='after', rank=8).save()
+        conn = self.reopen(conn)
+        self.assertEqual(4, len(conn.data))
+        self.assertEqual('kept', Player.load(p.id).name)
+        self.assertEqual('after', Player.load(q.id).name)
+
+    def test_view_index_kept(self):
+        conn = self.fixture()
+        Player.by_rank()
+        conn.dump()
+        conn = self.reopen(conn)
+        extra = Player(name='extra', rank=2).save()
+        del mapped[:]
+        sync_all(Player.viewlist())
+        self.assertEqual([0, 1, 2, 2, 3, 4],
+            [r.key for r in Player.by_rank()])
+        # only the doc written since the snapshot was mapped
+        self.assertEqual([extra.id], mapped)
+        # dumped again with the log applied
+        conn.dump()
+        self.assertEqual(0, os.path.getsize(self.path + '.log'))
+        conn = self.reopen(conn)
+        sync_all(Player.viewlist())
+        self.assertEqual(6, len(Player.by_rank()))
+
+    def test_changed_map_rebuilds(self):
+        conn = self.fixture()
+        Player.by_rank()
+        conn.dump()
+        conn = self.reopen(conn)
+        conn._saved_views['player/by_rank'] = (
+            'other', conn._saved_views['player/by_rank'][1])
+        del mapped[:]
+        sync_all(Player.viewlist())
+        self.assertEqual(5, len(Player.by_rank()))
+        self.assertEqual(5, len(mapped))
+
+    def test_closure_map_rebuilds(self):
+        conn = self.fixture()
+        conn.design_view_create('player', {'by': {'pymap': map_by('name')}})
+        self.assertEqual(5, len(list(conn.query('player', 'by'))))
+        conn.dump()
+        conn = self.reopen(conn)
+        # the same code over another field
+        conn.design_view_create('player', {'by': {'pymap': map_by('rank')}})
+        self.assertEqual(range(5), [r.key for r in conn.query('player', 'by')])
+        # nor is a map over what can't be told apart saved
+        conn.design_view_create('player',
+            {'by': {'pymap': map_by(object())}})
+        self.assertEqual(None, conn.designs['player/by']['digest'])
+
+    def test_cas(self):
+        conn = self.fixture(1)
+        conn.dump()
+        conn = self.reopen(conn)
+        key = conn.data.keys()[0]
+        doc, cas = conn.get(key, with_cas=True)
+        assert cas is not None
+        self.assertEqual(cas, conn.cas(key))
@@ -1,3 +1,4 @@
+import os
 import unittest
 from datetime import datetime, timedelta
 
@@ -5,11 +6,24 @@ from ..cushion.model import Model, DocTypeMismatch, DocTypeNotFound
 from ..cushion.field import (
     Field, TextField, IntegerField, FloatField, RefField, DateTimeField
     )
-from ..cushion.persist import set_connection, Persist
-from ..cushion.persist.mem import MemConnection
+from ..cushion.persist import set_connection, get_connection, Persist
+from ..cushion.persist.cache import identity_map
+from ..cushion.persist import mem
+from ..cushion.persist.mem import MemConnection, compile_map
 from ..cushion.view import View, sync_all
 
 
+def map_by_i(doc, meta):
+    if doc.get('type') == 'boogie':
+        yield doc['i'], None
+
+
+def map_n_times(doc, meta):
+    if doc.get('type') == 'boogie':
+        for _ in range(doc['i']):
+            yield doc['n'], None
+
+
 class Boogie(Model):
     n = TextField()
     i = IntegerField(default=37)
@@ -44,16 +58,123 @@ class Boogie(Model):
         }
         ''' )
 
+    by_i = View(
+        'boog', 'by_i',
+        '''
+        function(doc) {
+            if (doc.type == "boogie") {
+                emit(doc.i, null)
+            }
+        }
+        ''',
+        pymapf=map_by_i )
+
+    n_times = View(
+        'boog', 'n_times',
+        '''
+        function(doc) {
+            if (doc.type == "boogie") {
+                for (var j = 0; j < doc.i; j++) {
+                    emit(doc.n, null)
+                }
+            }
+        }
+        ''',
+        pymapf=map_n_times )
+
+    stats_by_comp = View(
+        'boog', 'stats_by_comp',
+        '''
+        function(doc) {
+            if (doc.type == "boogie") {
+                emit([doc.n, doc.i], doc.i)
+            }
+        }
+        ''',
+        '_stats' )
+
+    custom_sum_by_n = View(
+        'boog', 'custom_sum_by_n',
+        '''
+        function(doc) {
+            if (doc.type == "boogie") {
+                emit(doc.n, doc.i)
+            }
+        }
+        ''',
+        '''
+        function(keys, values, rereduce) {
+            return sum(values)
+        }
+        ''' )
+
 
 def clean_out_db_docs():
     for d in Boogie.all_docs(wrapper=None):
         Persist().delete(d.docid)
 
 
+class CountingReducer(object):
+    """ counts the batches and rows a reducer is handed """
+
+    def __init__(self, reducer):
+        self.reducer = reducer
+        self.batches = 0
+        self.reduced = 0
+
+    def __call__(self, keys, values, rereduce):
+        return self.many([(keys, values, rereduce)])[0]
+
+    def many(self, calls):
+        self.batches += 1
+        self.reduced += sum(len(v) for _, v, rereduce in calls if not rereduce)
+        return self.reducer.many(calls)
+
+
+def count_reduces(name):
+    view = get_connection().designs[name]
+    view['redf'] = CountingReducer(view['redf'])
+    return view['redf']
+
+
 class Outter(Model):
     some = TextField()
 
 
+def map_holders(doc, meta):
+    if doc.get('type') == 'holder':
+        yield meta['id'], None
+
+
+class Holder(Model):
+    boog = RefField(Boogie)
+
+    everything = View(
+        'hold', 'everything',
+        '''
+        function(doc, meta) {
+            if (doc.type == "holder") {
+                emit(meta.id, null)
+            }
+        }
+        ''',
+        pymapf=map_holders )
+
+
+def map_by_mapper(doc, meta):
+    if doc.get('type') == 'holder':
+        yield os.getpid(), None
+
+
+class Mapped(Model):
+    by_mapper = View(
+        'mapped', 'by_mapper',
+        '''
+        function(doc) {}
+        ''',
+        pymapf=map_by_mapper )
+
+
 class TestField(unittest.TestCase):
 
     def setUp(self):
@@ -71,6 +192,15 @@ class TestField(unittest.TestCase):
         assert r.n == b0.n
         assert r.id == b0.id
 
+    def test_wrapped_docs_are_lazy(self):
+        b0 = Boogie(n='one').save()
+        r = Boogie.by_n(key='one', include_docs=True)[0]
+        self.assertEqual({}, r._data)
+        assert not r.is_dirty
+        with identity_map():
+            b1 = Boogie.load(b0.id)
+            assert b1 is Boogie.by_n(key='one', include_docs=True)[0]
+
     def test_by_comp(self):
         b0 = Boogie(n='one').save()
         b1 = Boogie(n='two').save()
@@ -96,3 +226,227 @@ class TestField(unittest.TestCase):
         assert 'z9' == r.n
 
 
+
+    def test_key(self):
+        Boogie(n='one').save()
+        b1 = Boogie(n='two').save()
+        res = Boogie.by_n(key='two', include_docs=True)
+        self.assertEqual([b1.id], [r.id for r in res])
+
+    def test_skip_limit(self):
+        for n in ('a', 'b', 'c', 'd', 'e'):
+            Boogie(n=n).save()
+        res = Boogie.by_n(startkey='b', skip=1, limit=2, include_docs=True)
+        self.assertEqual(['c', 'd'], [r.n for r in res])
+        res = Boogie.by_n(startkey='d', descending=True, skip=1, limit=2,
+                include_docs=True)
+        self.assertEqual(['c', 'b'], [r.n for r in res])
+
+    def test_index_follows_writes(self):
+        b0 = Boogie(n='one').save()
+        self.assertEqual(1, len(Boogie.by_n(key='one')))
+        b0.n = 'uno'
+        b0.save()
+        self.assertEqual(0, len(Boogie.by_n(key='one')))
+        self.assertEqual(1, len(Boogie.by_n(key='uno')))
+        b0.delete()
+        self.assertEqual(0, len(Boogie.by_n(key='uno')))
+
+    def test_python_map(self):
+        Boogie(n='one', i=1).save()
+        b2 = Boogie(n='two', i=2).save()
+        res = Boogie.by_i(startkey=2, include_docs=True)
+        self.assertEqual([b2.id], [r.id for r in res])
+
+    def test_batched_js_map(self):
+        get_connection().map_batch_size = 2
+        for n in ('a', 'b', 'c', 'd', 'e'):
+            Boogie(n=n).save()
+        sync_all(Boogie.viewlist())
+        self.assertEqual(5, len(Boogie.by_n()))
+
+    def test_resync_keeps_index(self):
+        Boogie(n='one').save()
+        Boogie.by_n()
+        index = get_connection().designs['boog/by_n']['index']
+        sync_all(Boogie.viewlist())
+        assert index is get_connection().designs['boog/by_n']['index']
+        self.assertEqual(
+            compile_map(Boogie.by_n.mapf)[1],
+            get_connection().designs['boog/by_n']['mapf'] )
+
+    def test_reduce_stats(self):
+        Boogie(n='a', i=1).save()
+        Boogie(n='a', i=3).save()
+        Boogie(n='b', i=5).save()
+        res = Boogie.stats_by_comp()
+        self.assertEqual(1, len(res))
+        self.assertEqual(None, res[0].key)
+        self.assertEqual(
+            {'sum': 9, 'count': 3, 'min': 1, 'max': 5, 'sumsqr': 35},
+            res[0].value )
+        res = Boogie.stats_by_comp(group_level=1)
+        self.assertEqual([['a'], ['b']], [r.key for r in res])
+        self.assertEqual([2, 1], [r.value['count'] for r in res])
+        res = Boogie.stats_by_comp(group=True, descending=True, limit=1)
+        self.assertEqual([['b', 5]], [r.key for r in res])
+
+    def test_reduce_follows_writes(self):
+        b0 = Boogie(n='a', i=1).save()
+        self.assertEqual(1, Boogie.stats_by_comp()[0].value['count'])
+        Boogie(n='b', i=2).save()
+        self.assertEqual(2, Boogie.stats_by_comp()[0].value['count'])
+        b0.delete()
+        self.assertEqual(2, Boogie.stats_by_comp()[0].value['sum'])
+
+    def test_reduce_off(self):
+        b0 = Boogie(n='a', i=1).save()
+        res = Boogie.stats_by_comp(reduce=False, include_docs=True)
+        self.assertEqual([b0.id], [r.id for r in res])
+
+    def test_custom_reduce(self):
+        Boogie(n='a', i=1).save()
+        Boogie(n='a', i=3).save()
+        Boogie(n='b', i=5).save()
+        res = Boogie.custom_sum_by_n(group=True)
+        self.assertEqual([(u'a', 4), (u'b', 5)], [(r.key, r.value) for r in res])
+
+    def test_reduce_batches(self):
+        for n in 'abcdefgh':
+            Boogie(n=n, i=1).save()
+        Boogie.custom_sum_by_n(limit=0)
+        counter = count_reduces('boog/custom_sum_by_n')
+        res = Boogie.custom_sum_by_n(group=True)
+        self.assertEqual([(n, 1) for n in u'abcdefgh'],
+            [(r.key, r.value) for r in res])
+        self.assertEqual(2, counter.batches)
+
+    def test_reduce_blocks(self):
+        block, mem.REDUCE_BLOCK = mem.REDUCE_BLOCK, 4
+        try:
+            for i in range(40):
+                Boogie(n='a' if i < 30 else 'b', i=i).save()
+            Boogie.custom_sum_by_n(limit=0)
+            counter = count_reduces('boog/custom_sum_by_n')
+            self.assertEqual(sum(range(40)), Boogie.custom_sum_by_n()[0].value)
+            self.assertEqual(40, counter.reduced)
+            b = Boogie(n='a', i=100).save()
+            counter.reduced = 0
+            self.assertEqual(sum(range(40)) + 100,
+                Boogie.custom_sum_by_n()[0].value)
+            assert counter.reduced <= 2 * 4 + 1
+            b.delete()
+            res = Boogie.custom_sum_by_n(group=True)
+            self.assertEqual([(u'a', sum(range(30))), (u'b', sum(range(30, 40)))],
+                [(r.key, r.value) for r in res])
+            res = Boogie.stats_by_comp(group_level=1, startkey=['a', 5],
+                endkey=['b', 33])
+            self.assertEqual([25, 4], [r.value['count'] for r in res])
+        finally:
+            mem.REDUCE_BLOCK = block
+
+    def test_iter_pages(self):
+        for n in ('a', 'b', 'b', 'c', 'd', 'e', 'f'):
+            Boogie(n=n).save()
+        expected = [b.id for b in Boogie.by_n(include_docs=True)]
+        it = Boogie.by_n.iter(page_size=3, include_docs=True)
+        self.assertEqual(expected, [b.id for b in it])
+        res = Boogie.by_n.iter(page_size=2, limit=5, descending=True,
+            include_docs=True)
+        self.assertEqual(expected[::-1][:5], [b.id for b in res])
+
+    def test_iter_resume(self):
+        for n in ('a', 'b', 'c', 'd', 'e'):
+            Boogie(n=n).save()
+        it = Boogie.by_n.iter(page_size=2, include_docs=True)
+        first = []
+        for b in it:
+            first.append(b.n)
+            if len(first) == 3:
+                break
+        rest = Boogie.by_n.iter(page_size=2, cursor=it.cursor,
+            include_docs=True)
+        self.assertEqual(['a', 'b', 'c'], first)
+        self.assertEqual(['d', 'e'], [b.n for b in rest])
+
+    def test_iter_cursor_row_gone(self):
+        boogs = [Boogie(n=n).save() for n in ('a', 'b', 'c', 'd', 'e')]
+        it = Boogie.by_n.iter(page_size=2, include_docs=True)
+        seen = []
+        for b in it:
+            seen.append(b.n)
+            if b.n == 'b':
+                # the rows before the next page change under it
+                boogs[0].delete()
+                boogs[1].delete()
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'], seen)
+
+    def test_iter_repeated_emits(self):
+        for n, i in (('a', 3), ('b', 1), ('c', 2)):
+            Boogie(n=n, i=i).save()
+        for page_size in (1, 2, 3):
+            it = Boogie.n_times.iter(page_size=page_size, include_docs=True)
+            self.assertEqual(['a', 'a', 'a', 'b', 'c', 'c'],
+                [b.n for b in it])
+        it = Boogie.n_times.iter(page_size=2, include_docs=True)
+        first = [b.n for _, b in zip(range(2), it)]
+        rest = Boogie.n_times.iter(page_size=2, cursor=it.cursor,
+            include_docs=True)
+        self.assertEqual(['a', 'a'], first)
+        self.assertEqual(['a', 'b', 'c', 'c'], [b.n for b in rest])
+
+    def test_prefetch(self):
+        sync_all(Holder.viewlist())
+        for n in ('a', 'b', 'c'):
+            Holder(boog=Boogie(n=n).save()).save()
+        res = Holder.everything(include_docs=True, prefetch=['boog'])
+        assert all('boog' in h._data for h in res), "not prefetched"
+        self.assertEqual(['a', 'b', 'c'], sorted(h.boog.n for h in res))
+        res = list(Holder.everything.iter(
+            page_size=2, include_docs=True, prefetch=['boog']))
+        assert all('boog' in h._data for h in res), "not prefetched"
+
+    def test_profile(self):
+        for i in range(5):
+            Boogie(n='p', i=i).save()
+        Boogie(n='q').save()
+        res, profile = Boogie.by_i(
+            startkey=1, endkey=3, limit=2, include_docs=True, profile=True)
+        self.assertEqual(2, len(res))
+        self.assertEqual('boog/by_i', profile.view)
+        self.assertEqual(
+            ['map', 'index', 'scan', 'fetch', 'wrap'], list(profile.phases))
+        self.assertEqual((6, 3, 2, 2), (profile.rows_mapped,
+            profile.rows_scanned, profile.rows_returned,
+            profile.docs_fetched))
+        assert profile.elapsed >= sum(profile.phases.values())
+        assert 'boog/by_i' in str(profile)
+        # the index is built now, only the new doc gets mapped
+        Boogie(n='r', i=2).save()
+        _, profile = Boogie.by_i(startkey=1, endkey=3, profile=True)
+        self.assertEqual(1, profile.rows_mapped)
+        self.assertEqual(4, profile.rows_returned)
+        res, profile = Boogie.stats_by_comp(group_level=1, profile=True)
+        self.assertEqual(['map', 'index', 'reduce', 'wrap'],
+            list(profile.phases))
+        self.assertEqual((7, 3), (profile.rows_scanned,
+            profile.rows_returned))
+
+    def test_parallel_build(self):
+        for i in range(20):
+            Boogie(n=str(i % 7), i=i).save()
+            Holder().save()
+        serial = dict(get_connection().data)
+        expected = [(r.key, r.docid) for r in Boogie.by_n()]
+        conn = MemConnection(map_workers=2, parallel_threshold=10)
+        conn.data = serial
+        set_connection(conn)
+        sync_all(Boogie.viewlist() + Mapped.viewlist())
+        conn.build_indexes()
+        self.assertEqual(expected, [(r.key, r.docid) for r in Boogie.by_n()])
+        self.assertEqual(20, len(Boogie.by_i(startkey=0)))
+        mappers = set(r.key for r in Mapped.by_mapper())
+        assert os.getpid() not in mappers, "mapped in this process"
+        # the built index follows writes as usual
+        Boogie(n='0', i=99).save()
+        self.assertEqual(21, len(Boogie.by_n()))
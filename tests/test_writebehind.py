@@ -0,0 +1,164 @@
+import unittest
+from threading import Event, Thread
+from time import sleep
+
+from ..cushion.model import Model
+from ..cushion.field import IntegerField
+from ..cushion.persist import Persist, set_connection, set_write_behind
+from ..cushion.persist.exceptions import DocumentConflict, PersistenceError
+from ..cushion.persist.mem import MemConnection
+from ..cushion.persist.writebehind import WriteBehind
+
+
+class Presence(Model):
+    write_behind = True
+    seen = IntegerField()
+
+
+class BatchCountingConnection(MemConnection):
+
+    def __init__(self, fail=()):
+        super(BatchCountingConnection, self).__init__()
+        self.batches = []
+        self.fail = fail
+
+    def set_multi(self, items, durability=None):
+        self.batches.append([k for k,_ in items])
+        ok = [(k, v) for k,v in items if k not in self.fail]
+        results, errors = super(BatchCountingConnection, self).set_multi(
+            ok, durability)
+        errors.update({k: Exception('nope') for k,_ in items
+            if k in self.fail})
+        return results, errors
+
+
+class SlowConnection(MemConnection):
+    """ holds batches until released """
+
+    def __init__(self):
+        super(SlowConnection, self).__init__()
+        self.writing = Event()
+        self.release = Event()
+
+    def set_multi(self, items, durability=None):
+        self.writing.set()
+        self.release.wait(5)
+        return super(SlowConnection, self).set_multi(items, durability)
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = BatchCountingConnection(fail=('bad',))
+        set_connection(self.conn)
+        self.errors = {}
+        self.writer = WriteBehind(
+            max_batch=100, interval=60, on_error=self.errors.update)
+        set_write_behind(self.writer)
+
+    def tearDown(self):
+        set_write_behind(None)
+
+    def test_coalesce(self):
+        p = Presence()
+        for i in range(10):
+            p.seen = i
+            p.save()
+        assert p.id, "no id assigned"
+        self.assertEqual(None, self.conn.get(p.id))
+        # reads see the pending state
+        self.assertEqual(9, Presence.load(p.id).seen)
+        self.writer.flush()
+        self.assertEqual([[p.id]], self.conn.batches)
+        self.assertEqual(9, self.conn.get(p.id)['seen'])
+        self.assertEqual(9, self.writer.coalesced)
+
+    def test_size_threshold(self):
+        self.writer.max_batch = 3
+        for i in range(3):
+            Presence(seen=i).save()
+        for _ in range(100):
+            if self.conn.batches:
+                break
+            sleep(0.01)
+        self.assertEqual(1, len(self.conn.batches))
+        self.assertEqual(3, len(self.conn.batches[0]))
+
+    def test_errors(self):
+        self.writer.enqueue('bad', {'type': 'presence'})
+        self.writer.enqueue('good', {'type': 'presence'})
+        self.writer.flush()
+        self.assertEqual(['bad'], self.errors.keys())
+        assert self.conn.get('good'), "good doc not written"
+
+    def test_error_callback_deletes(self):
+        self.writer.on_error = lambda errors: [
+            Persist().delete(docid) for docid in errors]
+        self.writer.enqueue('bad', {'type': 'presence'})
+        flushing = Thread(target=self.writer.flush)
+        flushing.daemon = True
+        flushing.start()
+        flushing.join(5)
+        assert not flushing.is_alive(), "flush hung in its error callback"
+        self.assertEqual(None, self.conn.get('bad'))
+
+    def test_close_drains(self):
+        p = Presence(seen=1).save()
+        set_write_behind(None)
+        self.assertEqual(1, self.conn.get(p.id)['seen'])
+        with self.assertRaises(RuntimeError):
+            self.writer.enqueue('late', {})
+
+    def test_delete_queued_only(self):
+        p = Presence(seen=1).save()
+        p.delete()
+        self.writer.flush()
+        self.assertEqual(None, self.conn.get(p.id))
+        self.assertEqual([], self.conn.batches)
+
+    def test_delete_discards(self):
+        p = Presence(seen=1).save()
+        self.conn.set(p.id, {'type': 'presence'})
+        p.delete()
+        self.writer.flush()
+        self.assertEqual(None, self.conn.get(p.id))
+
+    def test_delete_during_flush(self):
+        conn = SlowConnection()
+        set_connection(conn)
+        p = Presence(seen=1).save()
+        flush = Thread(target=self.writer.flush)
+        flush.start()
+        conn.writing.wait(5)
+        delete = Thread(target=p.delete)
+        delete.start()
+        sleep(0.05)
+        conn.release.set()
+        flush.join()
+        delete.join()
+        self.assertEqual(None, conn.get(p.id))
+
+    def test_check_cas(self):
+        p = Presence(seen=1).save()
+        # queued, so there is no cas to check
+        with self.assertRaises(PersistenceError):
+            Presence.load(p.id).save(check_cas=True)
+        self.writer.flush()
+        mine, theirs = Presence.load(p.id), Presence.load(p.id)
+        theirs.seen = 2
+        theirs.save()
+        self.writer.flush()
+        mine.seen = 3
+        with self.assertRaises(DocumentConflict):
+            mine.save(check_cas=True)
+        # written right away, not queued
+        theirs = Presence.load(p.id)
+        theirs.seen = 4
+        theirs.save(check_cas=True)
+        self.assertEqual(0, len(self.writer))
+        self.assertEqual(4, self.conn.get(p.id)['seen'])
+
+    def test_update_pending(self):
+        p = Presence(seen=1).save()
+        Presence.update(p.id, lambda m: setattr(m, 'seen', m.seen + 1))
+        self.assertEqual(2, self.conn.get(p.id)['seen'])